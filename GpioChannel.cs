@@ -0,0 +1,105 @@
+using System;
+using System.Collections.Generic;
+using System.Diagnostics;
+using System.Net.Sockets;
+
+namespace Mirror_MIDI
+{
+    // Sends DHD GPIO codes to the Python script over a local TCP socket
+    // instead of stdin. A frame is one count byte followed by count
+    // (gpio, state) byte pairs, "2A01" going out as 2A 01, so codes that are
+    // collected together are written in one go. After a failed connection the
+    // next attempt waits out a backoff, doubling up to MAX_RETRY_DELAY_MS, so
+    // a script that is not listening does not stall every Send on a connect.
+    public class GpioChannel : IDisposable
+    {
+        public const int DEFAULT_PORT = 4647;
+        private const int MAX_CODES_PER_FRAME = 255;
+        private const int CONNECT_TIMEOUT_MS = 200;
+        private const int MIN_RETRY_DELAY_MS = 500;
+        private const int MAX_RETRY_DELAY_MS = 10000;
+        private readonly int port;
+        private readonly object sync = new object();
+        private TcpClient client;
+        private NetworkStream stream;
+        private int retryDelay = MIN_RETRY_DELAY_MS;
+        private long retryAt;
+
+        public GpioChannel(int port = DEFAULT_PORT)
+        {
+            this.port = port;
+        }
+
+        public int Port => port;
+
+        // Returns false when the script cannot be reached, the caller falls back to stdin
+        public bool Send(IList<string> codes)
+        {
+            lock (sync)
+            {
+                if (client == null && Environment.TickCount64 < retryAt)
+                {
+                    return false;
+                }
+
+                try
+                {
+                    if (client == null)
+                    {
+                        client = new TcpClient { NoDelay = true };
+                        if (!client.ConnectAsync("127.0.0.1", port).Wait(CONNECT_TIMEOUT_MS))
+                        {
+                            throw new TimeoutException($"no connection to port {port} within {CONNECT_TIMEOUT_MS} ms");
+                        }
+                        stream = client.GetStream();
+                        retryDelay = MIN_RETRY_DELAY_MS;
+                    }
+
+                    byte[] frame = Encode(codes);
+                    stream.Write(frame, 0, frame.Length);
+                    return true;
+                }
+                catch (Exception ex)
+                {
+                    Debug.WriteLine($"GPIO channel error: {ex.Message}, retrying in {retryDelay} ms");
+                    Close();
+                    retryAt = Environment.TickCount64 + retryDelay;
+                    retryDelay = Math.Min(retryDelay * 2, MAX_RETRY_DELAY_MS);
+                    return false;
+                }
+            }
+        }
+
+        public static byte[] Encode(IList<string> codes)
+        {
+            var frame = new List<byte>();
+            for (int start = 0; start < codes.Count; start += MAX_CODES_PER_FRAME)
+            {
+                int count = Math.Min(MAX_CODES_PER_FRAME, codes.Count - start);
+                frame.Add((byte)count);
+                for (int i = start; i < start + count; i++)
+                {
+                    frame.Add(Convert.ToByte(codes[i].Substring(0, 2), 16));
+                    frame.Add(Convert.ToByte(codes[i].Substring(2, 2), 16));
+                }
+            }
+            return frame.ToArray();
+        }
+
+        private void Close()
+        {
+            stream?.Dispose();
+            client?.Dispose();
+            stream = null;
+            client = null;
+        }
+
+        public void Dispose()
+        {
+            lock (sync)
+            {
+                Close();
+            }
+        }
+    }
+}
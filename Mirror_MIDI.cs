@@ -10,6 +10,7 @@ namespace Mirror_MIDI
     {
         private Process pythonProcess;
         private DHDServer dhdServer;
+        private GpioChannel gpioChannel;
 
         public Form1()
         {
@@ -109,10 +110,18 @@ namespace Mirror_MIDI
                 StopPythonScript();
             }
 
+            // GPIO codes go over a local socket when DHD is enabled, stdin stays as the fallback
+            string gpioArguments = "";
+            if (dhdEnabled == "True")
+            {
+                gpioChannel = new GpioChannel();
+                gpioArguments = $" --gpio-port {gpioChannel.Port}";
+            }
+
             ProcessStartInfo startInfo = new ProcessStartInfo
             {
                 FileName = "python",
-                Arguments = $"\"{scriptPath}\" \"{device1}\" \"{device2}\" \"{dhdEnabled}\" \"{dhdDevice}\"",
+                Arguments = $"\"{scriptPath}\" \"{device1}\" \"{device2}\" \"{dhdEnabled}\" \"{dhdDevice}\"{gpioArguments}",
                 UseShellExecute = false,
                 RedirectStandardOutput = true,
                 RedirectStandardError = true,
@@ -132,6 +141,9 @@ namespace Mirror_MIDI
 
         private void StopPythonScript()
         {
+            gpioChannel?.Dispose();
+            gpioChannel = null;
+
             if (pythonProcess != null)
             {
                 try
@@ -217,6 +229,11 @@ namespace Mirror_MIDI
         }
         private void SendMessageToPythonScript(string message)
         {
+            if (gpioChannel != null && gpioChannel.Send(new[] { message }))
+            {
+                return;
+            }
+
             if (pythonProcess != null && !pythonProcess.HasExited)
             {
                 pythonProcess.StandardInput.WriteLine(message);
@@ -0,0 +1,907 @@
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+# Hardware-free benchmarks for the mirror pipeline. Every scenario runs in its
+# own process against the simulated backend in scripts/midi_sim.py, replays a
+# synthetic or recorded session through start_routing() (start_mirroring()
+# with --engine threads, start_processes() with --engine processes) and
+# reports latency, jitter, throughput, coalescing and CPU figures. Results are written to benchmarks/results so runs can be compared
+# across releases.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.normpath(os.path.join(BENCH_DIR, '..', 'scripts'))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, SCRIPTS_DIR)
+
+SCENARIOS = ('fader_sweep', 'button_mash', 'dhd_gpio_burst', 'dhd_gpio_load', 'port_reconnect', 'bidirectional_sweep', 'macro_fire',
+             'fader_saturation')
+# The processes engine can only replay MIDI input, see replay_direction()
+PROCESS_SCENARIOS = ('fader_sweep', 'button_mash', 'bidirectional_sweep', 'macro_fire', 'fader_saturation')
+DEVICE1 = 'Q16'
+DEVICE2 = 'Xtouch-One'
+
+# Seconds without output before a run is considered drained
+DRAIN_IDLE = 0.5
+DRAIN_LIMIT = 10.0
+
+
+def fader_sweep_session(device1_config, device2_config, duration=2.0, rate=200, fader_ids=None):
+    # All Q16 faders (or those in fader_ids) sweep up and down together as full NRPN sequences
+    events = []
+    channel = device1_config['channel']
+    faders = sorted(item for item in device1_config['faders'].items() if fader_ids is None or item[0] in fader_ids)
+    steps = int(duration * rate)
+    for i in range(steps):
+        position = i / steps * 2
+        value = int((position if position <= 1 else 2 - position) * 16383)
+        for fader_id, fader in faders:
+            if fader['type'] != 'NRPN':
+                continue
+            offset = i / rate + fader_id * 0.0001
+            for control, data in ((99, fader['value'] >> 7), (98, fader['value'] & 0x7F),
+                                  (6, value >> 7), (38, value & 0x7F)):
+                events.append((offset, 'device1', f'control_change channel={channel} control={control} value={data}'))
+    return events
+
+
+def button_mash_session(device1_config, device2_config, presses=400, seed=1):
+    rng = random.Random(seed)
+    events = []
+    now = 0.0
+    for _ in range(presses):
+        source = rng.choice(('device1', 'device2'))
+        config = device1_config if source == 'device1' else device2_config
+        button = rng.choice(list(config['fader_buttons'].values()))
+        action = rng.choice(('toggle_on', 'toggle_off'))
+        for step in button[action]:
+            for part in step.split(' AND '):
+                events.append((now, source, part))
+                now += rng.uniform(0.002, 0.02)
+        now += rng.uniform(0.005, 0.05)
+    return events
+
+
+def dhd_gpio_burst_session(device1_config, device2_config, bursts=40, burst_size=10, seed=1):
+    import MIDI_MIrror
+
+    rng = random.Random(seed)
+    codes = list(MIDI_MIrror.gpio_to_fader_button_map)
+    events = []
+    for burst in range(bursts):
+        start = burst * 0.1
+        for i in range(burst_size):
+            events.append((start + i * 0.001, 'dhd', rng.choice(codes)))
+    return events
+
+
+def dhd_gpio_load_session(device1_config, device2_config):
+    # GPIO bursts while every Q16 fader sweeps, button output has to get past the fader backlog
+    events = fader_sweep_session(device1_config, device2_config, duration=4.0)
+    events += dhd_gpio_burst_session(device1_config, device2_config)
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def port_reconnect_session(device1_config, device2_config, down=(1.0, 2.0)):
+    # The X-Touch is unplugged for a second in the middle of a fader sweep
+    events = fader_sweep_session(device1_config, device2_config, duration=3.0)
+    events += [(down[0], 'port', 'disconnect device2'), (down[1], 'port', 'connect device2')]
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def bidirectional_sweep_session(device1_config, device2_config, duration=2.0, rate=200):
+    # Q16 faders 1-4 sweep as NRPN while X-Touch faders 5-8 sweep as CC, so
+    # both directions are busy at once; separate faders keep the echo and
+    # state tracking of one direction from swallowing the other's values
+    events = fader_sweep_session(device1_config, device2_config, duration, rate, fader_ids=(1, 2, 3, 4))
+    channel = device2_config['channel']
+    faders = sorted((fader_id, fader) for fader_id, fader in device2_config['faders'].items() if fader_id >= 5)
+    steps = int(duration * rate)
+    for i in range(steps):
+        position = i / steps * 2
+        value = int((position if position <= 1 else 2 - position) * 127)
+        for fader_id, fader in faders:
+            if fader['type'] != 'control_change':
+                continue
+            # Half a step after the Q16, like two operators out of step
+            offset = (i + 0.5) / rate + fader_id * 0.0001
+            events.append((offset, 'device2', f'control_change channel={channel} control={fader["value"]} value={value}'))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def fader_saturation_session(device1_config, device2_config, duration=12.0, rate=200, period=1.0):
+    # All eight X-Touch faders sweep up and down once per period for longer
+    # than the Q16 link keeps up with: as NRPN they need more than the 3125
+    # B/s budget, so the fader lane is saturated for the whole run and
+    # latency must not grow with it
+    events = []
+    channel = device2_config['channel']
+    faders = sorted(item for item in device2_config['faders'].items() if item[1]['type'] == 'control_change')
+    for i in range(int(duration * rate)):
+        position = (i / rate / period % 1.0) * 2
+        value = int((position if position <= 1 else 2 - position) * 127)
+        for fader_id, fader in faders:
+            events.append((i / rate + fader_id * 0.0001, 'device2', f'control_change channel={channel} control={fader["value"]} value={value}'))
+    return events
+
+
+def macro_fire_session(device1_config, device2_config, duration=4.0, interval=0.1):
+    # The X-Touch fires a MIDI macro (see SCENARIO_ACTIONS) every interval while every Q16 fader sweeps
+    events = fader_sweep_session(device1_config, device2_config, duration=duration)
+    channel = device2_config['channel']
+    for i in range(int(duration / interval)):
+        events.append((0.05 + i * interval, 'device2', f'note_on channel={channel} note=90 velocity=127'))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+# Actions bound on the X-Touch for a scenario, in the <actions> format of the device XML
+SCENARIO_ACTIONS = {
+    'macro_fire': """
+        <actions>
+            <action trigger="note_on channel=0 note=90 velocity=127">
+                <midi>note_on channel=15 note=60 velocity=127 AND note_on channel=15 note=61 velocity=127 AND note_on channel=15 note=62 velocity=127</midi>
+                <wait>0.03</wait>
+                <midi>note_off channel=15 note=60 velocity=0 AND note_off channel=15 note=61 velocity=0 AND note_off channel=15 note=62 velocity=0</midi>
+            </action>
+        </actions>""",
+}
+
+
+SESSION_BUILDERS = {
+    'fader_sweep': fader_sweep_session,
+    'button_mash': button_mash_session,
+    'dhd_gpio_burst': dhd_gpio_burst_session,
+    'dhd_gpio_load': dhd_gpio_load_session,
+    'port_reconnect': port_reconnect_session,
+    'bidirectional_sweep': bidirectional_sweep_session,
+    'macro_fire': macro_fire_session,
+    'fader_saturation': fader_saturation_session,
+}
+
+
+def load_session(path):
+    # Recorded sessions are JSON lines: {"time": 0.01, "source": "device1", "message": "..."}
+    # where message is a mido message string, a GPIO code for source "dhd", or
+    # "disconnect device2" / "connect device2" for source "port".
+    events = []
+    with open(path) as session_file:
+        for line in session_file:
+            if line.strip():
+                event = json.loads(line)
+                events.append((float(event['time']), event['source'], event['message']))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def save_session(path, events):
+    with open(path, 'w') as session_file:
+        for offset, source, message in events:
+            session_file.write(json.dumps({'time': offset, 'source': source, 'message': message}) + '\n')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class LatencyTracker:
+    # Matches output messages to the input that caused them. Every fader
+    # value is queued per target parameter with the time of its input, and an
+    # output is matched to the oldest queued value it carries. The values
+    # queued before that one were not written: they count as redundant when
+    # the device already held them, else as coalesced. Of the values still
+    # queued at the end the last one counts as dropped, unless the device
+    # holds it. An output that matches no input fails the run, except a
+    # reconnected port being resynced with the values it had.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.faders = defaultdict(deque)
+        self.events = defaultdict(deque)
+        self.selected = {}
+        self.latencies = []
+        self.outputs = 0
+        self.unmatched_outputs = 0
+        self.coalesced = 0
+        self.redundant = 0
+        self.resent = 0
+        # Parameter -> value the device holds, from what was written to it and what it sent
+        self.held = {}
+        self.last_output = time.perf_counter()
+        # Port name -> time it was plugged back in, until its first output
+        self.reconnected = {}
+        self.resynced = set()
+        self.recover_ms = []
+
+    def expect_fader(self, parameter, value, timestamp):
+        with self.lock:
+            self.faders[parameter].append((value, timestamp))
+
+    def hold(self, parameter, value):
+        with self.lock:
+            self.held[parameter] = value
+
+    def expect_event(self, key, timestamp):
+        with self.lock:
+            self.events[key].append(timestamp)
+
+    def expect_reconnect(self, port_name, timestamp):
+        with self.lock:
+            self.reconnected[port_name] = timestamp
+            self.resynced.add(port_name)
+
+    def figures(self):
+        # What a result is built from, also sent back by direction processes
+        with self.lock:
+            coalesced = self.coalesced
+            redundant = self.redundant
+            dropped = 0
+            for parameter, queue in self.faders.items():
+                if not queue:
+                    continue
+                coalesced += len(queue) - 1
+                if self.held.get(parameter) == queue[-1][0]:
+                    redundant += 1
+                else:
+                    dropped += 1
+            return {
+                'outputs': self.outputs,
+                'last_output': self.last_output,
+                'latencies': list(self.latencies),
+                'coalesced': coalesced,
+                'redundant': redundant,
+                'dropped': dropped,
+                'resent': self.resent,
+                'unmatched_outputs': self.unmatched_outputs,
+                'recover_ms': list(self.recover_ms),
+            }
+
+    def match_fader(self, port_name, parameter, value, timestamp):
+        held = self.held.get(parameter)
+        self.held[parameter] = value
+        queue = self.faders.get(parameter)
+        if queue:
+            for index, (expected, expected_at) in enumerate(queue):
+                if expected != value:
+                    continue
+                for _ in range(index):
+                    if queue.popleft()[0] == held:
+                        self.redundant += 1
+                    else:
+                        self.coalesced += 1
+                queue.popleft()
+                self.latencies.append(timestamp - expected_at)
+                return
+        if port_name in self.resynced and value == held:
+            # A resync writes the values the device had before it went away
+            self.resent += 1
+        else:
+            self.unmatched_outputs += 1
+
+    def on_output(self, port_name, data, timestamp):
+        # data is the bytes of the message, so mido and raw sends cost the same here
+        with self.lock:
+            self.outputs += 1
+            self.last_output = timestamp
+            connected = self.reconnected.pop(port_name, None)
+            if connected is not None:
+                self.recover_ms.append(round((timestamp - connected) * 1000, 3))
+            if data[0] & 0xF0 == 0xB0:
+                # NRPN values are matched at 14 bits, once CC 38 completes them
+                channel = data[0] & 0x0F
+                control = data[1]
+                selected = self.selected.setdefault((port_name, channel), [0, 0, 0])
+                if control in (99, 98, 6):
+                    selected[(99, 98, 6).index(control)] = data[2]
+                    return
+                if control == 38:
+                    self.match_fader(port_name, ('nrpn', port_name, channel, (selected[0] << 7) + selected[1]),
+                                     (selected[2] << 7) + data[2], timestamp)
+                else:
+                    self.match_fader(port_name, ('cc', port_name, channel, control), data[2], timestamp)
+                return
+
+            queue = self.events.get((port_name, tuple(data)))
+            if queue:
+                self.latencies.append(timestamp - queue.popleft())
+            else:
+                self.unmatched_outputs += 1
+
+
+class OutputPredictor:
+    # Predicts the output of each input message with the pipeline's own
+    # tables and hands it to the tracker. routes maps a source to its config
+    # and the configs it is mirrored to, relays the surfaces a device2 fader
+    # value reaches through the Q16 (see MidiRouter.build_relays).
+    def __init__(self, tracker, routes, tables, dhd_enabled, relays=()):
+        import MIDI_MIrror
+
+        self.tracker = tracker
+        self.routes = routes
+        self.dhd_enabled = dhd_enabled
+        self.step_map = tables['step_map']
+        self.button_dispatch = tables['button_dispatch']
+        self.conversions = {(source, target_config['midi_out_name']): MIDI_MIrror.build_conversions(source_config, target_config)
+                            for source, (source_config, target_configs) in routes.items() for target_config in target_configs}
+        self.parsers = {source: MIDI_MIrror.NrpnParser() for source in routes}
+        self.relays = [(config['midi_out_name'], MIDI_MIrror.build_conversions(routes['device1'][0], config)) for config in relays]
+        # Button messages go through the same pairing as in the pipeline,
+        # a held message is expected at the time it arrived
+        self.actions = {source: {trigger: action for trigger, action in source_config['actions'].items() if dhd_enabled or not action['dhd']}
+                        for source, (source_config, _) in routes.items()}
+        self.buttons = {source: MIDI_MIrror.ButtonPairer(tables['button_notes'], self.button_dispatch,
+                                                         source_config['pair_window'], source_config['button_debounce'])
+                        for source, (source_config, _) in routes.items()}
+        self.targets = {source: [config['midi_out_name'] for config in target_configs] for source, (_, target_configs) in routes.items()}
+        if relays:
+            # What a device2 button sends the Q16 is paired again as if the
+            # Q16 had sent it, without debounce, on its way to the relays
+            self.buttons['relay'] = MIDI_MIrror.ButtonPairer(tables['button_notes'], self.button_dispatch, routes['device1'][0]['pair_window'], 0)
+            self.targets['relay'] = [target for target, _ in self.relays]
+        self.held_since = {}
+
+    def expect_converted(self, target, converted, timestamp):
+        first = converted[0]
+        if first.control == 99:
+            parameter = (first.value << 7) + converted[1].value
+            value = (converted[2].value << 7) + converted[3].value
+            self.tracker.expect_fader(('nrpn', target, converted[2].channel, parameter), value, timestamp)
+        else:
+            self.tracker.expect_fader(('cc', target, first.channel, first.control), first.value, timestamp)
+
+    def expect_relayed(self, converted, timestamp):
+        # A device2 value converted for the Q16 is converted again for the other surfaces
+        first = converted[0]
+        if first.control == 99:
+            key = ('nrpn', (first.value << 7) + converted[1].value)
+            value = (converted[2].value << 7) + converted[3].value
+        else:
+            key = ('control_change', first.control)
+            value = first.value
+        for target, faders in self.relays:
+            conversion = faders.get(key)
+            if conversion is not None:
+                self.expect_converted(target, conversion.convert(value), timestamp)
+
+    def expect(self, source, message, timestamp):
+        from MIDI_MIrror import is_nrpn_control
+
+        target_configs = self.routes[source][1]
+        action = self.actions[source].get(tuple(message.bytes())) if self.actions[source] else None
+        if action is not None:
+            self.expect_action(source, action, timestamp)
+            if not action['mirror']:
+                return
+        source_port = self.routes[source][0]['midi_out_name']
+        if message.type == 'control_change' and is_nrpn_control(message.control):
+            result = self.parsers[source].feed(message.channel, message.control, message.value)
+            if result and result[0] == 'nrpn':
+                self.tracker.hold(('nrpn', source_port, message.channel, result[1]), result[2])
+        elif message.type == 'control_change':
+            self.tracker.hold(('cc', source_port, message.channel, message.control), message.value)
+        for target_config in target_configs:
+            target = target_config['midi_out_name']
+            faders = self.conversions[(source, target)]
+            if message.type == 'control_change':
+                if is_nrpn_control(message.control):
+                    if result and result[0] == 'nrpn':
+                        conversion = faders.get(('nrpn', result[1]))
+                        if conversion is not None:
+                            self.expect_converted(target, conversion.convert(result[2]), timestamp)
+                            if source == 'device2':
+                                self.expect_relayed(conversion.convert(result[2]), timestamp)
+                    continue
+                conversion = faders.get(('control_change', message.control))
+                if conversion is not None:
+                    self.expect_converted(target, conversion.convert(message.value), timestamp)
+                    if source == 'device2':
+                        self.expect_relayed(conversion.convert(message.value), timestamp)
+                continue
+        if message.type in ('note_on', 'note_off') and not self.dhd_enabled:
+            self.expect_button(source, message, timestamp)
+
+    def expect_button(self, source, message, timestamp):
+        buttons = self.buttons[source]
+        self.expect_held(source, buttons.wheel.advance(timestamp))
+        if buttons.is_button(message.note):
+            key = (message.type, message.channel, message.note, message.velocity)
+            self.expect_buttons(source, buttons.feed(key, timestamp), timestamp)
+            if buttons.button_notes[message.note] in buttons.wheel.timers:
+                self.held_since[(source, key)] = timestamp
+
+    def expect_action(self, source, action, timestamp):
+        # Macro messages are due once the waits before them are over; only
+        # the first target runs the action when the input is fanned out
+        target = self.routes[source][1][0]['midi_out_name']
+        for kind, value in action['steps']:
+            if kind == 'wait':
+                timestamp += value
+            elif kind == 'midi':
+                for message in value:
+                    self.tracker.expect_event((target, tuple(message.bytes())), timestamp)
+
+    def expect_buttons(self, source, entries, timestamp):
+        for entry in entries:
+            for target in self.targets[source]:
+                for mapped_message in entry[3]:
+                    self.tracker.expect_event((target, tuple(mapped_message.bytes())), timestamp)
+            if source == 'device2' and 'relay' in self.buttons:
+                for mapped_message in entry[3]:
+                    if mapped_message.type in ('note_on', 'note_off'):
+                        self.expect_button('relay', mapped_message, timestamp)
+
+    def expect_held(self, source, keys):
+        # Held messages whose partner did not come
+        for key in keys:
+            entry = self.button_dispatch.get(key)
+            if entry is not None:
+                self.expect_buttons(source, [entry], self.held_since.pop((source, key)))
+
+    def finish(self):
+        # Buttons held at the end of the session run out after the replay
+        for source, buttons in self.buttons.items():
+            self.expect_held(source, [buttons.wheel.cancel(button_id) for button_id in list(buttons.wheel.timers)])
+
+    def expect_gpio(self, code, timestamp):
+        import MIDI_MIrror
+
+        # GPIO output goes to device2, the DHD device of the benchmarks
+        dhd_config = self.routes['device2'][0]
+        button_id, action = MIDI_MIrror.gpio_to_fader_button_map[code]
+        for step in self.step_map[button_id][action]:
+            mapped_message = MIDI_MIrror.build_mapped_message(step['device2'])
+            self.tracker.expect_event((dhd_config['midi_out_name'], tuple(mapped_message.bytes())), timestamp)
+
+
+def load_configs(scenario=None):
+    import MIDI_MIrror
+    from xml.etree import ElementTree
+
+    device1_config = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config(f'{DEVICE1}.xml'))
+    device2_config = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config(f'{DEVICE2}.xml'))
+    if scenario in SCENARIO_ACTIONS:
+        device2_config['actions'] = MIDI_MIrror.parse_actions(ElementTree.fromstring(
+            f'<configuration>{SCENARIO_ACTIONS[scenario]}</configuration>'))
+    return device1_config, device2_config
+
+
+def load_events(scenario, session_path, device1_config, device2_config):
+    if session_path and session_path.endswith('.journal'):
+        # A journal written by MIDI_MIrror.py --journal, its inbound messages are the session
+        from midi_journal import load_journal_events
+        return load_journal_events(session_path, {device1_config['midi_in_name']: 'device1',
+                                                  device2_config['midi_in_name']: 'device2'})
+    if session_path:
+        return load_session(session_path)
+    return SESSION_BUILDERS[scenario](device1_config, device2_config)
+
+
+def parse_events(events, speed):
+    # MIDI messages a device sends at the same time (an NRPN sequence) become
+    # one event holding a tuple of messages, which is injected as a group
+    import mido
+
+    parsed = []
+    for offset, source, payload in events:
+        if source in ('dhd', 'port'):
+            parsed.append((offset / speed, source, payload))
+        elif parsed and parsed[-1][:2] == (offset / speed, source):
+            parsed[-1] = (offset / speed, source, parsed[-1][2] + (mido.Message.from_str(payload),))
+        else:
+            parsed.append((offset / speed, source, (mido.Message.from_str(payload),)))
+    return parsed
+
+
+def replay(parsed, start, handle):
+    # Calls handle(source, payload, timestamp) for every event at its offset
+    # from start, sleeping most of the wait and spinning the rest. Returns
+    # the number of inputs.
+    inputs = 0
+    for offset, source, payload in parsed:
+        target_time = start + offset
+        remaining = target_time - time.perf_counter()
+        if remaining > 0.0005:
+            time.sleep(remaining - 0.0003)
+        while time.perf_counter() < target_time:
+            pass
+        handle(source, payload, time.perf_counter())
+        inputs += len(payload) if isinstance(payload, tuple) else 1
+    return inputs
+
+
+def wait_for_drain(tracker, replay_end):
+    while True:
+        idle = time.perf_counter() - tracker.last_output
+        if idle >= DRAIN_IDLE or time.perf_counter() - replay_end > DRAIN_LIMIT:
+            break
+        time.sleep(0.05)
+
+
+def build_result(session_path, inputs, start, cpu_time, figures):
+    # figures are LatencyTracker.figures() of every process that tracked output
+    last_output = max(part['last_output'] for part in figures)
+    wall_time = last_output - start
+    outputs = sum(part['outputs'] for part in figures)
+    latencies = sorted(round(latency * 1000, 4) for part in figures for latency in part['latencies'])
+    return {
+        'session': session_path or 'synthetic',
+        'inputs': inputs,
+        'outputs': outputs,
+        'duration_s': round(wall_time, 4),
+        'inputs_per_s': round(inputs / wall_time, 1) if wall_time > 0 else None,
+        'outputs_per_s': round(outputs / wall_time, 1) if wall_time > 0 else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+            'samples': len(latencies),
+        },
+        # Spread of the latencies, what an operator feels as uneven fader motion
+        'jitter_ms': round(statistics.pstdev(latencies), 4) if latencies else None,
+        'coalesced': sum(part['coalesced'] for part in figures),
+        'redundant': sum(part['redundant'] for part in figures),
+        'dropped': sum(part['dropped'] for part in figures),
+        'resent': sum(part['resent'] for part in figures),
+        'unmatched_outputs': sum(part['unmatched_outputs'] for part in figures),
+        'cpu_us_per_input': round(cpu_time / inputs * 1e6, 2) if inputs else None,
+        'recover_ms': [value for part in figures for value in part['recover_ms']],
+    }
+
+
+def replay_direction(scenario, events, speed, ready, go, start, results, direction):
+    # setup() of a direction process with --engine processes. The simulated
+    # ports only exist in the process that opens them, so each process
+    # replays its own source's part of the session and tracks its own output
+    # from a thread that starts once both processes are ready.
+    import mido
+    import midi_sim
+    import MIDI_MIrror
+
+    device1_config, device2_config = load_configs(scenario)
+    configs = {'device1': device1_config, 'device2': device2_config}
+    source_config = configs[direction]
+    target_config = configs['device2' if direction == 'device1' else 'device1']
+    mido.set_backend('midi_sim')
+    midi_sim.add_device(source_config['midi_in_name'], is_input=True, is_output=False)
+    midi_sim.add_device(target_config['midi_out_name'], is_input=False, is_output=True)
+
+    tracker = LatencyTracker()
+    name = target_config['midi_out_name']
+    midi_sim.add_output_listener(name, lambda data, timestamp: tracker.on_output(name, data, timestamp), raw=True)
+    predictor = OutputPredictor(tracker, {direction: (source_config, [target_config])},
+                                MIDI_MIrror.compile_device_pair(device1_config, device2_config), False)
+    parsed = parse_events([event for event in events if event[1] == direction], speed)
+
+    def handle(source, messages, timestamp):
+        for message in messages:
+            predictor.expect(source, message, timestamp)
+        midi_sim.inject_group(source_config['midi_in_name'], messages)
+
+    def run():
+        # The direction opens its ports once setup() returns
+        time.sleep(0.2)
+        ready.wait()
+        go.wait()
+        cpu_start = time.process_time()
+        replay_cpu_start = time.thread_time()
+        inputs = replay(parsed, start.value, handle)
+        predictor.finish()
+        wait_for_drain(tracker, time.perf_counter())
+        cpu_time = (time.process_time() - cpu_start) - (time.thread_time() - replay_cpu_start)
+        results.put((inputs, cpu_time, tracker.figures()))
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def run_processes(scenario, events, speed, metrics_interval, journal, raw):
+    # --engine processes, returns (inputs, start, cpu time, figures) from
+    # both direction processes (see replay_direction)
+    import functools
+    import multiprocessing
+    import MIDI_MIrror
+
+    if any(source in ('dhd', 'port') for _, source, _ in events):
+        raise ValueError('--engine processes only replays MIDI input')
+    device1_config, device2_config = load_configs(scenario)
+    tables = MIDI_MIrror.compile_device_pair(device1_config, device2_config)
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Barrier(3)
+    go = context.Event()
+    start = context.Value('d', 0.0)
+    results = context.Queue()
+    setup = functools.partial(replay_direction, scenario, events, speed, ready, go, start, results)
+    processes = MIDI_MIrror.start_processes(tables, False, daemon=True, metrics_interval=metrics_interval,
+                                            journal_dir=journal, raw=raw, setup=setup)
+    ready.wait(timeout=60)
+    cpu_start = time.process_time()
+    start.value = time.perf_counter() + 0.05
+    go.set()
+    timeout = (events[-1][0] / speed if events else 0) + DRAIN_LIMIT + 10
+    parts = [results.get(timeout=timeout) for _ in processes]
+    cpu_time = time.process_time() - cpu_start + sum(cpu for _, cpu, _ in parts)
+    for process in processes:
+        process.terminate()
+        process.join()
+    return sum(inputs for inputs, _, _ in parts), start.value, cpu_time, [figures for _, _, figures in parts]
+
+
+def run_scenario(scenario, session_path=None, speed=1.0, metrics=False, engine='loop', surfaces=1, echo=False, gpio='socket', journal=None, raw=False):
+    import mido
+    import midi_sim
+    import MIDI_MIrror
+
+    device1_config, device2_config = load_configs(scenario)
+    events = load_events(scenario, session_path, device1_config, device2_config)
+    dhd_enabled = any(source == 'dhd' for _, source, _ in events)
+
+    # With metrics on, instrumentation runs but the periodic report stays out of the measurement
+    metrics_interval = 3600 if metrics else None
+    if engine == 'processes':
+        inputs, start, cpu_time, figures = run_processes(scenario, events, speed, metrics_interval, journal, raw)
+        return build_result(session_path, inputs, start, cpu_time, figures)
+
+    # Extra surfaces are copies of device2 on their own ports, the first one
+    # keeps the real port names so DHD GPIO output still finds it
+    surface_configs = [device2_config]
+    for number in range(2, surfaces + 1):
+        config = dict(device2_config)
+        config['midi_in_name'] = f"{device2_config['midi_in_name']} #{number}"
+        config['midi_out_name'] = f"{device2_config['midi_out_name']} #{number}"
+        surface_configs.append(config)
+
+    mido.set_backend('midi_sim')
+    for config in [device1_config] + surface_configs:
+        midi_sim.add_device(config['midi_in_name'], is_input=True, is_output=False)
+        midi_sim.add_device(config['midi_out_name'], is_input=False, is_output=True)
+
+    if echo:
+        for config in [device1_config] + surface_configs:
+            midi_sim.add_echo(config['midi_out_name'], config['midi_in_name'])
+
+    tracker = LatencyTracker()
+    for config in [device1_config] + surface_configs:
+        name = config['midi_out_name']
+        midi_sim.add_output_listener(name, lambda data, timestamp, name=name: tracker.on_output(name, data, timestamp), raw=True)
+
+    # DHD codes reach the pipeline through the GPIO socket, or with --gpio stdin
+    # through a pipe standing in for the C# host's stdin writes
+    dhd_write = None
+    gpio_port = None
+    if dhd_enabled:
+        read_fd, dhd_write = os.pipe()
+        sys.stdin = os.fdopen(read_fd)
+        if gpio == 'socket':
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                gpio_port = probe.getsockname()[1]
+
+    tables = MIDI_MIrror.compile_device_pair(device1_config, device2_config)
+
+    if engine == 'threads':
+        MIDI_MIrror.start_mirroring(tables, dhd_enabled, device2_config if dhd_enabled else None,
+                                    daemon=True, metrics_interval=metrics_interval, gpio_port=gpio_port, journal_dir=journal, raw=raw)
+    else:
+        devices = [DEVICE1] + [f'{DEVICE2} #{number}' if number > 1 else DEVICE2 for number in range(1, surfaces + 1)]
+        pairs = {(DEVICE1, devices[1]): tables}
+        for device, config in zip(devices[2:], surface_configs[1:]):
+            pairs[(DEVICE1, device)] = MIDI_MIrror.compile_device_pair(device1_config, config)
+        MIDI_MIrror.start_routing(devices, pairs, dhd_enabled, device2_config if dhd_enabled else None,
+                                  daemon=True, metrics_interval=metrics_interval, gpio_port=gpio_port, journal_dir=journal, raw=raw)
+    time.sleep(0.2)
+    gpio_client = None
+    if gpio_port is not None:
+        from gpio_client import GpioClient
+        gpio_client = GpioClient(gpio_port)
+
+    # The Q16 fans out to every surface, only the first surface is replayed
+    # back; its fader values reach the other surfaces through the Q16
+    routes = {
+        'device1': (device1_config, surface_configs),
+        'device2': (device2_config, [device1_config]),
+    }
+    predictor = OutputPredictor(tracker, routes, tables, dhd_enabled, surface_configs[1:] if engine != 'threads' else ())
+
+    def handle(source, payload, timestamp):
+        if source == 'dhd':
+            predictor.expect_gpio(payload, timestamp)
+            if gpio_client is not None:
+                gpio_client.send([payload])
+            else:
+                os.write(dhd_write, (payload + '\n').encode())
+        elif source == 'port':
+            # Both ports of the device drop out or come back, like a USB cable
+            action, device = payload.split()
+            config = routes[device][0]
+            for name in (config['midi_in_name'], config['midi_out_name']):
+                getattr(midi_sim, action)(name)
+            if action == 'connect':
+                tracker.expect_reconnect(config['midi_out_name'], timestamp)
+        else:
+            for message in payload:
+                predictor.expect(source, message, timestamp)
+            midi_sim.inject_group(routes[source][0]['midi_in_name'], payload)
+
+    parsed = parse_events(events, speed)
+
+    # CPU is counted for the whole process minus this replay thread, which
+    # spends its time pacing the session and predicting outputs
+    cpu_start = time.process_time()
+    replay_cpu_start = time.thread_time()
+    start = time.perf_counter()
+    inputs = replay(parsed, start, handle)
+    predictor.finish()
+    wait_for_drain(tracker, time.perf_counter())
+    cpu_time = (time.process_time() - cpu_start) - (time.thread_time() - replay_cpu_start)
+    return build_result(session_path, inputs, start, cpu_time, [tracker.figures()])
+
+
+def run_child(scenario, session_path, speed, metrics, engine, surfaces, echo, gpio, journal, raw):
+    command = [sys.executable, os.path.abspath(__file__), '--child', scenario, '--speed', str(speed),
+               '--engine', engine, '--surfaces', str(surfaces), '--gpio', gpio]
+    if session_path:
+        command += ['--session', session_path]
+    if metrics:
+        command.append('--metrics')
+    if echo:
+        command.append('--echo')
+    if journal:
+        command += ['--journal', journal]
+    if raw:
+        command.append('--raw')
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'{scenario} failed:\n{completed.stderr}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def format_latency(value):
+    return '-' if value is None else f'{value:.3f}'
+
+
+def print_results(results, previous=None):
+    for name, metrics in results['scenarios'].items():
+        latency = metrics['latency_ms']
+        print(f"{name}: {metrics['inputs']} in / {metrics['outputs']} out in {metrics['duration_s']} s")
+        print(f"  latency ms  p50 {format_latency(latency['p50'])}  p95 {format_latency(latency['p95'])}"
+              f"  p99 {format_latency(latency['p99'])}  max {format_latency(latency['max'])}"
+              f"  jitter {format_latency(metrics.get('jitter_ms'))}")
+        print(f"  {metrics['inputs_per_s']} in/s, {metrics['outputs_per_s']} out/s, "
+              f"coalesced {metrics['coalesced']}, redundant {metrics.get('redundant', 0)}, dropped {metrics['dropped']}, unmatched {metrics['unmatched_outputs']}, "
+              f"cpu {metrics['cpu_us_per_input']} us/input")
+        if metrics.get('recover_ms'):
+            print(f"  first output after reconnect ms  {'  '.join(f'{value:.1f}' for value in metrics['recover_ms'])}"
+                  f", resent {metrics.get('resent', 0)}")
+        if metrics['unmatched_outputs']:
+            print(f"  FAILED: {metrics['unmatched_outputs']} outputs matched no input")
+        if previous and name in previous['scenarios']:
+            old = previous['scenarios'][name]
+            for label, new_value, old_value in (
+                    ('p50', latency['p50'], old['latency_ms']['p50']),
+                    ('p99', latency['p99'], old['latency_ms']['p99']),
+                    ('jitter', metrics.get('jitter_ms'), old.get('jitter_ms')),
+                    ('cpu', metrics['cpu_us_per_input'], old['cpu_us_per_input'])):
+                if new_value is not None and old_value:
+                    print(f"  {label} vs {previous.get('label') or previous['created']}: {(new_value - old_value) / old_value * 100:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MIDI mirror pipeline against simulated ports.')
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--session', help='replay a recorded JSON lines session, or a .journal file, instead of a synthetic one')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed factor')
+    parser.add_argument('--label', help='label stored with the results, e.g. a release name')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    parser.add_argument('--metrics', action='store_true', help='run with the pipeline instrumentation enabled')
+    parser.add_argument('--engine', choices=('loop', 'threads', 'processes'), default='loop',
+                        help='pipeline engine to measure (default loop)')
+    parser.add_argument('--surfaces', type=int, default=1,
+                        help='number of surfaces the Q16 is mirrored to, copies of the Xtouch-One (loop engine only)')
+    parser.add_argument('--echo', action='store_true',
+                        help='simulated devices send every fader value they receive straight back')
+    parser.add_argument('--gpio', choices=('socket', 'stdin'), default='socket',
+                        help='how DHD GPIO codes are delivered (default socket)')
+    parser.add_argument('--journal', metavar='DIR', help='run with the MIDI journal enabled, writing to DIR')
+    parser.add_argument('--raw', action='store_true', help='run the raw bytes fast path instead of mido messages')
+    parser.add_argument('--save-session', help='write the synthetic session of the first scenario to this file and exit')
+    parser.add_argument('--no-save', action='store_true', help='do not write a results file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.surfaces < 1:
+        parser.error('--surfaces must be at least 1')
+    if args.surfaces > 1 and args.engine != 'loop':
+        parser.error('--surfaces needs the loop engine')
+    if args.echo and args.engine == 'processes':
+        parser.error('--echo does not reach across processes, use the loop or threads engine')
+
+    if args.child:
+        # The pipeline prints for every button, keep that out of the result
+        sys.stdout = open(os.devnull, 'w')
+        result = run_scenario(args.child, args.session, args.speed, args.metrics, args.engine, args.surfaces, args.echo, args.gpio,
+                              args.journal, args.raw)
+        sys.__stdout__.write(json.dumps(result) + '\n')
+        sys.__stdout__.flush()
+        os._exit(0)
+
+    scenarios = args.scenarios or list(PROCESS_SCENARIOS if args.engine == 'processes' else SCENARIOS)
+    for scenario in scenarios:
+        if scenario not in SESSION_BUILDERS:
+            parser.error(f'unknown scenario {scenario!r}')
+        if args.engine == 'processes' and scenario not in PROCESS_SCENARIOS and not args.session:
+            parser.error(f'{scenario} needs the loop or threads engine')
+
+    if args.save_session:
+        import MIDI_MIrror
+        device1_config = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config(f'{DEVICE1}.xml'))
+        device2_config = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config(f'{DEVICE2}.xml'))
+        save_session(args.save_session, SESSION_BUILDERS[scenarios[0]](device1_config, device2_config))
+        return
+
+    if args.session:
+        scenarios = [os.path.splitext(os.path.basename(args.session))[0]]
+
+    results = {
+        'label': args.label,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'speed': args.speed,
+        'metrics': args.metrics,
+        'engine': args.engine,
+        'surfaces': args.surfaces,
+        'echo': args.echo,
+        'gpio': args.gpio,
+        'journal': bool(args.journal),
+        'raw': args.raw,
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        results['scenarios'][scenario] = run_child(scenario, args.session, args.speed, args.metrics, args.engine, args.surfaces, args.echo, args.gpio,
+                                                   args.journal, args.raw)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    print_results(results, previous)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        name = f"{stamp}-{args.label}.json" if args.label else f"{stamp}.json"
+        path = os.path.join(RESULTS_DIR, name)
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f"Results written to {path}")
+
+    if any(metrics['unmatched_outputs'] for metrics in results['scenarios'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
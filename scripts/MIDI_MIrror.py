@@ -1,13 +1,24 @@
+import argparse
+import contextlib
+import itertools
+import math
 import sys
 import threading
-import xml.etree.ElementTree as ET
 import os
-from altair import Type
 import mido
 import time
+import hashlib
+import pickle
+import socket
+from array import array
 from collections import deque
-from queue import Queue
-from pynput.keyboard import Key, Controller
+from queue import Queue, Empty, Full
+from midi_log import log, LEVELS
+import midi_convert
+import midi_raw
+from midi_convert import build_conversions, check_fader_range, get_taper, PITCHBEND_CENTER
+from midi_raw import RAW_GROUP, open_raw_input, get_raw_send
+from midi_journal import Journal, JOURNAL_IN, JOURNAL_OUT, DEFAULT_RECORDS, get_journal_path
 
 gpio_to_fader_button_map = {
     "2A00": (1, 'toggle_off'),
@@ -22,293 +33,1236 @@ gpio_to_fader_button_map = {
     "2E01": (5, 'toggle_on')
 }
 
-keyboard = Controller()
+# pynput is only loaded once a key press actually runs, so hosts without a
+# display mirror fine as long as no keys action fires
+keyboard = None
+
+def get_keyboard():
+    global keyboard
+    if keyboard is None:
+        from pynput.keyboard import Controller
+        keyboard = Controller()
+    return keyboard
+
+def parse_keys(text):
+    # "ctrl+alt+f12" -> ('ctrl', 'alt', 'f12'), resolved when pressed
+    return tuple(part.strip().lower() for part in text.split('+') if part.strip())
+
+def press_keys(keys):
+    # Holds the keys in order and lets go in reverse, so modifiers wrap the last one
+    from pynput.keyboard import Key
+    keyboard = get_keyboard()
+    resolved = [getattr(Key, key) if len(key) > 1 else key for key in keys]
+    for key in resolved:
+        keyboard.press(key)
+    for key in reversed(resolved):
+        keyboard.release(key)
+    log.info('actions', "Triggered key press: %s", '+'.join(keys))
+
+class ActionExecutor:
+    # Runs the actions bound to trigger messages (see parse_actions) on a
+    # thread of its own, so a key press or a macro with waits never holds up
+    # mirroring. The queue is bounded: actions coming in faster than they
+    # run are dropped and logged instead of piling up. call runs a MIDI step
+    # where its writer lives (the router's loop.call_soon_threadsafe), gpio
+    # takes the DHD GPIO steps and press the keys steps.
+    def __init__(self, capacity=32, call=None, gpio=None, press=press_keys):
+        self.queue = Queue(maxsize=capacity)
+        self.call = call
+        self.gpio = gpio
+        self.press = press
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, action, emit):
+        # emit(messages, priority) is where the MIDI steps go
+        try:
+            self.queue.put_nowait((action, emit))
+        except Full:
+            log.warning('actions', "Action queue is full, dropping the action of %s", action['trigger'])
+            return False
+        return True
+
+    def run_action(self, action, emit):
+        for kind, value in action['steps']:
+            if kind == 'keys':
+                self.press(value)
+            elif kind == 'midi':
+                if self.call is None:
+                    emit(value, PRIORITY_BUTTON)
+                else:
+                    self.call(emit, value, PRIORITY_BUTTON)
+                for message in value:
+                    log.info('actions', "Sending macro message: %s", message)
+            elif kind == 'gpio':
+                if self.gpio is None:
+                    log.warning('actions', "DHD is not enabled, skipping GPIO %s", ','.join(value))
+                else:
+                    self.gpio.dispatch(list(value))
+            elif kind == 'wait':
+                time.sleep(value)
 
-#TODO: make this dynamic to work through faders 1-4, add an input for the fader number
-def trigger_key_press():
-    with keyboard.pressed(Key.ctrl):
-        with keyboard.pressed(Key.alt):
-            keyboard.press(Key.f12)
-            keyboard.release(Key.f12)
-    print("Triggered key press: Ctrl+Alt+F12")
-    
-def cc_to_nrpn(cc_number, data_value, input_channel, channel_map, cc_to_nrpn_map):
-    if not (0 <= data_value <= 127):
-        raise ValueError("data_value must be between 0 and 127")
-        
-    if cc_number in cc_to_nrpn_map:
-        nrpn_number, nrpn_output_channel = cc_to_nrpn_map[cc_number]
-        output_channel = channel_map.get(input_channel, nrpn_output_channel)
-        msb = (nrpn_number >> 7) & 0x7F
-        lsb = nrpn_number & 0x7F
-
-        return [
-            mido.Message('control_change', control=99, value=msb, channel=output_channel),
-            mido.Message('control_change', control=98, value=lsb, channel=output_channel),
-            mido.Message('control_change', control=6, value=data_value, channel=output_channel),
-            mido.Message('control_change', control=38, value=0, channel=output_channel)
-        ]
-    else:
-        pass
-    return None
+    def _run(self):
+        while True:
+            action, emit = self.queue.get()
+            try:
+                self.run_action(action, emit)
+            except Exception as e:
+                log.error('actions', "Action of %s failed: %r", action['trigger'], e)
+
+class FaderCoalescer:
+    # Latest-value-wins rate limiter for fader traffic. Each parameter key is
+    # forwarded at most once per min_interval; anything arriving inside that
+    # window replaces the pending value, which is flushed once the window ends
+    # so the settled fader position always reaches the target.
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.last_sent = {}
+        self.pending = {}
+
+    def submit(self, key, messages, now):
+        if key not in self.pending and now - self.last_sent.get(key, float('-inf')) >= self.min_interval:
+            self.last_sent[key] = now
+            return messages
+        self.pending[key] = messages
+        return None
+
+    def next_deadline(self):
+        if not self.pending:
+            return None
+        return min(self.last_sent[key] for key in self.pending) + self.min_interval
+
+    def flush_due(self, now):
+        ready = []
+        for key in list(self.pending):
+            if now - self.last_sent[key] >= self.min_interval:
+                ready.append(self.pending.pop(key))
+                self.last_sent[key] = now
+        return ready
+
+class TimerWheel:
+    # Hashed timer wheel with one timer per key. A timer goes into the slot
+    # of the tick its deadline falls in, so schedule() and cancel() are O(1)
+    # and advance() only visits the slots of the ticks that passed; a timer
+    # more than one turn out stays in its slot until its own turn comes.
+    # The earliest tick is cached for next_deadline(), which runs after
+    # every message, and only looked up again once that timer is gone.
+    def __init__(self, tick=0.002, slots=128):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.timers = {}
+        # First tick not expired yet, None while no timer is set
+        self.position = None
+        # Tick of the earliest timer, None when it has to be looked up
+        self.earliest = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline, value):
+        # Replaces the timer of key if there is one
+        self.cancel(key)
+        index = math.ceil(deadline / self.tick)
+        if self.position is None:
+            self.position = index
+            self.earliest = index
+        else:
+            # An earlier timer moves the scan back, a deadline already
+            # passed fires on the next advance()
+            if index < self.position:
+                self.position = index
+            if self.earliest is not None and index < self.earliest:
+                self.earliest = index
+        self.slots[index % len(self.slots)][key] = (index, value)
+        self.timers[key] = index
+
+    def cancel(self, key):
+        # Returns the value of the timer, None if key had none
+        index = self.timers.pop(key, None)
+        if index is None:
+            return None
+        value = self.slots[index % len(self.slots)].pop(key)[1]
+        if not self.timers:
+            self.position = None
+        if index == self.earliest:
+            self.earliest = None
+        return value
+
+    def next_deadline(self):
+        if not self.timers:
+            return None
+        if self.earliest is None:
+            # One timer per held button, so this stays short
+            self.earliest = min(self.timers.values())
+        return self.earliest * self.tick
+
+    def advance(self, now):
+        # Returns the values of the timers due by now, oldest deadline first
+        if not self.timers:
+            return []
+        current = math.floor(now / self.tick)
+        if current < self.position:
+            return []
+        slots = self.slots
+        due = []
+        # After a long gap every slot is visited once
+        for index in range(self.position, min(current, self.position + len(slots) - 1) + 1):
+            slot = slots[index % len(slots)]
+            for key, (timer_index, value) in list(slot.items()):
+                if timer_index <= current:
+                    del slot[key]
+                    del self.timers[key]
+                    due.append((timer_index, value))
+        self.position = current + 1 if self.timers else None
+        if due:
+            self.earliest = None
+        due.sort(key=lambda timer: timer[0])
+        return [value for _, value in due]
+
+class ButtonPairer:
+    # Turns the note messages of the fader buttons into dispatch entries,
+    # each press exactly once. A message that opens a note_on/note_off pair
+    # (see build_button_dispatch) is held per button until its partner
+    # arrives, giving the pair's entry, or until pair_window runs out on the
+    # wheel, giving its own entry if it has one. Everything else is
+    # dispatched right away. The same message from a button again within
+    # debounce is contact bounce and dropped.
+    def __init__(self, button_notes, button_dispatch, pair_window=0.1, debounce=0.01):
+        self.pair_window = pair_window
+        self.debounce = debounce
+        self.wheel = TimerWheel()
+        self.last_seen = {}
+        self.set_tables(button_notes, button_dispatch)
+
+    def set_tables(self, button_notes, button_dispatch):
+        self.button_notes = button_notes
+        self.button_dispatch = button_dispatch
+        self.pair_starts = frozenset(key[0] for key in button_dispatch if isinstance(key[0], tuple))
+
+    def is_button(self, note):
+        return note in self.button_notes
+
+    def feed(self, key, now):
+        # key is (type, channel, note, velocity), returns the entries to send
+        button_id = self.button_notes[key[2]]
+        if now - self.last_seen.get(key, float('-inf')) < self.debounce:
+            return []
+        self.last_seen[key] = now
+        button_dispatch = self.button_dispatch
+        ready = []
+        held = self.wheel.cancel(button_id)
+        if held is not None:
+            entry = button_dispatch.get((held, key))
+            if entry is not None:
+                return [entry]
+            # Not its partner, the held message counts on its own
+            entry = button_dispatch.get(held)
+            if entry is not None:
+                ready.append(entry)
+        if key in self.pair_starts:
+            self.wheel.schedule(button_id, now + self.pair_window, key)
+        else:
+            entry = button_dispatch.get(key)
+            if entry is not None:
+                ready.append(entry)
+        return ready
 
+    def next_deadline(self):
+        return self.wheel.next_deadline()
 
-def nrpn_to_cc(nrpn_number, data_value, input_channel, channel_map, nrpn_to_cc_map, threshold=20, min_interval=0.5, max_interval=0.7):
-    if nrpn_number in nrpn_to_cc_map:
-        cc_number, default_output_channel = nrpn_to_cc_map[nrpn_number]
-        output_channel = channel_map.get(input_channel, default_output_channel)
+    def expire(self, now):
+        # Entries of the held messages whose partner did not come in time
+        button_dispatch = self.button_dispatch
+        return [button_dispatch[key] for key in self.wheel.advance(now) if key in button_dispatch]
 
-        if not hasattr(nrpn_to_cc, 'last_values'):
-            nrpn_to_cc.last_values = {}
-        if not hasattr(nrpn_to_cc, 'last_times'):
-            nrpn_to_cc.last_times = {}
-        
-        key = (output_channel, cc_number)
-        current_time = time.time()
+    def release(self):
+        # Everything still held, as if the window ran out now
+        held = [self.wheel.cancel(button_id) for button_id in list(self.wheel.timers)]
+        return [self.button_dispatch[key] for key in held if key in self.button_dispatch]
 
-        if key not in nrpn_to_cc.last_values:
-            nrpn_to_cc.last_values[key] = data_value
-            nrpn_to_cc.last_times[key] = current_time
-            return None
+PARAMETER_CONTROLS = frozenset((6, 38, 96, 97, 98, 99, 100, 101))
 
-        last_value = nrpn_to_cc.last_values[key]
-        last_time = nrpn_to_cc.last_times[key]
+def is_nrpn_control(control):
+    return control in PARAMETER_CONTROLS
+
+
+class NrpnParser:
+    # Streaming NRPN/RPN parser with independent state per MIDI channel.
+    # A parameter stays selected after CC 99/98 (NRPN) or 101/100 (RPN), so
+    # devices that only resend the data entry CC 6/38 for the current
+    # parameter, or step it with CC 96/97, are handled as well.
+    def __init__(self):
+        self.channels = {}
+
+    def feed(self, channel, control, value):
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[channel] = {
+                'kind': None, 'msb': None, 'lsb': None,
+                'data_msb': 0, 'data_lsb': 0, 'lsb_follows': False
+            }
 
-        value_change = abs(data_value - last_value)
-        time_elapsed = current_time - last_time
+        if control == 99 or control == 101:
+            state['kind'] = 'nrpn' if control == 99 else 'rpn'
+            state['msb'] = value
+            return None
+        if control == 98 or control == 100:
+            state['kind'] = 'nrpn' if control == 98 else 'rpn'
+            state['lsb'] = value
+            return None
 
-        if (value_change >= threshold or time_elapsed >= max_interval):
-            nrpn_to_cc.last_values[key] = data_value
-            nrpn_to_cc.last_times[key] = current_time
-            scaled_data_value = data_value >> 7
-            return mido.Message('control_change', control=cc_number, value=scaled_data_value, channel=output_channel)
-        elif time_elapsed < min_interval:
+        if state['kind'] is None or state['msb'] is None or state['lsb'] is None:
+            return None
+        # 127/127 is the "null" parameter, data entry is ignored until reselected
+        if state['msb'] == 127 and state['lsb'] == 127:
             return None
-    return None
 
-#TODO: add functions to convert CC to CC and NRPN to NRPN
-def is_nrpn_control(control):
-    return control in [98, 99, 6, 38]
-
-
-def process_nrpn_messages(nrpn_cache, message):
-    if message.control == 99:
-        nrpn_cache['msb'] = message.value
-    elif message.control == 98:
-        nrpn_cache['lsb'] = message.value
-    elif message.control == 6:
-        nrpn_cache['data_msb'] = message.value
-    elif message.control == 38:
-        nrpn_cache['data_lsb'] = message.value
-
-    if 'msb' in nrpn_cache and 'lsb' in nrpn_cache and 'data_msb' in nrpn_cache and 'data_lsb' in nrpn_cache:
-        nrpn_number = (nrpn_cache['msb'] << 7) + nrpn_cache['lsb']
-        data_value = (nrpn_cache.get('data_msb', 0) << 7) + nrpn_cache.get('data_lsb', 0)
-        nrpn_cache.clear()
-        return nrpn_number, data_value
+        if control == 6:
+            state['data_msb'] = value
+            state['data_lsb'] = 0
+            # Once a channel has been seen sending CC 38, wait for it so a
+            # single move is reported once with its full 14-bit value
+            if state['lsb_follows']:
+                return None
+        elif control == 38:
+            state['data_lsb'] = value
+            state['lsb_follows'] = True
+        elif control == 96 or control == 97:
+            step = 1 if state['lsb_follows'] else 128
+            data_value = (state['data_msb'] << 7) + state['data_lsb']
+            data_value = min(16383, data_value + step) if control == 96 else max(0, data_value - step)
+            state['data_msb'] = data_value >> 7
+            state['data_lsb'] = data_value & 0x7F
+
+        parameter_number = (state['msb'] << 7) + state['lsb']
+        data_value = (state['data_msb'] << 7) + state['data_lsb']
+        return state['kind'], parameter_number, data_value
+
+
+class NrpnEncoder:
+    # Tracks which parameter is selected on each output channel and drops the
+    # CC 99/98 select messages when they would not change it.
+    def __init__(self):
+        self.selected = {}
+
+    def reset(self):
+        self.selected.clear()
+
+    def encode(self, messages):
+        encoded = []
+        for msg in messages:
+            if msg.type == 'control_change' and msg.control in (98, 99, 100, 101):
+                selected = self.selected.get(msg.channel)
+                if selected is None:
+                    selected = self.selected[msg.channel] = {}
+                if msg.control in (100, 101):
+                    selected.clear()
+                elif selected.get(msg.control) == msg.value:
+                    continue
+                else:
+                    selected[msg.control] = msg.value
+            encoded.append(msg)
+        return encoded
+
+    def encode_raw(self, data):
+        # Same for a raw group, whose select is always its first two messages
+        if len(data) < 6 or data[1] != 99 or data[4] != 98:
+            return data
+        selected = self.selected.get(data[0] & 0x0F)
+        if selected is None:
+            selected = self.selected[data[0] & 0x0F] = {}
+        same_msb = selected.get(99) == data[2]
+        same_lsb = selected.get(98) == data[5]
+        selected[99] = data[2]
+        selected[98] = data[5]
+        if same_msb and same_lsb:
+            return data[6:]
+        if same_msb:
+            return data[3:]
+        if same_lsb:
+            return data[:3] + data[6:]
+        return data
+
+class EchoSuppressor:
+    # The fader values last written to one device, per parameter. The writer
+    # of that device records every value it puts on the wire and the
+    # directions reading from the device drop an inbound value that matches
+    # within window seconds, so a motorized fader answering a mirrored move
+    # is not mirrored back. Values are compared at 7 bits, so a 14-bit
+    # value rounded on the way back still matches. Shared between threads,
+    # every access is a single dict operation.
+    def __init__(self, window):
+        self.window = window
+        self.sent = {}
+
+    def remember(self, key, value, now):
+        self.sent[key] = (value, now)
+
+    def recall(self, key):
+        return self.sent.get(key)
+
+    def record(self, messages, now):
+        first = messages[0]
+        if first.type == 'pitchwheel':
+            self.remember(('pitchwheel', first.channel), (first.pitch + PITCHBEND_CENTER) >> 7, now)
+            return
+        if first.type != 'control_change':
+            return
+        if first.control == 99 and len(messages) > 2:
+            self.remember(('nrpn', first.channel, (first.value << 7) + messages[1].value), messages[2].value, now)
+        elif not is_nrpn_control(first.control):
+            self.remember(('control_change', first.channel, first.control), first.value, now)
+
+    def record_raw(self, data, now):
+        status = data[0]
+        channel = status & 0x0F
+        if status & 0xF0 == midi_raw.PITCHWHEEL:
+            self.remember(('pitchwheel', channel), data[2], now)
+        elif data[1] == 99 and len(data) > 8:
+            self.remember(('nrpn', channel, (data[2] << 7) + data[5]), data[8], now)
+        elif not is_nrpn_control(data[1]):
+            self.remember(('control_change', channel, data[1]), data[2], now)
+
+    def is_echo(self, key, value, now):
+        sent = self.recall(key)
+        return sent is not None and sent[0] == value and now - sent[1] <= self.window
+
+ECHO_LAYOUT = (('control_change', 'h', 16 << 7), ('control_change_time', 'd', 16 << 7),
+               ('nrpn', 'h', 16 << 14), ('nrpn_time', 'd', 16 << 14),
+               ('pitchwheel', 'h', 16), ('pitchwheel_time', 'd', 16))
+
+class SharedEchoSuppressor(EchoSuppressor):
+    # EchoSuppressor for --engine processes, where the writer of a device
+    # and the direction reading from it run in different processes. The
+    # values and times are kept in a midi_shared.SharedArrays of ECHO_LAYOUT
+    # indexed by channel and parameter instead of a dict.
+    def __init__(self, window, arrays):
+        super().__init__(window)
+        self.arrays = arrays
+        self.tables = {kind: (getattr(arrays, kind), getattr(arrays, kind + '_time'))
+                       for kind in ('control_change', 'nrpn', 'pitchwheel')}
+
+    def get_index(self, key):
+        if key[0] == 'nrpn':
+            return (key[1] << 14) | key[2]
+        if key[0] == 'control_change':
+            return (key[1] << 7) | key[2]
+        return key[1]
+
+    def remember(self, key, value, now):
+        values, times = self.tables[key[0]]
+        index = self.get_index(key)
+        values[index] = value
+        times[index] = now
+
+    def recall(self, key):
+        values, times = self.tables[key[0]]
+        index = self.get_index(key)
+        return values[index], times[index]
+
+UNKNOWN_VALUE = -1
+
+DEVICE_STATE_LAYOUT = (('cc', 'h', 16 << 7), ('nrpn', 'h', 16 << 14), ('pitchbend', 'h', 16), ('notes', 'h', 16 << 7))
+
+class DeviceState:
+    # What one device currently holds: CC, NRPN and pitchbend values and the
+    # last note velocity per button, in arrays indexed by channel and
+    # parameter, UNKNOWN_VALUE until seen. The writer of the device updates
+    # it with every group it writes and skips fader groups the device
+    # already holds; the directions reading from the device update it with
+    # what the device sends. channel is the device's configured channel,
+    # where its own faders are looked up for a resync. Shared between
+    # threads, every access is a single array operation. Between processes
+    # the arrays come from a midi_shared.SharedArrays of DEVICE_STATE_LAYOUT
+    # filled with UNKNOWN_VALUE.
+    def __init__(self, channel, arrays=None):
+        self.channel = channel
+        if arrays is None:
+            self.cc = array('h', [UNKNOWN_VALUE]) * (16 << 7)
+            self.nrpn = array('h', [UNKNOWN_VALUE]) * (16 << 14)
+            self.pitchbend = array('h', [UNKNOWN_VALUE]) * 16
+            self.notes = array('h', [UNKNOWN_VALUE]) * (16 << 7)
+        else:
+            self.cc = arrays.cc
+            self.nrpn = arrays.nrpn
+            self.pitchbend = arrays.pitchbend
+            self.notes = arrays.notes
+
+    def update(self, messages):
+        # Returns False when messages is a fader value the device already holds
+        first = messages[0]
+        if first.type == 'control_change':
+            if first.control == 99 and len(messages) > 3:
+                table = self.nrpn
+                index = (first.channel << 14) | (first.value << 7) | messages[1].value
+                value = (messages[2].value << 7) | messages[3].value
+            elif is_nrpn_control(first.control):
+                return True
+            else:
+                table = self.cc
+                index = (first.channel << 7) | first.control
+                value = first.value
+        elif first.type == 'pitchwheel':
+            table = self.pitchbend
+            index = first.channel
+            value = first.pitch + PITCHBEND_CENTER
+        else:
+            notes = self.notes
+            for message in messages:
+                if message.type == 'note_on':
+                    notes[(message.channel << 7) | message.note] = message.velocity
+                elif message.type == 'note_off':
+                    notes[(message.channel << 7) | message.note] = 0
+            return True
+        if table[index] == value:
+            return False
+        table[index] = value
+        return True
+
+    def update_raw(self, data):
+        # update() for a raw group, which only ever holds one fader value
+        status = data[0]
+        channel = status & 0x0F
+        if status & 0xF0 == midi_raw.PITCHWHEEL:
+            table = self.pitchbend
+            index = channel
+            value = data[1] | (data[2] << 7)
+        elif data[1] == 99 and len(data) > 11:
+            table = self.nrpn
+            index = (channel << 14) | (data[2] << 7) | data[5]
+            value = (data[8] << 7) | data[11]
+        elif is_nrpn_control(data[1]):
+            return True
+        else:
+            table = self.cc
+            index = (channel << 7) | data[1]
+            value = data[2]
+        if table[index] == value:
+            return False
+        table[index] = value
+        return True
+
+    def get_fader(self, key):
+        # key is a conversion key, see midi_convert.get_source_key
+        kind, number = key
+        if kind == 'control_change':
+            return self.cc[(self.channel << 7) | number]
+        if kind == 'nrpn':
+            return self.nrpn[(self.channel << 14) | number]
+        return self.pitchbend[number]
+
+def get_group_key(messages):
+    # The fader parameter a group sets, None for anything else. A group
+    # queued behind a newer one for the same key is superseded.
+    first = messages[0]
+    if first.type == 'control_change':
+        if first.control == 99 and len(messages) > 3:
+            return ('nrpn', (first.channel << 14) | (first.value << 7) | messages[1].value)
+        if is_nrpn_control(first.control):
+            return None
+        return ('control_change', (first.channel << 7) | first.control)
+    if first.type == 'pitchwheel':
+        return ('pitchwheel', first.channel)
     return None
 
-def get_combined_message_str(message1, message2):
-    return f"{message1.type} channel={message1.channel} note={message1.note} velocity={message1.velocity} time=0 AND {message2.type} channel={message2.channel} note={message2.note} velocity={message2.velocity} time=0"
-
-def get_message_str(message):
-    return f"{message.type} channel={message.channel} note={message.note} velocity={message.velocity} time=0"
-
-def get_note_from_step(step_str):
-    for part in step_str.split():
-        if part.startswith('note='):
-            return int(part.split('=')[1])
+def get_raw_group_key(data):
+    # get_group_key() for a raw group, which only ever holds one fader value
+    status = data[0]
+    channel = status & 0x0F
+    if status & 0xF0 == midi_raw.PITCHWHEEL:
+        return ('pitchwheel', channel)
+    if data[1] == 99 and len(data) > 11:
+        return ('nrpn', (channel << 14) | (data[2] << 7) | data[5])
+    if is_nrpn_control(data[1]):
+        return None
+    return ('control_change', (channel << 7) | data[1])
+
+# Output lanes, lower value is sent first
+PRIORITY_BUTTON = 0
+PRIORITY_FADER = 1
+PRIORITY_BULK = 2
+
+DIN_MIDI_BYTES_PER_SECOND = 3125
+
+class PortWriter:
+    # Owns all sends to one output port. Messages are queued in groups that
+    # are written back to back (an NRPN sequence must not be split), the
+    # highest priority lane is always served first and the writer paces
+    # itself to bytes_per_second so a DIN link is never overrun. With a
+    # DeviceState, fader values the device already holds are not written;
+    # the bulk lane (a resync) is always written. A fader group still queued
+    # when a newer value for the same parameter arrives is replaced in place,
+    # so a fader lane behind the byte budget holds at most one value per
+    # parameter and sends the latest one. A queued resync group is replaced
+    # the same way, or it would overwrite newer fader values once the bulk
+    # lane gets its turn. While outport is None (the
+    # port is being reopened, see PortSupervisor) groups are dropped; a send
+    # that fails detaches the port and is reported to on_error(port, error).
+    # A group is a sequence of mido messages or a raw byte group (midi_raw),
+    # which is written to the port as bytes.
+    def __init__(self, outport, bytes_per_second=DIN_MIDI_BYTES_PER_SECOND, metrics=None, echoes=None, journal=None, state=None):
+        self.outport = outport
+        self.on_error = None
+        self.raw_outport = None
+        self.raw_send = None
+        self.bytes_per_second = bytes_per_second
+        self.metrics = metrics
+        self.echoes = echoes
+        self.journal = journal
+        self.state = state
+        self.nrpn_encoder = NrpnEncoder()
+        self.lanes = (deque(), deque(), deque())
+        self.queued_faders = {}
+        self.next_free = 0.0
+        self._start()
+
+    def _start(self):
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, messages, priority):
+        queued = self.metrics.sample() if self.metrics is not None else 0
+        with self.condition:
+            self._queue(messages, priority, queued)
+            self.condition.notify()
+
+    def _queue(self, messages, priority, queued):
+        if priority == PRIORITY_BUTTON:
+            self.lanes[priority].append((messages, queued, None))
+            return
+        key = get_raw_group_key(messages) if isinstance(messages, RAW_GROUP) else get_group_key(messages)
+        if key is not None and priority == PRIORITY_FADER:
+            group = self.queued_faders.get(key)
+            if group is not None:
+                # Latest wins, the group keeps its place in the lane
+                group[0] = messages
+                group[1] = queued
+                if self.metrics is not None:
+                    self.metrics.superseded += 1
+                return
+        group = [messages, queued, key]
+        self.lanes[priority].append(group)
+        if key is not None:
+            self.queued_faders[key] = group
+
+    def _pop(self, priority):
+        group = self.lanes[priority].popleft()
+        if group[2] is not None and self.queued_faders.get(group[2]) is group:
+            del self.queued_faders[group[2]]
+        return group
+
+    def depth(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def attach(self, outport):
+        # Swaps in a reopened port, or None to drop output until there is
+        # one. The device lost its selected NRPN, so the encoder starts over.
+        self.nrpn_encoder.reset()
+        self.outport = outport
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _next_group(self):
+        with self.condition:
+            while True:
+                pending = any(self.lanes)
+                if not pending:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+                # Wait out the byte budget before choosing, a button press
+                # queued meanwhile still goes ahead of fader data
+                delay = self.next_free - time.monotonic()
+                if delay > 0 and not self.closed:
+                    self.condition.wait(delay)
+                    continue
+                for priority, lane in enumerate(self.lanes):
+                    if lane:
+                        return self._pop(priority), priority
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            if group is None:
+                return
+            self._write(*group)
+
+    def _write(self, group, priority, start=None):
+        outport = self.outport
+        if outport is None:
+            return
+        metrics = self.metrics
+        messages, queued = group[0], group[1]
+        raw = isinstance(messages, RAW_GROUP)
+        state = self.state
+        if state is not None and not (state.update_raw(messages) if raw else state.update(messages)) and priority != PRIORITY_BULK:
+            if metrics is not None:
+                metrics.redundant += 1
+            return
+        if queued:
+            stamp = time.perf_counter_ns()
+            metrics.queue.record(stamp - queued)
+        journal = self.journal
+        size = 0
+        try:
+            if raw:
+                size = self._send_raw(outport, messages)
+                if queued:
+                    metrics.send.record(time.perf_counter_ns() - stamp)
+            else:
+                for msg in self.nrpn_encoder.encode(messages):
+                    outport.send(msg)
+                    if journal is not None:
+                        journal.record(JOURNAL_OUT, msg)
+                    size += len(msg)
+                    if queued:
+                        sent = time.perf_counter_ns()
+                        metrics.send.record(sent - stamp)
+                        stamp = sent
+        except Exception as e:
+            # Backends raise their own errors for a port that went away. The
+            # failed group may be encoded against a port attached meanwhile,
+            # whose device never got its NRPN select.
+            self.nrpn_encoder.reset()
+            if self.outport is outport:
+                self.outport = None
+            if self.on_error is not None:
+                self.on_error(outport, e)
+            else:
+                log.error('port', "Unable to write to %s, output stopped: %s", outport.name, e)
+            return
+        if metrics is not None:
+            metrics.messages_out += len(messages) // 3 if raw else len(messages)
+        if self.echoes is not None:
+            if raw:
+                self.echoes.record_raw(messages, time.monotonic())
+            else:
+                self.echoes.record(messages, time.monotonic())
+        if self.bytes_per_second:
+            if start is None:
+                start = time.monotonic()
+            self.next_free = max(self.next_free, start) + size / self.bytes_per_second
+
+    def _send_raw(self, outport, data):
+        # Writes a raw group one three byte message at a time, returns its size
+        if outport is not self.raw_outport:
+            self.raw_send = get_raw_send(outport)
+            self.raw_outport = outport
+        send = self.raw_send
+        journal = self.journal
+        data = self.nrpn_encoder.encode_raw(data)
+        for index in range(0, len(data), 3):
+            message = data[index:index + 3]
+            send(message)
+            if journal is not None:
+                journal.record_bytes(JOURNAL_OUT, message)
+        return len(data)
+
+class LoopPortWriter(PortWriter):
+    # PortWriter for the router: the same lanes and pacing, but driven by
+    # timers on the event loop instead of a thread of its own. Only call it
+    # from the loop.
+    def __init__(self, outport, loop, bytes_per_second=DIN_MIDI_BYTES_PER_SECOND, metrics=None, echoes=None, journal=None, state=None):
+        self.loop = loop
+        super().__init__(outport, bytes_per_second, metrics, echoes, journal, state)
+
+    def _start(self):
+        self.timer = None
+
+    def send(self, messages, priority):
+        queued = self.metrics.sample() if self.metrics is not None else 0
+        self._queue(messages, priority, queued)
+        if self.timer is None:
+            self._pump(None)
+
+    def attach(self, outport):
+        # May be called from any thread, the swap runs on the loop
+        self.loop.call_soon_threadsafe(PortWriter.attach, self, outport)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _pump(self, start):
+        # Loop timers fire up to a millisecond late. While a backlog drains
+        # the budget is charged from when the port became free, not from
+        # when the timer ran, so that lateness does not add up per message.
+        self.timer = None
+        while any(self.lanes):
+            delay = self.next_free - time.monotonic()
+            if delay > 0:
+                self.timer = self.loop.call_later(delay, self._pump, self.next_free)
+                return
+            for priority, lane in enumerate(self.lanes):
+                if lane:
+                    self._write(self._pop(priority), priority, start)
+                    break
+            start = self.next_free
+
+def parse_step_message(step_str):
+    parts = step_str.split()
+    fields = dict(part.split('=', 1) for part in parts[1:] if '=' in part)
+    return (parts[0], int(fields['channel']), int(fields['note']), int(fields['velocity']))
+
+def get_step_key(step_str):
+    keys = tuple(parse_step_message(part) for part in step_str.split(' AND '))
+    if len(keys) == 1:
+        return keys[0]
+    if len(keys) == 2:
+        return keys
     return None
 
-def send_mapped_message(outport, step, originating_device, message_type):
-    note = get_note_from_step(step[originating_device])
-    velocity = int(step[originating_device].split('velocity=')[1].split()[0])
-    channel = int(step[originating_device].split('channel=')[1].split()[0])
-    mapped_message = mido.Message(message_type, note=note, velocity=velocity, channel=channel)
-    print(f"Sending mapped message: {mapped_message}")
-    outport.send(mapped_message)
-
-def mirror_midi(input_device_name, output_device_name, channel_map, cc_to_nrpn_map, nrpn_to_cc_map, button_map, step_map, DHD_enabled, stdin_queue, delay=0.001):
-    message_queue = deque()
-    last_send_time = time.time()
-    nrpn_cache = {}
-    message_buffer = {}
-    buffer_timeout = 0.1
-    
-    #TODO: change function to define what buttons from config will trigger the key combination
-    def handle_special_message(message):
-        # Define the specific messages that should trigger the key combination
-        special_messages = [
-            mido.Message('note_on', channel=0, note=40, velocity=127, time=0),
-            mido.Message('note_off', channel=0, note=40, velocity=0, time=0)
-        ]
-        return message in special_messages
-    
-    def send_messages():
-        nonlocal last_send_time
-        while message_queue:
-            msg = message_queue.popleft()
-            outport.send(msg)
-        last_send_time = time.time()
-
-    with mido.open_input(input_device_name) as inport, mido.open_output(output_device_name) as outport:
-        print(f"Mirroring MIDI from {input_device_name} to {output_device_name}...")
+def build_mapped_message(step_str, message_type=None):
+    # The first message of a step, as message_type or else as its own type
+    step_type, channel, note, velocity = parse_step_message(step_str.split(' AND ')[0])
+    return mido.Message(message_type or step_type, note=note, velocity=velocity, channel=channel)
+
+def build_button_dispatch(button_map, step_map):
+    # Single messages are keyed on (type, channel, note, velocity), paired
+    # note_on/note_off toggles on a tuple of two such keys.
+    button_notes = {}
+    button_dispatch = {}
+
+    for (button_id, note1), (_, note2) in button_map.items():
+        button_notes.setdefault(note1, button_id)
+        button_notes.setdefault(note2, button_id)
+
+    for button_id, steps in step_map.items():
+        for action in ('toggle_on', 'toggle_off'):
+            origins = {}
+            for step in steps[action]:
+                for device in ('device2', 'device1'):
+                    key = get_step_key(step[device])
+                    if key is not None:
+                        origins[key] = device
+
+            for key, originating_device in origins.items():
+                if key in button_dispatch:
+                    continue
+                messages = []
+                if originating_device == 'device1':
+                    message_type = 'note_on' if isinstance(key[0], tuple) else key[0]
+                    for step in steps[action]:
+                        messages.append(build_mapped_message(step['device2'], message_type))
+                else:
+                    for step in steps[action]:
+                        messages.append(build_mapped_message(step['device1'], 'note_on'))
+                        messages.append(build_mapped_message(step['device1'], 'note_off'))
+                button_dispatch[key] = (button_id, action, originating_device, tuple(messages))
+
+    return button_notes, button_dispatch
+
+def send_dispatched_messages(emit, entry):
+    if entry is None:
+        return
+    emit(entry[3], PRIORITY_BUTTON)
+    for mapped_message in entry[3]:
+        log.info('button', "Sending mapped message: %s", mapped_message)
+
+class MirrorDirection:
+    # Conversion state for the messages of one input device towards one
+    # target format. It owns no port: results go to emit(messages, priority),
+    # which is a single writer in mirror_midi and every writer sharing the
+    # format in the router. check_special is off for the extra directions of
+    # an input the router fans out, so an action is only run once.
+    # echoes is the EchoSuppressor of the input device, state its
+    # DeviceState, conversions the compiled faders of the direction
+    # (midi_convert.build_conversions). pair_window and debounce are the
+    # button timing of the input device (see ButtonPairer), actions its
+    # trigger bindings (see parse_actions), run on executor.
+    def __init__(self, emit, conversions, button_notes, button_dispatch, DHD_enabled,
+                 fader_interval=0.02, metrics=None, live_tables=None, direction='device1', name='', on_reload=None, check_special=True,
+                 echoes=None, state=None, pair_window=0.1, debounce=0.01, actions=None, executor=None):
+        self.emit = emit
+        self.conversions = conversions
+        self.button_notes = button_notes
+        self.button_dispatch = button_dispatch
+        self.DHD_enabled = DHD_enabled
+        self.metrics = metrics
+        self.live_tables = live_tables
+        self.direction = direction
+        self.name = name
+        self.on_reload = on_reload
+        self.check_special = check_special
+        self.echoes = echoes
+        self.state = state
+        self.executor = executor
+        self.set_actions(actions)
+        self.coalescer = FaderCoalescer(fader_interval)
+        self.nrpn_parser = NrpnParser()
+        self.buttons = ButtonPairer(button_notes, button_dispatch, pair_window, debounce)
+        self.active_tables = live_tables.current if live_tables is not None else None
+
+    def apply_tables(self, tables):
+        # Runs between two messages, so a reload never applies halfway through one
+        self.active_tables = tables
+        source = tables[self.direction]
+        target = tables['device2' if self.direction == 'device1' else 'device1']
+        self.conversions = tables['conversions'][self.direction]
+        self.button_notes = tables['button_notes']
+        self.button_dispatch = tables['button_dispatch']
+        self.coalescer.min_interval = target['fader_interval']
+        self.buttons.set_tables(self.button_notes, self.button_dispatch)
+        self.buttons.pair_window = source['pair_window']
+        self.buttons.debounce = source['button_debounce']
+        self.set_actions(source['actions'])
+        if self.echoes is not None:
+            self.echoes.window = source['echo_window']
+        if self.on_reload is not None:
+            self.on_reload(target)
+        log.info('config', "Applied reloaded config to %s", self.name)
+
+    def set_actions(self, actions):
+        # Indexed on the bytes of the trigger message, actions marked dhd
+        # only count with DHD enabled. Control change triggers are also
+        # indexed by channel and control so faders only pay a set lookup.
+        if not actions or self.executor is None or not self.check_special:
+            actions = {}
+        self.actions = {trigger: action for trigger, action in actions.items() if self.DHD_enabled or not action['dhd']}
+        self.action_controls = frozenset(((trigger[0] & 0x0F) << 7) | trigger[1] for trigger in self.actions
+                                         if len(trigger) == 3 and trigger[0] & 0xF0 == midi_raw.CONTROL_CHANGE)
+
+    def run_action(self, trigger):
+        # Hands the action bound to a trigger to the executor, returns True
+        # when the trigger message is not mirrored
+        action = self.actions.get(trigger)
+        if action is None:
+            return False
+        log.info('actions', "Action triggered by %s", action['trigger'])
+        self.executor.submit(action, self.emit)
+        return not action['mirror']
+
+    def next_deadline(self):
+        deadline = self.coalescer.next_deadline()
+        if self.buttons.wheel:
+            button_deadline = self.buttons.next_deadline()
+            if deadline is None or button_deadline < deadline:
+                return button_deadline
+        return deadline
+
+    def flush(self):
+        now = time.monotonic()
+        for messages in self.coalescer.flush_due(now):
+            self.emit(messages, PRIORITY_FADER)
+        if self.buttons.wheel:
+            for entry in self.buttons.expire(now):
+                send_dispatched_messages(self.emit, entry)
+
+    def resync_messages(self):
+        # The known fader values of the input device converted for the
+        # target, one group per fader
+        state = self.state
+        if state is None:
+            return []
+        groups = []
+        for key, conversion in self.conversions.items():
+            value = state.get_fader(key)
+            if value != UNKNOWN_VALUE:
+                groups.append(conversion.convert(value))
+        return groups
+
+    def submit_fader(self, key, messages, stamp):
+        # stamp is set for a timed message, the convert stage ends here
+        metrics = self.metrics
+        if stamp:
+            metrics.convert.record(time.perf_counter_ns() - stamp)
+        ready = self.coalescer.submit(key, messages, time.monotonic())
+        if ready:
+            self.emit(ready, PRIORITY_FADER)
+        elif metrics is not None:
+            metrics.throttled += 1
+
+    def prepare(self, received):
+        # Start of handle() and handle_raw(): picks up a reloaded config and
+        # lets due fader values out. received is the sampled receipt
+        # timestamp, only those messages are timed; the returned stamp ends
+        # the input stage, which covers the inbox wait.
+        live_tables = self.live_tables
+        if live_tables is not None and live_tables.current is not self.active_tables:
+            self.apply_tables(live_tables.current)
+        self.flush()
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.messages_in += 1
+        if received:
+            stamp = time.perf_counter_ns()
+            metrics.input.record(stamp - received)
+            return stamp
+        return 0
+
+    def handle_nrpn(self, channel, number, value, stamp, raw=False):
+        metrics = self.metrics
+        if self.state is not None:
+            self.state.nrpn[(channel << 14) | number] = value
+        if self.echoes is not None and self.echoes.is_echo(('nrpn', channel, number), value >> 7, time.monotonic()):
+            if metrics is not None:
+                metrics.echoes += 1
+            return
+        conversion = self.conversions.get(('nrpn', number))
+        if conversion is not None:
+            self.submit_fader(('nrpn', channel, number), conversion.convert_raw(value) if raw else conversion.convert(value), stamp)
+        elif metrics is not None:
+            metrics.unknown += 1
+
+    def handle_control(self, channel, control, value, stamp, raw=False):
+        metrics = self.metrics
+        if self.action_controls and ((channel << 7) | control) in self.action_controls and \
+           self.run_action((midi_raw.CONTROL_CHANGE | channel, control, value)):
+            return
+        if self.state is not None:
+            self.state.cc[(channel << 7) | control] = value
+        if self.echoes is not None and self.echoes.is_echo(('control_change', channel, control), value, time.monotonic()):
+            if metrics is not None:
+                metrics.echoes += 1
+            return
+        conversion = self.conversions.get(('control_change', control))
+        if conversion is not None:
+            self.submit_fader(('control_change', channel, control), conversion.convert_raw(value) if raw else conversion.convert(value), stamp)
+        elif metrics is not None:
+            metrics.unknown += 1
+
+    def handle_pitchwheel(self, channel, value, stamp, raw=False):
+        # value is the unsigned 14-bit pitch
+        metrics = self.metrics
+        if self.state is not None:
+            self.state.pitchbend[channel] = value
+        conversion = self.conversions.get(('pitchwheel', channel))
+        if conversion is None:
+            if metrics is not None:
+                metrics.unknown += 1
+            return
+        if self.echoes is not None and self.echoes.is_echo(('pitchwheel', channel), value >> 7, time.monotonic()):
+            if metrics is not None:
+                metrics.echoes += 1
+            return
+        self.submit_fader(('pitchwheel', channel), conversion.convert_raw(value) if raw else conversion.convert(value), stamp)
+
+    def handle_raw(self, data, received=0):
+        # Fast path for the bytes of one message as the backend received
+        # them. Control changes and pitchbend are matched on their status and
+        # data bytes and converted into raw groups; anything else is parsed
+        # into a mido message for handle().
+        status = data[0]
+        kind = status & 0xF0
+        if kind != midi_raw.CONTROL_CHANGE and kind != midi_raw.PITCHWHEEL:
+            try:
+                message = mido.Message.from_bytes(data)
+            except ValueError:
+                log.warning('midi', "Ignoring malformed MIDI data from %s: %s", self.name, bytes(data).hex(' '))
+                return
+            self.handle(message, received)
+            return
+        stamp = self.prepare(received)
+        channel = status & 0x0F
+        if kind == midi_raw.PITCHWHEEL:
+            self.handle_pitchwheel(channel, data[1] | (data[2] << 7), stamp, True)
+            return
+        control = data[1]
+        if control in PARAMETER_CONTROLS:
+            result = self.nrpn_parser.feed(channel, control, data[2])
+            if received:
+                done = time.perf_counter_ns()
+                self.metrics.nrpn.record(done - stamp)
+                stamp = done
+            if result and result[0] == 'nrpn':
+                self.handle_nrpn(channel, result[1], result[2], stamp, True)
+            return
+        self.handle_control(channel, control, data[2], stamp, True)
+
+    def handle(self, message, received=0):
+        stamp = self.prepare(received)
+        metrics = self.metrics
+        if message.type == 'control_change':
+            if is_nrpn_control(message.control):
+                result = self.nrpn_parser.feed(message.channel, message.control, message.value)
+                if received:
+                    done = time.perf_counter_ns()
+                    metrics.nrpn.record(done - stamp)
+                    stamp = done
+                if result and result[0] == 'nrpn':
+                    self.handle_nrpn(message.channel, result[1], result[2], stamp)
+                return
+            self.handle_control(message.channel, message.control, message.value, stamp)
+            return
+        if message.type == 'pitchwheel':
+            self.handle_pitchwheel(message.channel, message.pitch + PITCHBEND_CENTER, stamp)
+            return
+
+        if self.actions and self.run_action(tuple(message.bytes())):
+            return
+
+        if not self.DHD_enabled and message.type in ('note_on', 'note_off') and self.buttons.is_button(message.note):
+            key = (message.type, message.channel, message.note, message.velocity)
+            for entry in self.buttons.feed(key, time.monotonic()):
+                send_dispatched_messages(self.emit, entry)
+            if received:
+                metrics.button.record(time.perf_counter_ns() - stamp)
+            return
+
+        if metrics is not None:
+            metrics.unknown += 1
+
+def send_resync(writer, mirrors, name):
+    # Pushes the known fader values of every input mirrored to one device
+    # in a single burst on the bulk lane, paced like any other output. A
+    # device that needs one has usually rebooted and has no NRPN selected,
+    # so the encoder starts over and the first group selects its NRPN in full.
+    groups = [messages for mirror in mirrors for messages in mirror.resync_messages()]
+    writer.nrpn_encoder.reset()
+    for messages in groups:
+        writer.send(messages, PRIORITY_BULK)
+    log.info('resync', "Resyncing %s with %d fader values", name, len(groups))
+    return len(groups)
+
+def journal_input(journal, callback, raw=False):
+    # Records each message on the backend thread before handing it on, so
+    # the journal shows when it arrived rather than when it was handled
+    record_message = journal.record_bytes if raw else journal.record
+    def record(message):
+        record_message(JOURNAL_IN, message)
+        callback(message)
+    return record
+
+class MirrorContext:
+    # What one direction of mirror_midi runs with. Its settings are those of
+    # the input device (direction) and of the target device in live_tables.
+    # echoes and states hold the EchoSuppressor and DeviceState of each
+    # device by role, shared with the direction the other way. gpio is the
+    # GpioDispatcher of a direction writing to the DHD device, resyncers
+    # gets the resync of the output port. All services are optional,
+    # mirror_midi starts its own supervisor and, for actions, executor.
+    def __init__(self, live_tables, direction='device1', DHD_enabled=False, gpio=None, metrics=None, journal=None,
+                 echoes=None, states=None, resyncers=None, supervisor=None, executor=None, raw=False):
+        self.live_tables = live_tables
+        self.direction = direction
+        self.target = 'device2' if direction == 'device1' else 'device1'
+        self.DHD_enabled = DHD_enabled
+        self.gpio = gpio
+        self.metrics = metrics
+        self.journal = journal
+        self.echoes = echoes or {}
+        self.states = states or {}
+        self.resyncers = resyncers
+        self.supervisor = supervisor
+        self.executor = executor
+        self.raw = raw
+
+def mirror_midi(context, inbox=None, input_mode='callback', delay=0.001):
+    tables = context.live_tables.current
+    source = tables[context.direction]
+    target = tables[context.target]
+    input_device_name = source['midi_in_name']
+    output_device_name = target['midi_out_name']
+    metrics = context.metrics
+    journal = context.journal
+    gpio = context.gpio
+    if inbox is None:
+        inbox = Queue()
+    executor = context.executor
+    if executor is None and source['actions']:
+        executor = ActionExecutor(gpio=gpio).start()
+    supervisor = context.supervisor
+    if supervisor is None:
+        supervisor = PortSupervisor()
+        supervisor.start()
+
+    # In callback mode the backend pushes messages into the inbox from its own
+    # thread and this loop sleeps until a message arrives.
+    # 'poll' keeps the old iter_pending/sleep loop for backends without callbacks.
+    # raw hands the inbox the bytes of each message instead (see midi_raw),
+    # poll mode always reads mido messages.
+    raw = context.raw and input_mode == 'callback'
+    callback = None
+    if input_mode == 'callback':
+        if metrics is None:
+            callback = inbox.put
+        else:
+            callback = lambda message: inbox.put((message, metrics.sample()))
+        if journal is not None:
+            callback = journal_input(journal, callback, raw)
+
+    # The ports are opened by the supervisor, which reopens them if the
+    # device goes away while this direction keeps running
+    writer = PortWriter(None, target['bytes_per_second'], metrics, context.echoes.get(context.target), journal,
+                        context.states.get(context.target))
+    mirror = MirrorDirection(writer.send, tables['conversions'][context.direction], tables['button_notes'], tables['button_dispatch'],
+                             context.DHD_enabled, fader_interval=target['fader_interval'], metrics=metrics,
+                             live_tables=context.live_tables, direction=context.direction,
+                             name=f"{input_device_name} -> {output_device_name}",
+                             on_reload=lambda target: setattr(writer, 'bytes_per_second', target['bytes_per_second']),
+                             echoes=context.echoes.get(context.direction), state=context.states.get(context.direction),
+                             pair_window=source['pair_window'], debounce=source['button_debounce'],
+                             actions=source['actions'], executor=executor)
+    handle_message = mirror.handle_raw if raw else mirror.handle
+    restore = lambda: send_resync(writer, (mirror,), output_device_name)
+    if context.resyncers is not None:
+        context.resyncers[output_device_name] = restore
+    if gpio is not None:
+        # DHD GPIO output goes straight to this writer from the thread that received it
+        gpio.send = writer.send
+    if metrics is not None:
+        metrics.gauges['queue_depth'] = writer.depth
+        metrics.gauges['pending_faders'] = lambda: len(mirror.coalescer.pending)
+    supervisor.add_output(output_device_name, writer, restore, metrics)
+    inport = supervisor.add_input(input_device_name, callback, metrics, raw)
+    log.info('startup', "Mirroring MIDI from %s to %s...", input_device_name, output_device_name)
+    if input_mode == 'callback':
         while True:
-            #TODO: remove the hardcoded port name
-            while DHD_enabled and not stdin_queue.empty() and str(outport) == """<open output 'X-TOUCH COMPACT 2' (RtMidi/WINDOWS_MM)>""":
-                step, originating_device = stdin_queue.get()
-                send_gpio_mapped_message(outport, step, originating_device)
-
-            for message in inport.iter_pending():
-                now = time.time()
-                if now - last_send_time > delay:
-                    send_messages()
-                if handle_special_message(message) and DHD_enabled:
-                        print(f"Special MIDI message received: {message}. Sending key combination Ctrl+Alt+F12")
-                        trigger_key_press()
-                        continue  # Skip further processing for this message
-                if message.type == 'control_change':
-                    if is_nrpn_control(message.control):
-                        result = process_nrpn_messages(nrpn_cache, message)
-                        if result:
-                            nrpn_number, data_value = result
-                            transformed_message = nrpn_to_cc(nrpn_number, data_value, message.channel, channel_map, nrpn_to_cc_map)
-                            if transformed_message:
-                                message_queue.append(transformed_message)
-                        continue
-                    transformed_message = cc_to_nrpn(message.control, message.value, message.channel, channel_map, cc_to_nrpn_map)
-                    if transformed_message:
-                        for msg in transformed_message:
-                            message_queue.append(msg)
-                        continue
-
-                if not DHD_enabled:
-                    if message.type in ['note_on', 'note_off']:
-                        all_notes = {note for pair in button_map.keys() | button_map.values() for note in pair}
-                        if message.note in all_notes:
-                            button_id = None
-                            for key, value in button_map.items():
-                                if message.note in key or message.note in value:
-                                    button_id = key[0]
-                                    break
-
-                            if button_id is not None:
-                                steps = step_map[button_id]
-                                
-                                #TODO: simplify this logic
-                                if button_id in message_buffer and now - message_buffer[button_id]['timestamp'] <= buffer_timeout:
-                                    buffered_message = message_buffer[button_id]['message']
-                                    if (buffered_message.channel == message.channel and buffered_message.note == message.note):
-                                        combined_message_str = get_combined_message_str(buffered_message, message)
-                                        message_buffer.pop(button_id)
-
-                                        action = None
-                                        for step in steps['toggle_on']:
-                                            if combined_message_str == step['device1'] or combined_message_str == step['device2']:
-                                                action = 'toggle_on'
-                                                break
-
-                                        if action is None:
-                                            for step in steps['toggle_off']:
-                                                if combined_message_str == step['device1'] or combined_message_str == step['device2']:
-                                                    action = 'toggle_off'
-                                                    break
-
-                                        if action is not None:
-                                            originating_device = None
-                                            for step in steps[action]:
-                                                if combined_message_str == step['device1']:
-                                                    originating_device = 'device1'
-                                                elif combined_message_str == step['device2']:
-                                                    originating_device = 'device2'
-
-                                            if originating_device == 'device1':
-                                                for step in steps[action]:
-                                                    send_mapped_message(outport, step, 'device2', 'note_on')
-                                            else:
-                                                for step in steps[action]:
-                                                    send_mapped_message(outport, step, 'device1', 'note_on')
-                                                    send_mapped_message(outport, step, 'device1', 'note_off')
-                                    else:
-                                        single_message_str = get_message_str(buffered_message)
-                                        action = None
-                                        for step in steps['toggle_on']:
-                                            if single_message_str == step['device1'] or single_message_str == step['device2']:
-                                                action = 'toggle_on'
-                                                break
-
-                                        if action is None:
-                                            for step in steps['toggle_off']:
-                                                if single_message_str == step['device1'] or single_message_str == step['device2']:
-                                                    action = 'toggle_off'
-                                                    break
-
-                                        if action is not None:
-                                            originating_device = None
-                                            for step in steps[action]:
-                                                if single_message_str == step['device1']:
-                                                    originating_device = 'device1'
-                                                elif single_message_str == step['device2']:
-                                                    originating_device = 'device2'
-
-                                            if originating_device == 'device1':
-                                                for step in steps[action]:
-                                                    send_mapped_message(outport, step, 'device2', message.type)
-                                            else:
-                                                for step in steps[action]:
-                                                    send_mapped_message(outport, step, 'device1', 'note_on')
-                                                    send_mapped_message(outport, step, 'device1', 'note_off')
-
-                                        message_buffer[button_id] = {'message': message, 'timestamp': now}
-                                else:
-                                    message_buffer[button_id] = {'message': message, 'timestamp': now}
-
-                                single_message_str = get_message_str(message)
-                                action = None
-                                for step in steps['toggle_on']:
-                                    if single_message_str == step['device1'] or single_message_str == step['device2']:
-                                        action = 'toggle_on'
-                                        break
-
-                                if action is None:
-                                    for step in steps['toggle_off']:
-                                        if single_message_str == step['device1'] or single_message_str == step['device2']:
-                                            action = 'toggle_off'
-                                            break
-
-                                if action is not None:
-                                    originating_device = None
-                                    for step in steps[action]:
-                                        if single_message_str == step['device1']:
-                                            originating_device = 'device1'
-                                        elif single_message_str == step['device2']:
-                                            originating_device = 'device2'
-
-                                    if originating_device == 'device1':
-                                        for step in steps[action]:
-                                            send_mapped_message(outport, step, 'device2', message.type)
-                                    else:
-                                        for step in steps[action]:
-                                            send_mapped_message(outport, step, 'device1', 'note_on')
-                                            send_mapped_message(outport, step, 'device1', 'note_off')
-
+            # Only wake on a timer while a coalesced fader value is waiting
+            deadline = mirror.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                message = inbox.get(timeout=timeout)
+            except Empty:
+                mirror.flush()
+                continue
+            if metrics is None:
+                handle_message(message)
+            else:
+                handle_message(*message)
+    else:
+        while True:
+            port = inport.port
+            if port is not None:
+                try:
+                    for message in port.iter_pending():
+                        if journal is not None:
+                            journal.record(JOURNAL_IN, message)
+                        handle_message(message, metrics.sample() if metrics is not None else 0)
+                except OSError:
+                    # Closed by the supervisor under us, the next loop reads the new port
+                    pass
+            mirror.flush()
             time.sleep(delay)
 
-    send_messages()
+def get_config_path(file_name):
+    return os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'configs', file_name))
 
 def read_xml_config(file_name):
-    configs_path = os.path.join(os.path.dirname(__file__), '..', 'configs', file_name)
-    full_path = os.path.normpath(configs_path)
+    import xml.etree.ElementTree as ET
+
+    full_path = get_config_path(file_name)
     
     try:
         tree = ET.parse(full_path)
         root = tree.getroot()
-        print(f"Read XML config from {full_path}")
+        log.info('config', "Read XML config from %s", full_path)
         return root
     except ET.ParseError as e:
-        print(f"Error parsing XML file {full_path}: {e}")
+        log.error('config', "Error parsing XML file %s: %s", full_path, e)
     except FileNotFoundError:
-        print(f"XML file not found: {full_path}")
+        log.error('config', "XML file not found: %s", full_path)
     return None
 
 def parse_config(xml_root):
@@ -316,16 +1270,56 @@ def parse_config(xml_root):
         'midi_in_name': xml_root.find('./midi/midi_in_name').text,
         'midi_out_name': xml_root.find('./midi/midi_out_name').text,
         'channel': int(xml_root.find('./midi/channel').text),
+        'fader_interval': 0.02,
+        'bytes_per_second': DIN_MIDI_BYTES_PER_SECOND,
+        'echo_window': 0.25,
+        'pair_window': 0.1,
+        'button_debounce': 0.01,
         'faders': {},
         'fader_buttons': {}
     }
     
+    # Minimum time between two updates of the same fader sent to this device
+    fader_interval = xml_root.find('./midi/fader_interval')
+    if fader_interval is not None:
+        config['fader_interval'] = float(fader_interval.text)
+
+    # Output byte budget, 0 disables pacing for fast USB-only devices
+    bytes_per_second = xml_root.find('./midi/bytes_per_second')
+    if bytes_per_second is not None:
+        config['bytes_per_second'] = int(bytes_per_second.text)
+
+    # How long a value written to this device is treated as an echo when
+    # the device sends it back, 0 disables echo suppression
+    echo_window = xml_root.find('./midi/echo_window')
+    if echo_window is not None:
+        config['echo_window'] = float(echo_window.text)
+
+    # How long a button message waits for the second half of a note_on/
+    # note_off pair, and how soon a repeat of the same message is bounce
+    pair_window = xml_root.find('./midi/pair_window')
+    if pair_window is not None:
+        config['pair_window'] = float(pair_window.text)
+    button_debounce = xml_root.find('./midi/button_debounce')
+    if button_debounce is not None:
+        config['button_debounce'] = float(button_debounce.text)
+
     for fader in xml_root.findall('./faders/fader'):
         fader_id = int(fader.get('id'))
         fader_config = {
             'type': fader.get('type'),
             'value': int(fader.get('value')),
         }
+        # Optional value mapping, as an attribute or a child element (see midi_convert)
+        for option, parse in (('min_value', int), ('max_value', int), ('taper', get_taper),
+                              ('invert', lambda setting: setting.lower() == 'true')):
+            setting = fader.get(option, fader.findtext(option))
+            if setting is not None:
+                fader_config[option] = parse(setting.strip())
+        try:
+            check_fader_range(fader_config)
+        except ValueError as e:
+            raise ValueError(f"fader {fader_id}: {e}") from None
         config['faders'][fader_id] = fader_config
 
     for button in xml_root.findall('./fader_buttons/fader_button'):
@@ -350,23 +1344,47 @@ def parse_config(xml_root):
 
         config['fader_buttons'][button_id] = button_config
 
+    config['actions'] = parse_actions(xml_root)
     return config
 
-def build_mappings(device1_config, device2_config):
-    cc_to_nrpn_map = {}
-    nrpn_to_cc_map = {}
-
-    for fader_id, fader in device1_config['faders'].items():
-        if fader['type'] == 'NRPN':
-            if fader_id in device2_config['faders'] and device2_config['faders'][fader_id]['type'] == 'control_change':
-                nrpn_to_cc_map[fader['value']] = (device2_config['faders'][fader_id]['value'], device2_config['channel'])
-
-    for fader_id, fader in device2_config['faders'].items():
-        if fader['type'] == 'control_change':
-            if fader_id in device1_config['faders'] and device1_config['faders'][fader_id]['type'] == 'NRPN':
-                cc_to_nrpn_map[fader['value']] = (device1_config['faders'][fader_id]['value'], device1_config['channel'])
-
-    return nrpn_to_cc_map, cc_to_nrpn_map
+def parse_actions(xml_root):
+    # <action trigger="note_on channel=0 note=40 velocity=127"> with <keys>,
+    # <gpio>, <midi> and <wait> steps, run in order by the ActionExecutor.
+    # Returns {trigger message bytes: action}. dhd="true" only binds the
+    # trigger with DHD enabled, mirror="true" mirrors it as well. An action
+    # with a bad trigger or step is logged and left out, the others still load.
+    actions = {}
+    for element in xml_root.findall('./actions/action'):
+        trigger = (element.get('trigger') or '').strip()
+        if not trigger:
+            log.warning('config', "Ignoring an action without a trigger")
+            continue
+        steps = []
+        try:
+            key = tuple(mido.Message.from_str(trigger).bytes())
+            for step in element:
+                text = (step.text or '').strip()
+                if step.tag == 'keys':
+                    steps.append(('keys', parse_keys(text)))
+                elif step.tag == 'gpio':
+                    steps.append(('gpio', tuple(code.strip().upper() for code in text.split(',') if code.strip())))
+                elif step.tag == 'midi':
+                    steps.append(('midi', tuple(mido.Message.from_str(part.strip()) for part in text.split(' AND '))))
+                elif step.tag == 'wait':
+                    steps.append(('wait', float(text)))
+                else:
+                    log.warning('config', "Ignoring unknown action step <%s> for %s", step.tag, trigger)
+        except (ValueError, LookupError) as e:
+            # mido raises IndexError or KeyError for some malformed messages
+            log.warning('config', "Ignoring the action of %s: %s", trigger, e)
+            continue
+        actions[key] = {
+            'trigger': trigger,
+            'steps': tuple(steps),
+            'dhd': element.get('dhd', 'false').lower() == 'true',
+            'mirror': element.get('mirror', 'false').lower() == 'true',
+        }
+    return actions
 
 def build_toggle_mappings(device1_config, device2_config):
     fader_button_map = {}
@@ -398,15 +1416,350 @@ def build_toggle_mappings(device1_config, device2_config):
 
     return fader_button_map, steps_button_map
 
-def get_conversion_function(config1, config2):
-    if all(fader['type'] == 'NRPN' for fader in config1['faders'].values()) and \
-       all(fader['type'] == 'NRPN' for fader in config2['faders'].values()):
-        return nrpn_to_cc, nrpn_to_cc
-    elif all(fader['type'] == 'control_change' for fader in config1['faders'].values()) and \
-         all(fader['type'] == 'control_change' for fader in config2['faders'].values()):
-        return cc_to_nrpn, cc_to_nrpn
-    else:
-        return cc_to_nrpn, nrpn_to_cc
+def compile_device_pair(device1_config, device2_config):
+    button_map, step_map = build_toggle_mappings(device1_config, device2_config)
+    button_notes, button_dispatch = build_button_dispatch(button_map, step_map)
+    return {
+        'device1': device1_config,
+        'device2': device2_config,
+        'conversions': {
+            'device1': build_conversions(device1_config, device2_config),
+            'device2': build_conversions(device2_config, device1_config)
+        },
+        'step_map': step_map,
+        'button_notes': button_notes,
+        'button_dispatch': button_dispatch
+    }
+
+# Bump when the layout of the compiled tables changes
+CONFIG_CACHE_VERSION = 3
+CONFIG_CACHE_DIR = get_config_path('.cache')
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    with open(path, 'rb') as source:
+        digest = hashlib.sha256(source.read()).hexdigest()
+    return stat.st_mtime_ns, stat.st_size, digest
+
+def is_source_unchanged(path, signature):
+    # A matching mtime and size is trusted as is, otherwise the content hash
+    # decides, so a touched but unchanged file does not force a rebuild
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if (stat.st_mtime_ns, stat.st_size) == signature[:2]:
+        return True
+    return get_file_signature(path)[2] == signature[2]
+
+def load_device_pair(device1, device2):
+    # The compiled tables depend on both XML files and on the code compiling them
+    sources = [get_config_path(f"{device1}.xml"), get_config_path(f"{device2}.xml"), os.path.abspath(__file__),
+               os.path.abspath(midi_convert.__file__), os.path.abspath(midi_raw.__file__)]
+    cache_path = os.path.join(CONFIG_CACHE_DIR, f"{device1}__{device2}.pickle")
+
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached['version'] == CONFIG_CACHE_VERSION and cached['sources'].keys() == set(sources) and \
+           all(is_source_unchanged(path, signature) for path, signature in cached['sources'].items()):
+            log.info('config', "Loaded compiled config from %s", cache_path)
+            return cached['tables']
+    except (OSError, EOFError, KeyError, TypeError, AttributeError, pickle.UnpicklingError):
+        pass
+
+    configs = []
+    for device in (device1, device2):
+        xml_root = read_xml_config(f"{device}.xml")
+        if xml_root is None:
+            return None
+        # A setting out of range is reported with its file, the caller
+        # keeps the running config or stops at startup
+        try:
+            configs.append(parse_config(xml_root))
+        except ValueError as e:
+            raise ValueError(f"{device}.xml: {e}") from None
+    tables = compile_device_pair(*configs)
+
+    try:
+        os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+        cached = {
+            'version': CONFIG_CACHE_VERSION,
+            'sources': {path: get_file_signature(path) for path in sources},
+            'tables': tables
+        }
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump(cached, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        log.warning('config', "Could not write config cache %s: %s", cache_path, e)
+    return tables
+
+class LiveTables:
+    # The compiled tables of the running device pair. A reload publishes a
+    # new dict with a single assignment to current, so readers see either
+    # the old or the new tables, never a mix.
+    def __init__(self, tables):
+        self.current = tables
+
+def validate_reload(current, tables):
+    # Ports and channels stay as they were opened: the DeviceState of a
+    # device looks up its own faders on the channel it was created with
+    for device in ('device1', 'device2'):
+        for port in ('midi_in_name', 'midi_out_name'):
+            if tables[device][port] != current[device][port]:
+                return f"{device} {port} changed from '{current[device][port]}' to '{tables[device][port]}', restart to switch ports"
+        if tables[device]['channel'] != current[device]['channel']:
+            return f"{device} channel changed from {current[device]['channel']} to {tables[device]['channel']}, restart to switch channels"
+    return None
+
+def reload_device_pair(device1, device2, live_tables):
+    try:
+        tables = load_device_pair(device1, device2)
+    except Exception as e:
+        log.error('config', "Config reload failed, keeping the current config: %s", e)
+        return False
+    if tables is None:
+        log.error('config', "Config reload failed, keeping the current config: unable to read configuration files")
+        return False
+    if tables == live_tables.current:
+        return False
+    error = validate_reload(live_tables.current, tables)
+    if error:
+        log.error('config', "Config reload rejected: %s", error)
+        return False
+    live_tables.current = tables
+    log.info('config', "Reloaded config for %s and %s", device1, device2)
+    return True
+
+class ConfigWatcher:
+    # Polls the XML files of the running devices and calls reload() in the
+    # background. A change is only picked up once the files have been stable
+    # for one interval, so a half-written file is not loaded.
+    def __init__(self, devices, reload, interval=1.0):
+        self.reload = reload
+        self.interval = interval
+        self.paths = [get_config_path(f"{device}.xml") for device in devices]
+        self.applied = self.snapshot()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def snapshot(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def _run(self):
+        previous = self.applied
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            if current != self.applied and current == previous:
+                self.applied = current
+                self.reload()
+            previous = current
+
+class SupervisedPort:
+    # One port kept open by a PortSupervisor. An input is opened with
+    # callback, or without one for a direction that polls .port; an output is
+    # attached to writer and restore() brings the device up to date after it
+    # was reopened. A raw input hands callback the bytes of each message.
+    def __init__(self, name, is_input, callback=None, writer=None, restore=None, metrics=None, raw=False):
+        self.name = name
+        self.is_input = is_input
+        self.callback = callback
+        self.raw = raw
+        self.writer = writer
+        self.restore = restore
+        self.metrics = metrics
+        self.port = None
+        # Monotonic time the port went away, None until it was open once
+        self.lost = None
+        self.failure = None
+        self.backoff = 0.0
+        self.retry_at = 0.0
+
+    def open(self):
+        if self.is_input and self.raw:
+            return open_raw_input(self.name, self.callback)
+        if self.is_input:
+            return mido.open_input(self.name, callback=self.callback)
+        return mido.open_output(self.name)
+
+class PortSupervisor:
+    # Keeps the MIDI ports open while mirroring. A port whose writer failed to
+    # send, or that left the backend's port list (USB glitch, surface reboot),
+    # is closed and reopened with exponential backoff; every other port keeps
+    # running meanwhile. A port missing at startup is waited for the same
+    # way. Once an output is back, the last known values mirrored to the
+    # device are sent again and the time it was gone is logged and reported
+    # as the recover_ms gauge of its metrics.
+    def __init__(self, interval=0.5, min_backoff=0.05, max_backoff=0.5):
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ports = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add_input(self, name, callback=None, metrics=None, raw=False):
+        return self.add(SupervisedPort(name, True, callback=callback, metrics=metrics, raw=raw))
+
+    def add_output(self, name, writer, restore=None, metrics=None):
+        supervised = SupervisedPort(name, False, writer=writer, restore=restore, metrics=metrics)
+        writer.on_error = lambda port, error: self.failed(supervised, port, error)
+        return self.add(supervised)
+
+    def add(self, supervised):
+        # The port is opened right away when it is there, else in the background
+        try:
+            self.reopen(supervised, restore=False)
+        except Exception as e:
+            log.warning('port', "MIDI port %s is not available, waiting for it: %s", supervised.name, e)
+            self.schedule_retry(supervised, time.monotonic())
+        with self.lock:
+            self.ports.append(supervised)
+        return supervised
+
+    def failed(self, supervised, port, error):
+        # Called by a writer from any thread, the port is replaced on the supervisor thread
+        with self.lock:
+            if supervised.port is not port or supervised.failure is not None:
+                return
+            supervised.failure = error
+        self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        with self.lock:
+            ports, self.ports = self.ports, []
+        for supervised in ports:
+            self.close_port(supervised)
+
+    def close_port(self, supervised):
+        port, supervised.port = supervised.port, None
+        if supervised.writer is not None:
+            supervised.writer.attach(None)
+        if port is not None:
+            try:
+                port.close()
+            except Exception:
+                # Closing a port of an unplugged device may fail, it is gone either way
+                pass
+
+    def schedule_retry(self, supervised, now):
+        supervised.backoff = min(max(supervised.backoff * 2, self.min_backoff), self.max_backoff)
+        supervised.retry_at = now + supervised.backoff
+
+    def reopen(self, supervised, restore=True):
+        port = supervised.open()
+        supervised.port = port
+        supervised.backoff = 0.0
+        if supervised.writer is not None:
+            supervised.writer.attach(port)
+        if restore and supervised.restore is not None:
+            supervised.restore()
+        if supervised.lost is not None:
+            recover_ms = (time.monotonic() - supervised.lost) * 1000
+            supervised.lost = None
+            log.info('port', "Reconnected %s after %.0f ms", supervised.name, recover_ms)
+            metrics = supervised.metrics
+            if metrics is not None:
+                metrics.gauges['recover_ms'] = lambda: round(recover_ms, 1)
+        elif restore:
+            log.info('port', "MIDI port %s is available", supervised.name)
+
+    def check(self):
+        # Returns how long to sleep until the next check
+        now = time.monotonic()
+        try:
+            available = {True: set(mido.get_input_names()), False: set(mido.get_output_names())}
+        except Exception as e:
+            log.error('port', "Unable to list MIDI ports: %s", e)
+            return self.interval
+        with self.lock:
+            ports = list(self.ports)
+        delay = self.interval
+        for supervised in ports:
+            names = available[supervised.is_input]
+            if supervised.port is not None:
+                failure = supervised.failure
+                if failure is None and supervised.name in names:
+                    continue
+                self.close_port(supervised)
+                supervised.failure = None
+                supervised.lost = now
+                supervised.backoff = 0.0
+                supervised.retry_at = now
+                log.warning('port', "Lost MIDI port %s (%s), reconnecting", supervised.name, failure or "it was unplugged")
+            if now >= supervised.retry_at:
+                try:
+                    if supervised.name not in names:
+                        raise OSError("not in the port list")
+                    self.reopen(supervised)
+                except Exception:
+                    self.schedule_retry(supervised, now)
+            if supervised.port is None:
+                delay = min(delay, max(0.0, supervised.retry_at - now))
+        return delay
+
+    def _run(self):
+        while not self.closed:
+            delay = self.check()
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+def get_routing_pairs(devices, topology='star'):
+    # star mirrors the first device (the console) to each of the others,
+    # mesh mirrors every device to every other one. Within a pair the device
+    # listed first takes the device1 role of the two device setup.
+    if topology == 'mesh':
+        return list(itertools.combinations(devices, 2))
+    return [(devices[0], device) for device in devices[1:]]
+
+def load_routing(devices, topology='star'):
+    pairs = {}
+    for device1, device2 in get_routing_pairs(devices, topology):
+        tables = load_device_pair(device1, device2)
+        if tables is None:
+            return None
+        pairs[(device1, device2)] = tables
+    return pairs
+
+def get_route_format(tables, direction):
+    # Everything the output of a direction depends on. Directions leaving the
+    # same input with equal formats produce identical messages.
+    target = tables['device2' if direction == 'device1' else 'device1']
+    return (tables['conversions'][direction], tables['button_notes'], tables['button_dispatch'], target['fader_interval'])
+
+def build_routes(pairs):
+    # Returns {input device: [(format, [target devices])]} with one entry per
+    # distinct format, so fan-out converts once per format, not per target
+    routes = {}
+    for (device1, device2), tables in pairs.items():
+        for source, target, direction in ((device1, device2, 'device1'), (device2, device1, 'device2')):
+            route_format = get_route_format(tables, direction)
+            for existing_format, targets in routes.setdefault(source, []):
+                if existing_format == route_format:
+                    targets.append(target)
+                    break
+            else:
+                routes[source].append((route_format, [target]))
+    return routes
 
 gpio_to_fader_button_map = {
     "2A00": (1, 'toggle_on'),
@@ -421,108 +1774,923 @@ gpio_to_fader_button_map = {
     "2E01": (5, 'toggle_off')
 }
 
-def send_gpio_mapped_message(outport, step, originating_device):
-    note = get_note_from_step(step[originating_device])
-    velocity = int(step[originating_device].split('velocity=')[1].split()[0])
-    channel = int(step[originating_device].split('channel=')[1].split()[0])
-    message_type = step[originating_device].split()[0]
-    mapped_message = mido.Message(message_type, note=note, velocity=velocity, channel=channel)
-    print(f"Sending mapped message: {mapped_message}")
-    outport.send(mapped_message)
+class GpioDispatcher:
+    # Turns DHD GPIO codes into the step messages of the DHD device and hands
+    # them to that device's writer as one group, from whichever thread
+    # received them. role is the DHD device's side in the tables of
+    # live_tables; send is set once the writer exists.
+    def __init__(self, live_tables, role, send=None):
+        self.live_tables = live_tables
+        self.role = role
+        self.send = send
+
+    def dispatch(self, codes):
+        step_map = self.live_tables.current['step_map']
+        messages = []
+        for code in codes:
+            if code not in gpio_to_fader_button_map:
+                log.warning('gpio', "Unknown or malformed action received: %s", code)
+                continue
+            button_id, action = gpio_to_fader_button_map[code]
+            for step in step_map.get(button_id, {action: []})[action]:
+                messages.append(build_mapped_message(step[self.role]))
+        send = self.send
+        if not messages:
+            return
+        if send is None:
+            log.warning('gpio', "DHD device is not open yet, dropping GPIO action")
+            return
+        send(tuple(messages), PRIORITY_BUTTON)
+        for mapped_message in messages:
+            log.info('gpio', "Sending mapped message: %s", mapped_message)
+
+def get_gpio_role(tables, dhd_config):
+    # The DHD device is matched on its output port, GPIO output goes there
+    for role in ('device1', 'device2'):
+        if tables[role]['midi_out_name'] == dhd_config['midi_out_name']:
+            return role
+    return None
 
-def listen_to_stdin(dhd_device_config, step_map, stdin_queue, dhd_device = "device2"):
-    print("Ready to receive data from C#...")
-    sys.stdout.flush()
+def listen_to_stdin(gpio, resync=None):
+    # Lines are DHD GPIO codes, or "resync <device>" to push the mirrored
+    # state to a device again, e.g. after it was power-cycled
+    log.info('dhd', "Ready to receive data from C#...")
 
     try:
         for line in sys.stdin:
-            if line.strip():
-                print(f"Received from C#: {line.strip()}")
-                sys.stdout.flush()
-
-                hex_action = line.strip()
-                if hex_action in gpio_to_fader_button_map:
-                    button_id, action = gpio_to_fader_button_map[hex_action]
-                    steps = step_map[button_id]                    
-                    for step in steps[action]:
-                        stdin_queue.put((step, dhd_device))                    
-                else:
-                    print(f"Unknown or malformed action received: {line.strip()}")
+            line = line.strip()
+            if line.startswith('resync '):
+                name = line[len('resync '):].strip()
+                if resync is None or not resync(name):
+                    log.warning('resync', "Unknown device to resync: %s", name)
+            elif not line:
+                log.warning('gpio', "Received an empty line")
+            elif gpio is None:
+                log.warning('gpio', "DHD is disabled, ignoring GPIO action: %s", line)
             else:
-                print("Received an empty line")
-                sys.stdout.flush()
+                gpio.dispatch((line,))
     except Exception as e:
-        print(f"Exception: {e}")
-        sys.stdout.flush()
+        log.error('dhd', "Exception: %s", e)
+
+def decode_gpio_frames(buffer):
+    # A frame is one count byte followed by count (gpio, state) byte pairs,
+    # 2A 01 being code "2A01". Returns the codes of all complete frames and
+    # the unconsumed rest of the buffer.
+    codes = []
+    offset = 0
+    while offset < len(buffer):
+        end = offset + 1 + 2 * buffer[offset]
+        if end > len(buffer):
+            break
+        for index in range(offset + 1, end, 2):
+            codes.append(f"{buffer[index]:02X}{buffer[index + 1]:02X}")
+        offset = end
+    return codes, buffer[offset:]
+
+class GpioChannel:
+    # Local TCP socket for DHD GPIO codes, used by the C# host next to the
+    # stdin lines. Everything read in one go is dispatched as a single batch,
+    # so a burst of codes reaches the writer with one wakeup. One client is
+    # served at a time; scripts/gpio_client.py is a stand-in for tests.
+    def __init__(self, gpio, port, host='127.0.0.1'):
+        self.gpio = gpio
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        log.info('dhd', "Listening for DHD GPIO on port %s", self.port)
+
+    def serve(self, connection):
+        buffer = b''
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                return
+            codes, buffer = decode_gpio_frames(buffer + data)
+            if codes:
+                self.gpio.dispatch(codes)
+
+    def _run(self):
+        while True:
+            connection, _ = self.server.accept()
+            with connection:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self.serve(connection)
+                except OSError as e:
+                    log.warning('dhd', "GPIO connection lost: %s", e)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='MIDI_mirror.py', usage='MIDI_mirror.py <device1> <device2> <dhd_enabled> <dhd_device> [options]')
+    parser.add_argument('device1')
+    parser.add_argument('device2')
+    parser.add_argument('dhd_enabled')
+    parser.add_argument('dhd_device')
+    parser.add_argument('--device', action='append', default=[], dest='devices', metavar='NAME',
+                        help='mirror one more device, may be repeated')
+    parser.add_argument('--topology', choices=('star', 'mesh'), default='star',
+                        help='star mirrors device1 to every other device, mesh mirrors all devices to each other (default star)')
+    parser.add_argument('--engine', choices=('loop', 'threads', 'processes'), default='loop',
+                        help='run all ports on one event loop, or one thread or process per direction for two devices (default loop)')
+    parser.add_argument('--gpio-port', type=int, default=None, metavar='PORT',
+                        help='also accept DHD GPIO codes on this local TCP port')
+    parser.add_argument('--log-level', choices=tuple(LEVELS), default='info',
+                        help='lowest level written to stdout (default info)')
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text',
+                        help='plain log lines, or JSON lines like the metrics (default text)')
+    parser.add_argument('--metrics', type=float, nargs='?', const=5.0, default=None, metavar='SECONDS',
+                        help='print per-stage metrics as JSON lines every SECONDS (default 5)')
+    parser.add_argument('--journal', default=None, metavar='DIR',
+                        help='record all MIDI in and out of each input port to a ring file in DIR')
+    parser.add_argument('--journal-records', type=int, default=DEFAULT_RECORDS, metavar='N',
+                        help=f'messages kept per journal file (default {DEFAULT_RECORDS})')
+    parser.add_argument('--raw', action='store_true',
+                        help='read and write fader messages as raw bytes instead of mido messages')
+    args = parser.parse_args(argv)
+    if args.engine != 'loop' and args.devices:
+        parser.error(f'--engine {args.engine} only mirrors two devices')
+    return args
+
+def fail(message):
+    log.error('startup', message)
+    log.flush()
+    sys.exit(1)
 
 def main():
-    if len(sys.argv) != 5:
-        print("Usage: MIDI_mirror.py <device1> <device2> <dhd_enabled> <dhd_device>")
-        sys.exit(1)
-
-    device1 = sys.argv[1]
-    device2 = sys.argv[2]
-    dhd_enabled = sys.argv[3] == 'True'
-    dhd_device = sys.argv[4]
-    
-    device1_config = read_xml_config(f"{device1}.xml")
-    device2_config = read_xml_config(f"{device2}.xml")
+    args = parse_args(sys.argv[1:])
+    log.configure(level=LEVELS[args.log_level], structured=args.log_format == 'json')
+
+    devices = [args.device1, args.device2] + args.devices
+    dhd_enabled = args.dhd_enabled == 'True'
+    dhd_device = args.dhd_device
+
+    if len(set(devices)) != len(devices):
+        fail("Error: A device can only be mirrored once.")
+
+    try:
+        if args.engine != 'loop':
+            tables = load_device_pair(args.device1, args.device2)
+            pairs = {(args.device1, args.device2): tables} if tables is not None else None
+        else:
+            pairs = load_routing(devices, args.topology)
+    except ValueError as e:
+        fail(f"Error: Invalid configuration: {e}")
 
-    if device1_config is None or device2_config is None:
-        print("Error: Unable to read configuration files.")
-        sys.exit(1)
+    if pairs is None:
+        fail("Error: Unable to read configuration files.")
 
-    device1_config = parse_config(device1_config)
-    device2_config = parse_config(device2_config)
+    configs = {}
+    for (device1, device2), tables in pairs.items():
+        configs[device1] = tables['device1']
+        configs[device2] = tables['device2']
 
     if dhd_device:
-        if dhd_device == device1:
-            dhd_config = device1_config
-        elif dhd_device == device2:
-            dhd_config = device2_config
+        if dhd_device in configs:
+            dhd_config = configs[dhd_device]
         else:
             dhd_config = read_xml_config(f"{dhd_device}.xml")
             if dhd_config is None:
-                print(f"Error: Unable to read DHD device configuration file '{dhd_device}.xml'.")
-                sys.exit(1)
-            dhd_config = parse_config(dhd_config)
+                fail(f"Error: Unable to read DHD device configuration file '{dhd_device}.xml'.")
+            try:
+                dhd_config = parse_config(dhd_config)
+            except ValueError as e:
+                fail(f"Error: Invalid configuration: {dhd_device}.xml: {e}")
 
     available_inputs = mido.get_input_names()
     available_outputs = mido.get_output_names()
 
-    if device1_config['midi_in_name'] not in available_inputs:
-        print(f"Error: Input device '{device1_config['midi_in_name']}' for device1 not found.")
-        sys.exit(1)
-    if device1_config['midi_out_name'] not in available_outputs:
-        print(f"Error: Output device '{device1_config['midi_out_name']}' for device1 not found.")
-        sys.exit(1)
-    if device2_config['midi_in_name'] not in available_inputs:
-        print(f"Error: Input device '{device2_config['midi_in_name']}' for device2 not found.")
-        sys.exit(1)
-    if device2_config['midi_out_name'] not in available_outputs:
-        print(f"Error: Output device '{device2_config['midi_out_name']}' for device2 not found.")
-        sys.exit(1)
-
-    cc_to_nrpn_map, nrpn_to_cc_map = build_mappings(device1_config, device2_config)
-    button_map, step_map = build_toggle_mappings(device1_config, device2_config)
+    # A missing port is opened once the device shows up, the others start mirroring meanwhile
+    for index, device in enumerate(devices, 1):
+        if configs[device]['midi_in_name'] not in available_inputs:
+            log.warning('startup', f"Warning: Input device '{configs[device]['midi_in_name']}' for device{index} not found, waiting for it.")
+        if configs[device]['midi_out_name'] not in available_outputs:
+            log.warning('startup', f"Warning: Output device '{configs[device]['midi_out_name']}' for device{index} not found, waiting for it.")
+
+    if args.engine == 'threads':
+        start_mirroring(pairs[(args.device1, args.device2)], dhd_enabled, dhd_config if dhd_device else None,
+                        metrics_interval=args.metrics, reload_devices=(args.device1, args.device2), gpio_port=args.gpio_port,
+                        journal_dir=args.journal, journal_records=args.journal_records, raw=args.raw)
+    elif args.engine == 'processes':
+        processes = start_processes(pairs[(args.device1, args.device2)], dhd_enabled, dhd_config if dhd_device else None,
+                                    metrics_interval=args.metrics, reload_devices=(args.device1, args.device2), gpio_port=args.gpio_port,
+                                    journal_dir=args.journal, journal_records=args.journal_records, raw=args.raw)
+        # The shared memory lives as long as this process, which has no
+        # other thread keeping it up without DHD
+        for process in processes:
+            process.join()
+    else:
+        start_routing(devices, pairs, dhd_enabled, dhd_config if dhd_device else None,
+                      metrics_interval=args.metrics, topology=args.topology, watch_configs=True, gpio_port=args.gpio_port,
+                      journal_dir=args.journal, journal_records=args.journal_records, raw=args.raw)
+
+class EngineSetup:
+    # What every engine sets up around its mirroring: the device DHD GPIO is
+    # written to, stdin and the GPIO socket, and the journal. Create it before
+    # the engine, which builds its GpioDispatcher for gpio_pair and gpio_role,
+    # and start() it once the engine takes GPIO actions and resync commands.
+    # GPIO steps are taken from the first pair with the DHD device in it.
+    def __init__(self, pairs, dhd_enabled, dhd_config=None, gpio_port=None, journal_dir=None, daemon=False):
+        self.gpio_port = gpio_port
+        self.daemon = daemon
+        self.gpio_pair = None
+        self.gpio_role = None
+        if dhd_enabled:
+            for pair, tables in pairs.items() if dhd_config is not None else ():
+                role = get_gpio_role(tables, dhd_config)
+                if role is not None:
+                    self.gpio_pair = pair
+                    self.gpio_role = role
+                    break
+            else:
+                log.error('dhd', "Error: The DHD device is not one of the mirrored devices, GPIO is disabled.")
+        if journal_dir is not None:
+            log.info('startup', "Journaling MIDI to %s", journal_dir)
+
+    def start(self, gpio, resync):
+        # Returns the stdin thread when it carries DHD GPIO, else None
+        if gpio is None:
+            # Without DHD stdin only carries resync commands
+            threading.Thread(target=listen_to_stdin, args=(None, resync), daemon=True).start()
+            return None
+        stdin_thread = threading.Thread(target=listen_to_stdin, args=(gpio, resync), daemon=self.daemon)
+        stdin_thread.start()
+        if self.gpio_port is not None:
+            # The stdin lines keep working without the socket
+            try:
+                GpioChannel(gpio, self.gpio_port).start()
+            except OSError as e:
+                log.error('dhd', "Unable to listen for DHD GPIO on port %s, using stdin only: %s", self.gpio_port, e)
+
+        log.info('dhd', "DHD is enabled. Listening for updates...")
+        return stdin_thread
+
+def start_mirroring(tables, dhd_enabled, dhd_config=None, daemon=False, metrics_interval=None, reload_devices=None, gpio_port=None,
+                    journal_dir=None, journal_records=DEFAULT_RECORDS, raw=False):
+    device1_config = tables['device1']
+    device2_config = tables['device2']
+
+    live_tables = LiveTables(tables)
+    echoes = {'device1': EchoSuppressor(device1_config['echo_window']),
+              'device2': EchoSuppressor(device2_config['echo_window'])}
+    states = {'device1': DeviceState(device1_config['channel']),
+              'device2': DeviceState(device2_config['channel'])}
+
+    # Output port -> resync of that port, registered by mirror_midi once open
+    resyncers = {}
+    ports = {device1_config['midi_out_name']: device1_config['midi_out_name'],
+             device2_config['midi_out_name']: device2_config['midi_out_name']}
+    if reload_devices is not None:
+        ports[reload_devices[0]] = device1_config['midi_out_name']
+        ports[reload_devices[1]] = device2_config['midi_out_name']
+
+    def resync(name):
+        resync_port = resyncers.get(ports.get(name))
+        if resync_port is None:
+            return False
+        resync_port()
+        return True
+
+    threads = []
+    engine = EngineSetup({reload_devices: tables}, dhd_enabled, dhd_config, gpio_port, journal_dir, daemon)
+    supervisor = PortSupervisor()
+    supervisor.start()
+
+    if reload_devices is not None:
+        ConfigWatcher(reload_devices, lambda: reload_device_pair(reload_devices[0], reload_devices[1], live_tables)).start()
+
+    metrics1 = metrics2 = None
+    if metrics_interval:
+        from midi_metrics import DirectionMetrics, MetricsReporter
+        metrics1 = DirectionMetrics(f"{device1_config['midi_in_name']} -> {device2_config['midi_out_name']}")
+        metrics2 = DirectionMetrics(f"{device2_config['midi_in_name']} -> {device1_config['midi_out_name']}")
+        MetricsReporter((metrics1, metrics2), metrics_interval).start()
+
+    # GPIO output goes to the direction writing to the DHD device
+    gpio1 = gpio2 = gpio = None
+    if engine.gpio_role is not None:
+        gpio = GpioDispatcher(live_tables, engine.gpio_role)
+        if engine.gpio_role == 'device2':
+            gpio1 = gpio
+        else:
+            gpio2 = gpio
+    stdin_thread = engine.start(gpio, resync)
+    if stdin_thread is not None:
+        threads.append(stdin_thread)
+
+    # Actions of both devices run on one executor, GPIO steps go out like DHD GPIO
+    executor = ActionExecutor(gpio=gpio).start()
+
+    # One journal per direction, named after its input port
+    journal1 = journal2 = None
+    if journal_dir is not None:
+        journal1 = Journal(get_journal_path(journal_dir, device1_config['midi_in_name']),
+                           device1_config['midi_in_name'], device2_config['midi_out_name'], journal_records)
+        journal2 = Journal(get_journal_path(journal_dir, device2_config['midi_in_name']),
+                           device2_config['midi_in_name'], device1_config['midi_out_name'], journal_records)
+
+    for direction, direction_gpio, direction_metrics, journal in (('device1', gpio1, metrics1, journal1),
+                                                                  ('device2', gpio2, metrics2, journal2)):
+        context = MirrorContext(live_tables, direction, dhd_enabled, gpio=direction_gpio, metrics=direction_metrics,
+                                journal=journal, echoes=echoes, states=states, resyncers=resyncers,
+                                supervisor=supervisor, executor=executor, raw=raw)
+        threads.append(threading.Thread(target=mirror_midi, args=(context,), daemon=daemon))
+
+    for thread in threads[-2:]:
+        thread.start()
+    return threads
+
+# Records between the main process and the direction processes
+EVENT_LOG = b'L'
+EVENT_GPIO = b'G'
+EVENT_KEYS = b'K'
+COMMAND_GPIO = b'G'
+COMMAND_RESYNC = b'R'
+
+class RingStream:
+    # Log stream of a direction process: the formatted lines go to the main
+    # process, whose log writes them to stdout, so there is one writer
+    def __init__(self, ring):
+        self.ring = ring
+
+    def write(self, text):
+        data = text.encode()
+        size = self.ring.payload_size - len(EVENT_LOG)
+        for offset in range(0, len(data), size):
+            self.ring.put_wait(EVENT_LOG + data[offset:offset + size])
+
+    def flush(self):
+        pass
 
-    convert_func1, convert_func2 = get_conversion_function(device1_config, device2_config)
+class GpioForwarder:
+    # Takes the place of the GpioDispatcher in the main process and passes
+    # the codes to the process writing to the DHD device; in the other
+    # direction process it passes the GPIO steps of actions to the main
+    # process (kind EVENT_GPIO) on the actions ring, which log output does
+    # not share, and the main process forwards them again. Records that do
+    # not fit are dropped and counted.
+    def __init__(self, commands, kind=COMMAND_GPIO):
+        self.commands = commands
+        self.kind = kind
+        self.dropped = 0
+
+    def dispatch(self, codes):
+        # Codes are four characters and a comma, a batch is split to fit the slots
+        per_record = (self.commands.payload_size - len(self.kind)) // 5
+        for offset in range(0, len(codes), per_record):
+            if not self.commands.put(self.kind + ','.join(codes[offset:offset + per_record]).encode()):
+                self.dropped += 1
+                log.warning('gpio', "GPIO is not keeping up, dropped a GPIO batch (%d so far)", self.dropped)
+
+class KeyForwarder:
+    # Presses the keys of actions for a direction process: they go to the
+    # main process on the actions ring (kind EVENT_KEYS), which runs them, so
+    # the OS calls of a key press stay out of the MIDI processes
+    def __init__(self, ring):
+        self.ring = ring
+        self.dropped = 0
+
+    def press(self, keys):
+        if not self.ring.put(EVENT_KEYS + '+'.join(keys).encode()):
+            self.dropped += 1
+            log.warning('actions', "Key presses are not keeping up, dropped %s (%d so far)", '+'.join(keys), self.dropped)
+
+class ProcessEvents:
+    # Serves the events of the direction processes in the main process. The
+    # actions rings come first: key presses run on an executor of this
+    # process and GPIO steps go on to gpio, the forwarder of the DHD
+    # direction. Log output arrives on the log rings and
+    # is handed to the log line by line, whose drain thread writes it, so a
+    # slow stdout reader holds up neither. It also holds the shared memory
+    # blocks of the processes and removes them at exit, once the processes
+    # are gone and their last events have been served.
+    def __init__(self, rings, action_rings, doorbell, shared=(), gpio=None, processes=()):
+        self.rings = rings
+        self.action_rings = action_rings
+        self.doorbell = doorbell
+        self.shared = list(shared)
+        self.gpio = gpio
+        self.processes = list(processes)
+        self.keys = ActionExecutor()
+        self.reporter = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        import atexit
+        # Registered after multiprocessing's own exit handler, so this runs
+        # first and has to stop the processes itself
+        atexit.register(self.close)
+        self.keys.start()
+        self.thread.start()
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        if self.reporter is not None:
+            self.reporter.close()
+        self.closed = True
+        self.doorbell.release()
+        self.thread.join()
+        for block in self.shared:
+            block.close()
+        self.shared = []
+
+    def _run(self):
+        partial = [b''] * len(self.rings)
+        while not self.closed:
+            self.doorbell.acquire()
+            for ring in self.action_rings:
+                while True:
+                    record = ring.get()
+                    if record is None:
+                        break
+                    self.run_action(record[:1], record[1:])
+            for index, ring in enumerate(self.rings):
+                while True:
+                    record = ring.get()
+                    if record is None:
+                        break
+                    # Chunks of a line may arrive in several records
+                    text = partial[index] + record[len(EVENT_LOG):]
+                    end = text.rfind(b'\n')
+                    partial[index] = text[end + 1:]
+                    if end >= 0:
+                        log.write(text[:end].decode(errors='replace'))
+
+    def run_action(self, kind, body):
+        if kind == EVENT_KEYS:
+            keys = body.decode()
+            self.keys.submit({'trigger': keys, 'steps': (('keys', parse_keys(keys)),)}, None)
+        elif kind == EVENT_GPIO:
+            if self.gpio is None:
+                log.warning('actions', "DHD is not enabled, skipping GPIO %s", body.decode())
+            else:
+                self.gpio.dispatch(body.decode().split(','))
 
-    stdin_queue = Queue()
+def serve_commands(commands, gpio, resyncers):
+    # Command loop of a direction process, fed by the main process
+    while True:
+        commands.doorbell.acquire()
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            kind, body = command[:1], command[1:]
+            if kind == COMMAND_GPIO:
+                if gpio is None:
+                    log.warning('gpio', "GPIO action for a direction without DHD output: %s", body.decode())
+                else:
+                    gpio.dispatch(body.decode().split(','))
+            elif kind == COMMAND_RESYNC:
+                for resync_port in resyncers.values():
+                    resync_port()
+
+def run_direction_process(spec):
+    # Entry point of a direction process in --engine processes. Everything a
+    # direction shares with the other one lives in shared memory: the state
+    # and echo values of both devices and its metrics.
+    log.configure(level=spec['log_level'], structured=spec['log_structured'])
+    log.stream = RingStream(spec['events'])
+    if spec['setup'] is not None:
+        # Lets the benchmarks set up the simulated ports in this process
+        spec['setup'](spec['direction'])
+
+    tables = spec['tables']
+    direction = spec['direction']
+    target = 'device2' if direction == 'device1' else 'device1'
+    source_config = tables[direction]
+    target_config = tables[target]
+    live_tables = LiveTables(tables)
+    if spec['reload_devices'] is not None:
+        device1, device2 = spec['reload_devices']
+        ConfigWatcher(spec['reload_devices'], lambda: reload_device_pair(device1, device2, live_tables)).start()
+
+    metrics = None
+    if spec['metrics'] is not None:
+        from midi_metrics import SharedDirectionMetrics, MetricsPublisher
+        metrics = SharedDirectionMetrics(spec['name'], spec['metrics'])
+        MetricsPublisher((metrics,), spec['metrics_interval']).start()
+
+    gpio = GpioDispatcher(live_tables, target) if spec['gpio'] else None
+    journal = None
+    if spec['journal_dir'] is not None:
+        journal = Journal(get_journal_path(spec['journal_dir'], source_config['midi_in_name']),
+                          source_config['midi_in_name'], target_config['midi_out_name'], spec['journal_records'])
+
+    resyncers = {}
+    threading.Thread(target=serve_commands, args=(spec['commands'], gpio, resyncers), daemon=True).start()
+    # Key presses of actions run in the main process, and so do GPIO steps
+    # unless this direction writes to the DHD device
+    executor = ActionExecutor(gpio=gpio if gpio is not None else GpioForwarder(spec['actions'], EVENT_GPIO),
+                              press=KeyForwarder(spec['actions']).press).start()
+    echoes = {role: SharedEchoSuppressor(tables[role]['echo_window'], spec['echoes'][role]) for role in (direction, target)}
+    states = {role: DeviceState(tables[role]['channel'], spec['states'][role]) for role in (direction, target)}
+    mirror_midi(MirrorContext(live_tables, direction, spec['dhd_enabled'], gpio=gpio, metrics=metrics, journal=journal,
+                              echoes=echoes, states=states, resyncers=resyncers, executor=executor, raw=spec['raw']))
+
+def start_processes(tables, dhd_enabled, dhd_config=None, daemon=False, metrics_interval=None, reload_devices=None, gpio_port=None,
+                    journal_dir=None, journal_records=DEFAULT_RECORDS, raw=False, setup=None):
+    # Like start_mirroring, but each direction runs in a process of its own
+    # so neither shares a GIL with the other or with the DHD side: this
+    # process reads stdin and the GPIO socket, runs the key presses and
+    # reports the metrics. setup(direction) is run first thing in each
+    # direction process and has to be picklable.
+    import multiprocessing
+    from midi_shared import SharedArrays, RingQueue
+
+    context = multiprocessing.get_context('spawn')
+    roles = ('device1', 'device2')
+    states = {role: SharedArrays(DEVICE_STATE_LAYOUT, UNKNOWN_VALUE) for role in roles}
+    echoes = {role: SharedArrays(ECHO_LAYOUT) for role in roles}
+    events_doorbell = context.Semaphore(0)
+
+    # GPIO output goes to the direction writing to the DHD device
+    engine = EngineSetup({reload_devices: tables}, dhd_enabled, dhd_config, gpio_port, journal_dir, daemon)
+    gpio_direction = None
+    if engine.gpio_role is not None:
+        gpio_direction = 'device2' if engine.gpio_role == 'device1' else 'device1'
+
+    if metrics_interval:
+        from midi_metrics import SharedDirectionMetrics, MetricsReporter, SHARED_LAYOUT
+
+    processes = []
+    commands = {}
+    event_rings = []
+    action_rings = []
+    metrics = []
+    shared = list(states.values()) + list(echoes.values())
+    for direction, target in (('device1', 'device2'), ('device2', 'device1')):
+        name = f"{tables[direction]['midi_in_name']} -> {tables[target]['midi_out_name']}"
+        metrics_arrays = None
+        if metrics_interval:
+            metrics_arrays = SharedArrays(SHARED_LAYOUT)
+            shared.append(metrics_arrays)
+            metrics.append(SharedDirectionMetrics(name, metrics_arrays))
+        commands[tables[target]['midi_out_name']] = command_ring = RingQueue(context.Semaphore(0), capacity=64)
+        event_ring = RingQueue(events_doorbell)
+        event_rings.append(event_ring)
+        action_ring = RingQueue(events_doorbell, capacity=64)
+        action_rings.append(action_ring)
+        shared += [command_ring, event_ring, action_ring]
+        spec = {
+            'name': name, 'tables': tables, 'direction': direction, 'dhd_enabled': dhd_enabled,
+            'gpio': direction == gpio_direction, 'states': states, 'echoes': echoes,
+            'metrics': metrics_arrays, 'metrics_interval': metrics_interval,
+            'commands': command_ring, 'events': event_ring, 'actions': action_ring, 'reload_devices': reload_devices,
+            'journal_dir': journal_dir, 'journal_records': journal_records, 'raw': raw,
+            'log_level': log.level, 'log_structured': log.structured, 'setup': setup,
+        }
+        processes.append(context.Process(target=run_direction_process, args=(spec,), name=name, daemon=daemon))
+
+    gpio = None
+    if gpio_direction is not None:
+        gpio_target = 'device2' if gpio_direction == 'device1' else 'device1'
+        gpio = GpioForwarder(commands[tables[gpio_target]['midi_out_name']])
+    process_events = ProcessEvents(event_rings, action_rings, events_doorbell, shared, gpio, processes)
+    process_events.start()
+    for process in processes:
+        process.start()
+    if metrics_interval:
+        process_events.reporter = MetricsReporter(metrics, metrics_interval)
+        process_events.reporter.start()
+
+    ports = {name: name for name in commands}
+    if reload_devices is not None:
+        ports[reload_devices[0]] = tables['device1']['midi_out_name']
+        ports[reload_devices[1]] = tables['device2']['midi_out_name']
+
+    def resync(name):
+        command_ring = commands.get(ports.get(name))
+        if command_ring is None:
+            return False
+        command_ring.put(COMMAND_RESYNC)
+        return True
+
+    engine.start(gpio, resync)
+    return processes
+
+class MidiRouter:
+    # Mirrors N devices on a single asyncio event loop. Backend callbacks hand
+    # messages to the loop, every output port gets a LoopPortWriter and
+    # coalesced faders are flushed from loop timers, so there is one thread
+    # for all ports instead of one per direction. The conversion tables of an
+    # edge come from the compiled pair of its two devices (see build_routes).
+    # With a journal_dir each device journals its input and output port, with
+    # raw the inputs are read as bytes (see MirrorDirection.handle_raw).
+    def __init__(self, devices, pairs, dhd_enabled, topology='star', metrics_interval=None, journal_dir=None, journal_records=DEFAULT_RECORDS,
+                 raw=False):
+        self.devices = devices
+        self.raw = raw
+        self.topology = topology
+        self.dhd_enabled = dhd_enabled
+        self.metrics_interval = metrics_interval
+        self.journal_dir = journal_dir
+        self.journal_records = journal_records
+        self.journals = {}
+        self.gpio = None
+        self.gpio_pair = None
+        self.gpio_device = None
+        self.loop = None
+        self.supervisor = None
+        self.executor = None
+        self.writers = {}
+        self.echoes = {}
+        self.states = {}
+        self.routes = {}
+        self.feeds = {}
+        self.mirrors = []
+        self.route_metrics = {}
+        self.metrics = []
+        self.flush_timer = None
+        self.flush_at = None
+        self.ready = threading.Event()
+        self.set_pairs(pairs)
+
+    def set_pairs(self, pairs):
+        self.pairs = pairs
+        self.configs = {}
+        for (device1, device2), tables in pairs.items():
+            self.configs[device1] = tables['device1']
+            self.configs[device2] = tables['device2']
+        if self.gpio is not None:
+            self.gpio.live_tables.current = pairs[self.gpio_pair]
+
+    def set_gpio_device(self, pair, role):
+        self.gpio_pair = pair
+        self.gpio_device = pair[0] if role == 'device1' else pair[1]
+        self.gpio = GpioDispatcher(LiveTables(self.pairs[pair]), role)
+        return self.gpio
+
+    def get_emit(self, targets):
+        writers = [self.writers[target] for target in targets]
+        if len(writers) == 1:
+            return writers[0].send
+        def emit(messages, priority, writers=writers):
+            for writer in writers:
+                writer.send(messages, priority)
+        return emit
+
+    def build_relays(self, surface):
+        # In a star the surfaces only have a pair with the console, so what a
+        # surface sends the console is handed to a copy of the console's own
+        # directions towards the other surfaces, as if the console had sent
+        # it. The surfaces follow each other; the console's echo of the value
+        # is still suppressed. Relays do not run actions or debounce.
+        console = self.devices[0]
+        pairs = {pair: tables for pair, tables in self.pairs.items() if surface not in pair}
+        relays = []
+        for route_format, targets in build_routes(pairs).get(console, ()):
+            conversions, button_notes, button_dispatch, fader_interval = route_format
+            name = f"{self.configs[surface]['midi_in_name']} -> {self.configs[console]['midi_in_name']} -> " \
+                   f"{', '.join(self.configs[target]['midi_out_name'] for target in targets)}"
+            relays.append(MirrorDirection(self.get_emit(targets), conversions, button_notes, button_dispatch, self.dhd_enabled,
+                                          fader_interval=fader_interval, name=name, check_special=False,
+                                          pair_window=self.configs[console]['pair_window'], debounce=0))
+        return relays
+
+    def relay(self, relays, messages):
+        if isinstance(messages, RAW_GROUP):
+            for relay in relays:
+                for index in range(0, len(messages), 3):
+                    relay.handle_raw(messages[index:index + 3])
+        else:
+            for relay in relays:
+                for message in messages:
+                    relay.handle(message)
+        # Action output reaches the relays outside handle_message()
+        self.arm_flush()
+
+    def build_mirrors(self):
+        self.routes = {}
+        self.feeds = {}
+        self.mirrors = []
+        star = self.topology != 'mesh' and len(self.devices) > 2
+        for source, formats in build_routes(self.pairs).items():
+            mirrors = []
+            relays = self.build_relays(source) if star and source != self.devices[0] else []
+            self.mirrors.extend(relays)
+            for index, (route_format, targets) in enumerate(formats):
+                conversions, button_notes, button_dispatch, fader_interval = route_format
+                emit = self.get_emit(targets)
+                if relays:
+                    def emit(messages, priority, send=emit, relays=relays):
+                        send(messages, priority)
+                        self.relay(relays, messages)
+                name = f"{self.configs[source]['midi_in_name']} -> {', '.join(self.configs[target]['midi_out_name'] for target in targets)}"
+                metrics = self.get_metrics(name)
+                mirror = MirrorDirection(emit, conversions, button_notes, button_dispatch, self.dhd_enabled,
+                                         fader_interval=fader_interval, metrics=metrics, name=name, check_special=index == 0,
+                                         echoes=self.echoes[source], state=self.states[source],
+                                         pair_window=self.configs[source]['pair_window'], debounce=self.configs[source]['button_debounce'],
+                                         actions=self.configs[source]['actions'], executor=self.executor)
+                if metrics is not None:
+                    metrics.gauges['pending_faders'] = lambda mirror=mirror: len(mirror.coalescer.pending)
+                mirrors.append(mirror)
+                for target in targets:
+                    self.feeds.setdefault(target, []).append(mirror)
+            self.routes[source] = mirrors
+            self.mirrors.extend(mirrors)
+
+    def get_metrics(self, name):
+        if not self.metrics_interval:
+            return None
+        metrics = self.route_metrics.get(name)
+        if metrics is None:
+            from midi_metrics import DirectionMetrics
+            metrics = self.route_metrics[name] = DirectionMetrics(name)
+            self.metrics.append(metrics)
+        return metrics
+
+    def make_callback(self, device):
+        loop = self.loop
+        handle = self.handle_raw if self.raw else self.handle_message
+        if not self.metrics_interval:
+            callback = lambda message: loop.call_soon_threadsafe(handle, device, message)
+        else:
+            sample = self.routes[device][0].metrics.sample
+            callback = lambda message: loop.call_soon_threadsafe(handle, device, message, sample())
+        journal = self.journals.get(device)
+        if journal is not None:
+            callback = journal_input(journal, callback, self.raw)
+        return callback
+
+    def handle_message(self, device, message, received=0):
+        for mirror in self.routes[device]:
+            mirror.handle(message, received)
+        self.arm_flush()
+
+    def handle_raw(self, device, data, received=0):
+        # Messages other than faders are parsed once for all directions of the input
+        kind = data[0] & 0xF0
+        if kind != midi_raw.CONTROL_CHANGE and kind != midi_raw.PITCHWHEEL:
+            try:
+                message = mido.Message.from_bytes(data)
+            except ValueError:
+                log.warning('midi', "Ignoring malformed MIDI data from %s: %s", device, bytes(data).hex(' '))
+                return
+            self.handle_message(device, message, received)
+            return
+        for mirror in self.routes[device]:
+            mirror.handle_raw(data, received)
+        self.arm_flush()
+
+    def arm_flush(self):
+        # One timer for the earliest coalesced fader of all directions
+        deadline = None
+        for mirror in self.mirrors:
+            mirror_deadline = mirror.next_deadline()
+            if mirror_deadline is not None and (deadline is None or mirror_deadline < deadline):
+                deadline = mirror_deadline
+        if deadline is None or (self.flush_timer is not None and self.flush_at <= deadline):
+            return
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        self.flush_at = deadline
+        self.flush_timer = self.loop.call_later(max(0, deadline - time.monotonic()), self.flush)
+
+    def flush(self):
+        self.flush_timer = None
+        for mirror in self.mirrors:
+            mirror.flush()
+        self.arm_flush()
+
+    def resync(self, name):
+        # Called from any thread with a device or output port name
+        for device in self.devices:
+            if name in (device, self.configs[device]['midi_out_name']):
+                self.loop.call_soon_threadsafe(self.resync_device, device)
+                return True
+        return False
+
+    def resync_device(self, device):
+        return send_resync(self.writers[device], self.feeds.get(device, ()), device)
+
+    def reload(self):
+        # Called from the ConfigWatcher thread, the swap itself runs on the loop
+        try:
+            pairs = load_routing(self.devices, self.topology)
+        except Exception as e:
+            log.error('config', "Config reload failed, keeping the current config: %s", e)
+            return False
+        if pairs is None:
+            log.error('config', "Config reload failed, keeping the current config: unable to read configuration files")
+            return False
+        if pairs == self.pairs:
+            return False
+        for pair, tables in pairs.items():
+            error = validate_reload(self.pairs[pair], tables)
+            if error:
+                log.error('config', "Config reload rejected: %s", error)
+                return False
+        self.loop.call_soon_threadsafe(self.apply_pairs, pairs)
+        return True
+
+    def apply_pairs(self, pairs):
+        # Held buttons go out with the old tables before the directions are
+        # rebuilt. A rebuilt direction between the same ports keeps the NRPN
+        # selection of its input, and its pending fader values while its
+        # conversions are unchanged; any other pending value goes out now.
+        previous = {mirror.name: mirror for mirror in self.mirrors}
+        for mirror in self.mirrors:
+            for entry in mirror.buttons.release():
+                send_dispatched_messages(mirror.emit, entry)
+        self.set_pairs(pairs)
+        for device, writer in self.writers.items():
+            writer.bytes_per_second = self.configs[device]['bytes_per_second']
+            self.echoes[device].window = self.configs[device]['echo_window']
+        self.build_mirrors()
+        for mirror in self.mirrors:
+            old = previous.pop(mirror.name, None)
+            if old is None:
+                continue
+            mirror.nrpn_parser = old.nrpn_parser
+            if old.conversions == mirror.conversions:
+                old.coalescer.min_interval = mirror.coalescer.min_interval
+                mirror.coalescer = old.coalescer
+            else:
+                previous[old.name] = old
+        for mirror in previous.values():
+            for messages in mirror.coalescer.pending.values():
+                mirror.emit(messages, PRIORITY_FADER)
+        self.arm_flush()
+        log.info('config', "Reloaded config for %s", ', '.join(self.devices))
+
+    def run(self):
+        import asyncio
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        supervisor = self.supervisor = PortSupervisor()
+        port_metrics = {}
+        with contextlib.ExitStack() as ports:
+            for device in self.devices:
+                config = self.configs[device]
+                metrics = port_metrics[device] = self.get_metrics(f"-> {config['midi_out_name']}")
+                self.echoes[device] = EchoSuppressor(config['echo_window'])
+                self.states[device] = DeviceState(config['channel'])
+                if self.journal_dir is not None:
+                    journal = self.journals[device] = Journal(get_journal_path(self.journal_dir, config['midi_in_name']),
+                                                              config['midi_in_name'], config['midi_out_name'], self.journal_records)
+                    ports.callback(journal.close)
+                writer = self.writers[device] = LoopPortWriter(None, self.loop, config['bytes_per_second'], metrics, self.echoes[device],
+                                                               self.journals.get(device), self.states[device])
+                if metrics is not None:
+                    metrics.gauges['queue_depth'] = writer.depth
+                ports.callback(writer.close)
+            # Macro messages of actions are handed to the writers on the loop
+            self.executor = ActionExecutor(call=self.loop.call_soon_threadsafe, gpio=self.gpio).start()
+            self.build_mirrors()
+            if self.gpio is not None:
+                writer = self.writers[self.gpio_device]
+                self.gpio.send = lambda messages, priority: self.loop.call_soon_threadsafe(writer.send, messages, priority)
+            # Ports are opened and reopened by the supervisor, a device that
+            # goes away does not stop the others
+            ports.callback(supervisor.close)
+            for device in self.devices:
+                config = self.configs[device]
+                supervisor.add_output(config['midi_out_name'], self.writers[device],
+                                      lambda device=device: self.loop.call_soon_threadsafe(self.resync_device, device), port_metrics[device])
+                supervisor.add_input(config['midi_in_name'], self.make_callback(device), port_metrics[device], self.raw)
+            supervisor.start()
+            for source, mirrors in self.routes.items():
+                for mirror in mirrors:
+                    log.info('startup', "Mirroring MIDI from %s...", mirror.name)
+            self.ready.set()
+            await asyncio.Event().wait()
+
+def start_routing(devices, pairs, dhd_enabled, dhd_config=None, daemon=False, metrics_interval=None, topology='star', watch_configs=False, gpio_port=None,
+                  journal_dir=None, journal_records=DEFAULT_RECORDS, raw=False):
+    router = MidiRouter(devices, pairs, dhd_enabled, topology, metrics_interval, journal_dir, journal_records, raw)
+    threads = []
+
+    engine = EngineSetup(pairs, dhd_enabled, dhd_config, gpio_port, journal_dir, daemon)
+    gpio = None
+    if engine.gpio_role is not None:
+        gpio = router.set_gpio_device(engine.gpio_pair, engine.gpio_role)
+
+    if watch_configs:
+        ConfigWatcher(devices, router.reload).start()
+
+    router_thread = threading.Thread(target=router.run, daemon=daemon)
+    router_thread.start()
+    threads.append(router_thread)
+    while not router.ready.wait(0.1) and router_thread.is_alive():
+        pass
 
-    if dhd_enabled:
-        stdin_thread = threading.Thread(target=listen_to_stdin, args=(dhd_config, step_map, stdin_queue))
-        stdin_thread.start()
+    if metrics_interval:
+        from midi_metrics import MetricsReporter
+        MetricsReporter(router.metrics, metrics_interval).start()
 
-        print("DHD is enabled. Listening for updates...")
+    stdin_thread = engine.start(gpio, router.resync)
+    if stdin_thread is not None:
+        threads.append(stdin_thread)
+    return threads
 
-    threading.Thread(target=mirror_midi, args=(
-        device1_config['midi_in_name'], device2_config['midi_out_name'], 
-        {device1_config['channel']: device2_config['channel']}, nrpn_to_cc_map, cc_to_nrpn_map, button_map, step_map, dhd_enabled, stdin_queue)).start()
-    
-    threading.Thread(target=mirror_midi, args=(
-        device2_config['midi_in_name'], device1_config['midi_out_name'], 
-        {device2_config['channel']: device1_config['channel']}, nrpn_to_cc_map, cc_to_nrpn_map, button_map, step_map, dhd_enabled, stdin_queue)).start()
-        
 if __name__ == "__main__":
     main()
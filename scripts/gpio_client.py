@@ -0,0 +1,38 @@
+import socket
+import sys
+
+# Stand-in for the C# host's GpioChannel, for tests and benchmarks. Sends DHD
+# GPIO codes to MIDI_MIrror.py started with --gpio-port, in the same frames:
+# one count byte followed by count (gpio, state) byte pairs.
+#
+#   python scripts/gpio_client.py 4647 2A01 2A00
+
+MAX_CODES_PER_FRAME = 255
+
+def encode_frame(codes):
+    frame = bytearray([len(codes)])
+    for code in codes:
+        frame += bytes.fromhex(code)
+    return bytes(frame)
+
+
+class GpioClient:
+    def __init__(self, port, host='127.0.0.1'):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, codes):
+        for start in range(0, len(codes), MAX_CODES_PER_FRAME):
+            self.socket.sendall(encode_frame(codes[start:start + MAX_CODES_PER_FRAME]))
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: gpio_client.py <port> <code> [<code> ...]")
+        sys.exit(1)
+    client = GpioClient(int(sys.argv[1]))
+    client.send(sys.argv[2:])
+    client.close()
@@ -0,0 +1,166 @@
+from array import array
+import mido
+import midi_raw
+from midi_log import log
+
+# Fader value conversion between two devices. Every fader pair (same id on
+# both devices) is compiled once into a lookup table indexed by the raw
+# value the source sends, 128 entries for a control change and 16384 for an
+# NRPN or pitchbend fader, holding the raw value for the target. Range,
+# taper, inversion and resolution are all folded into that table, so a
+# converted move costs one index plus picking prebuilt messages.
+#
+# Optional settings of a <fader> (attribute or child element):
+#   min_value, max_value  raw range the fader uses, default the full range;
+#                         a max below min inverts the fader
+#   taper                 how the value follows the fader position, value =
+#                         position ** taper; a number or one of TAPERS
+#   invert                true when the top of the fader sends the minimum
+# A pitchbend fader has its MIDI channel as value.
+#
+# convert() returns mido messages, convert_raw() the same group as bytes for
+# the raw fast path (see midi_raw).
+
+RESOLUTIONS = {'control_change': 128, 'NRPN': 16384, 'pitchbend': 16384}
+
+TAPERS = {'linear': 1.0, 'log': 2.0, 'exp': 0.5}
+
+PITCHBEND_CENTER = 8192
+
+
+def get_taper(setting):
+    taper = TAPERS.get(setting)
+    if taper is None:
+        taper = float(setting)
+    if taper <= 0:
+        raise ValueError(f"taper must be positive: {setting}")
+    return taper
+
+
+def get_fader_range(fader):
+    top = RESOLUTIONS[fader['type']] - 1
+    return fader.get('min_value', 0), fader.get('max_value', top)
+
+
+def check_fader_range(fader):
+    # Raises ValueError for a min_value or max_value the fader cannot send,
+    # which would not fit the lookup table
+    resolution = RESOLUTIONS.get(fader['type'])
+    if resolution is None:
+        return
+    for option in ('min_value', 'max_value'):
+        value = fader.get(option)
+        if value is not None and not 0 <= value < resolution:
+            raise ValueError(f"{option} {value} is outside 0-{resolution - 1} for a {fader['type']} fader")
+
+
+def build_value_table(source, target):
+    source_min, source_max = get_fader_range(source)
+    target_min, target_max = get_fader_range(target)
+    source_low, source_high = min(source_min, source_max), max(source_min, source_max)
+    source_span = source_max - source_min
+    target_span = target_max - target_min
+    source_curve = 1 / source.get('taper', 1.0)
+    target_curve = target.get('taper', 1.0)
+    invert = source.get('invert', False) != target.get('invert', False)
+
+    table = array('B' if RESOLUTIONS[target['type']] == 128 else 'H')
+    for value in range(RESOLUTIONS[source['type']]):
+        value = min(max(value, source_low), source_high)
+        fraction = (value - source_min) / source_span if source_span else 0.0
+        position = fraction ** source_curve
+        if invert:
+            position = 1.0 - position
+        table.append(target_min + round(position ** target_curve * target_span))
+    return table
+
+
+class FaderConversion:
+    # One fader of the source device mapped onto the target. convert() takes
+    # the raw source value and returns the messages for the target; the
+    # subclasses differ only in how a raw target value is put on the wire.
+    def __init__(self, source, target, channel):
+        self.spec = (source, target, channel)
+        self.table = build_value_table(source, target)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.spec == other.spec
+
+    __hash__ = None
+
+
+class ControlChangeConversion(FaderConversion):
+    def __init__(self, source, target, channel):
+        super().__init__(source, target, channel)
+        self.outputs = tuple((mido.Message('control_change', control=target['value'], value=value, channel=channel),)
+                             for value in range(128))
+        self.raw_outputs = tuple(midi_raw.control_change(channel, target['value'], value) for value in range(128))
+
+    def convert(self, value):
+        return self.outputs[self.table[value]]
+
+    def convert_raw(self, value):
+        return self.raw_outputs[self.table[value]]
+
+
+class NrpnConversion(FaderConversion):
+    def __init__(self, source, target, channel):
+        super().__init__(source, target, channel)
+        number = target['value']
+        self.select = (mido.Message('control_change', control=99, value=(number >> 7) & 0x7F, channel=channel),
+                       mido.Message('control_change', control=98, value=number & 0x7F, channel=channel))
+        self.data_msb = tuple(mido.Message('control_change', control=6, value=value, channel=channel) for value in range(128))
+        self.data_lsb = tuple(mido.Message('control_change', control=38, value=value, channel=channel) for value in range(128))
+        self.template = midi_raw.nrpn_template(channel, number)
+
+    def convert(self, value):
+        value = self.table[value]
+        return self.select + (self.data_msb[value >> 7], self.data_lsb[value & 0x7F])
+
+    def convert_raw(self, value):
+        # A fresh copy, the group may still be queued when the next move comes in
+        value = self.table[value]
+        data = bytearray(self.template)
+        data[8] = value >> 7
+        data[11] = value & 0x7F
+        return data
+
+
+class PitchbendConversion(FaderConversion):
+    def __init__(self, source, target, channel):
+        super().__init__(source, target, channel)
+        self.channel = target['value']
+
+    def convert(self, value):
+        return (mido.Message('pitchwheel', channel=self.channel, pitch=self.table[value] - PITCHBEND_CENTER),)
+
+    def convert_raw(self, value):
+        return midi_raw.pitchwheel(self.channel, self.table[value])
+
+
+CONVERSIONS = {'control_change': ControlChangeConversion, 'NRPN': NrpnConversion, 'pitchbend': PitchbendConversion}
+
+
+def get_source_key(fader):
+    # How MirrorDirection looks the fader up: CC and NRPN faders by number on
+    # any channel, pitchbend faders by their channel
+    if fader['type'] == 'control_change':
+        return ('control_change', fader['value'])
+    if fader['type'] == 'NRPN':
+        return ('nrpn', fader['value'])
+    return ('pitchwheel', fader['value'])
+
+
+def build_conversions(source_config, target_config):
+    # Returns {source key: FaderConversion} for the faders both devices have
+    conversions = {}
+    for fader_id, fader in source_config['faders'].items():
+        target = target_config['faders'].get(fader_id)
+        if target is None:
+            continue
+        if fader['type'] not in RESOLUTIONS or target['type'] not in RESOLUTIONS:
+            log.warning('config', "Fader %d: unsupported fader type %s", fader_id,
+                        fader['type'] if fader['type'] not in RESOLUTIONS else target['type'])
+            continue
+        conversions[get_source_key(fader)] = CONVERSIONS[target['type']](fader, target, target_config['channel'])
+    return conversions
@@ -0,0 +1,228 @@
+import argparse
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+# Session journal for one input/output port pair. Every message read from the
+# input and written to the output is stored as its raw bytes with a
+# time.monotonic_ns() timestamp in a fixed-size ring inside a memory-mapped
+# file, so a crash or a hard stop still leaves the last capacity messages on
+# disk. Recording packs one fixed-size slot in place: no formatting, no I/O
+# and no lock, the slot index comes from a shared counter so the backend
+# thread (inbound) and the writer (outbound) can both record.
+#
+#   python scripts/midi_journal.py dump journals/QU-16_MIDI_In_0.journal
+#   python scripts/midi_journal.py replay journals/QU-16_MIDI_In_0.journal Q16 Xtouch-One --speed 4
+
+MAGIC = b'MIDIJRNL'
+VERSION = 1
+HEADER_SIZE = 4096
+HEADER = struct.Struct('<8sIIII')
+# sequence, timestamp, tag, message length, up to three message bytes
+RECORD = struct.Struct('<QQBBBBB3x')
+
+JOURNAL_IN = 0
+JOURNAL_OUT = 1
+TAG_NAMES = {JOURNAL_IN: 'in', JOURNAL_OUT: 'out'}
+
+DEFAULT_RECORDS = 65536
+
+# Status and data fields of the channel messages, so record() packs a mido
+# message from its attributes without encoding it
+CHANNEL_MESSAGES = {
+    'note_off': (0x80, 'note', 'velocity'),
+    'note_on': (0x90, 'note', 'velocity'),
+    'polytouch': (0xA0, 'note', 'value'),
+    'control_change': (0xB0, 'control', 'value'),
+    'program_change': (0xC0, 'program', None),
+    'aftertouch': (0xD0, 'value', None),
+}
+
+
+def get_journal_path(directory, port_name):
+    return os.path.join(directory, re.sub(r'[^\w.-]+', '_', port_name) + '.journal')
+
+
+class Journal:
+    def __init__(self, path, input_name, output_name, records=DEFAULT_RECORDS):
+        self.path = path
+        self.records = records
+        self.sequence = itertools.count(1)
+        info = json.dumps({'input': input_name, 'output': output_name, 'opened': time.time(),
+                           'opened_ns': time.monotonic_ns()}).encode()
+        if HEADER.size + 4 + len(info) > HEADER_SIZE:
+            raise ValueError("journal port names are too long")
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        size = HEADER_SIZE + records * RECORD.size
+        # The journal of the previous run is what a crash leaves behind, keep it
+        if os.path.exists(path):
+            os.replace(path, path + '.1')
+        with open(path, 'w+b') as journal_file:
+            journal_file.truncate(size)
+            self.buffer = mmap.mmap(journal_file.fileno(), size)
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, RECORD.size, records, HEADER_SIZE)
+        struct.pack_into(f'<I{len(info)}s', self.buffer, HEADER.size, len(info), info)
+
+    def record(self, tag, message):
+        fields = CHANNEL_MESSAGES.get(message.type)
+        if fields is not None:
+            status, first, second = fields
+            if second is None:
+                self._pack(tag, 2, status | message.channel, getattr(message, first), 0)
+            else:
+                self._pack(tag, 3, status | message.channel, getattr(message, first), getattr(message, second))
+        elif message.type == 'pitchwheel':
+            pitch = message.pitch + 8192
+            self._pack(tag, 3, 0xE0 | message.channel, pitch & 0x7F, pitch >> 7)
+        else:
+            # System messages and sysex are rare, those are encoded
+            self.record_bytes(tag, message.bytes())
+
+    def record_bytes(self, tag, data):
+        # data is bytes or the list of ints a raw input gets from the backend
+        size = len(data)
+        if size == 3:
+            first, second, third = data
+        elif size == 2:
+            first, second = data
+            third = 0
+        elif size == 1:
+            first, second, third = data[0], 0, 0
+        else:
+            # Sysex keeps its first bytes and true length
+            first, second, third = data[0], data[1], data[2]
+        self._pack(tag, size, first, second, third)
+
+    def _pack(self, tag, size, first, second, third):
+        sequence = next(self.sequence)
+        RECORD.pack_into(self.buffer, HEADER_SIZE + (sequence % self.records) * RECORD.size,
+                         sequence, time.monotonic_ns(), tag, min(size, 255), first, second, third)
+
+    def close(self):
+        buffer, self.buffer = self.buffer, None
+        if buffer is not None:
+            buffer.flush()
+            buffer.close()
+
+
+def read_journal(path):
+    # Returns (info, [(timestamp_ns, tag, bytes)]) oldest first. A sysex
+    # message is returned with the bytes that fit, check its length.
+    with open(path, 'rb') as journal_file:
+        content = journal_file.read()
+    magic, version, record_size, records, header_size = HEADER.unpack_from(content, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a journal of this version")
+    length, = struct.unpack_from('<I', content, HEADER.size)
+    info = json.loads(content[HEADER.size + 4:HEADER.size + 4 + length])
+    entries = []
+    for sequence, timestamp, tag, size, *data in RECORD.iter_unpack(content[header_size:header_size + records * record_size]):
+        if sequence:
+            entries.append((sequence, timestamp, tag, bytes(data[:size])))
+    entries.sort()
+    return info, [(timestamp, tag, data) for _, timestamp, tag, data in entries]
+
+
+def load_journal_events(path, source_names):
+    # Inbound messages as (seconds from the first, source, mido message
+    # string), the session format of the benchmarks. source_names maps
+    # input port names to sources.
+    import mido
+
+    info, entries = read_journal(path)
+    source = source_names.get(info['input'])
+    if source is None:
+        raise ValueError(f"{path} was recorded from {info['input']}, which is not one of the devices")
+    events = []
+    start = None
+    for timestamp, tag, data in entries:
+        if tag != JOURNAL_IN or data[:1] == b'\xf0':
+            continue
+        if start is None:
+            start = timestamp
+        events.append(((timestamp - start) / 1e9, source, str(mido.Message.from_bytes(data))))
+    return events
+
+
+def replay(path, device1, device2, speed=1.0, emit=None):
+    # Feeds the inbound messages of a journal through the conversion of the
+    # direction they were recorded on, with the original timing divided by
+    # speed (0 is as fast as possible). emit(messages, priority) receives
+    # the output, by default it is printed.
+    import mido
+    import MIDI_MIrror
+
+    tables = MIDI_MIrror.load_device_pair(device1, device2)
+    if tables is None:
+        raise ValueError(f"unable to load the configs of {device1} and {device2}")
+    names = {tables['device1']['midi_in_name']: 'device1', tables['device2']['midi_in_name']: 'device2'}
+    events = load_journal_events(path, names)
+    direction = events[0][1] if events else 'device1'
+    target = tables['device2' if direction == 'device1' else 'device1']
+    if emit is None:
+        start = time.monotonic()
+        def emit(messages, priority):
+            for message in messages:
+                print(f"{time.monotonic() - start:10.6f} {message}")
+
+    mirror = MIDI_MIrror.MirrorDirection(emit, tables['conversions'][direction], tables['button_notes'], tables['button_dispatch'], False,
+                                         fader_interval=target['fader_interval'], direction=direction, name=path,
+                                         pair_window=tables[direction]['pair_window'], debounce=tables[direction]['button_debounce'])
+    start = time.monotonic()
+    for offset, _, message in events:
+        if speed:
+            delay = start + offset / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        mirror.handle(mido.Message.from_str(message))
+    # Let the last coalesced fader values out
+    deadline = mirror.next_deadline()
+    while deadline is not None:
+        time.sleep(max(0, deadline - time.monotonic()))
+        mirror.flush()
+        deadline = mirror.next_deadline()
+    return len(events)
+
+
+def dump(path):
+    import mido
+
+    info, entries = read_journal(path)
+    print(f"{info['input']} -> {info['output']}, {len(entries)} messages")
+    for timestamp, tag, data in entries:
+        # Wall clock time from the monotonic stamp taken when the journal was opened
+        stamp = info['opened'] + (timestamp - info['opened_ns']) / 1e9
+        try:
+            message = mido.Message.from_bytes(data)
+        except ValueError:
+            message = data.hex(' ')
+        print(f"{time.strftime('%H:%M:%S', time.localtime(stamp))}.{int(stamp % 1 * 1e6):06d} {TAG_NAMES.get(tag, tag):>3} {message}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or replay a MIDI session journal.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    dump_parser = commands.add_parser('dump', help="print every recorded message")
+    dump_parser.add_argument('journal')
+    replay_parser = commands.add_parser('replay', help="feed the recorded input through the conversion again")
+    replay_parser.add_argument('journal')
+    replay_parser.add_argument('device1', help="first device of the pair, as passed to MIDI_MIrror.py")
+    replay_parser.add_argument('device2')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="playback speed, 0 for as fast as possible")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'dump':
+        dump(args.journal)
+    else:
+        replay(args.journal, args.device1, args.device2, args.speed)
@@ -0,0 +1,154 @@
+import atexit
+import sys
+import threading
+import time
+from collections import deque
+
+# Non-blocking logging for the mirror. Callers on the MIDI threads only
+# append a record to an in-memory ring buffer; a background thread formats
+# the records and writes them to stdout, so a slow reader on the C# side
+# never holds up a message. When the buffer is full the oldest records are
+# dropped and counted, and each category is rate limited so a stream of
+# repeated events (an unknown GPIO code, a button burst) cannot flood the
+# output.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+
+class Logger:
+    def __init__(self, capacity=4096, level=INFO, rate_limit=50, rate_limits=None, structured=False, stream=None, linger=0.01):
+        self.level = level
+        self.linger = linger
+        # Records per category and second, rate_limits overrides single categories
+        self.rate_limit = rate_limit
+        self.rate_limits = dict(rate_limits or {})
+        self.structured = structured
+        self.stream = stream
+        self.records = deque(maxlen=capacity)
+        self.windows = {}
+        self.dropped = 0
+        self.rate_limited = 0
+        self.reported_drops = 0
+        self.wakeup = threading.Event()
+        self.drain_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+
+    def configure(self, level=None, structured=None):
+        if level is not None:
+            self.level = level
+        if structured is not None:
+            self.structured = structured
+
+    def log(self, level, category, message, *args):
+        if level < self.level:
+            return
+        now = time.time()
+        window = self.windows.get(category)
+        if window is None or now - window[0] >= 1.0:
+            suppressed = window[2] if window is not None else 0
+            window = self.windows[category] = [now, 0, 0]
+            if suppressed:
+                self._append((now, WARNING, category, "%d more '%s' messages were rate limited", (suppressed, category)))
+        limit = self.rate_limits.get(category, self.rate_limit)
+        if limit and window[1] >= limit:
+            window[2] += 1
+            self.rate_limited += 1
+            return
+        window[1] += 1
+        self._append((now, level, category, message, args))
+
+    def debug(self, category, message, *args):
+        self.log(DEBUG, category, message, *args)
+
+    def info(self, category, message, *args):
+        self.log(INFO, category, message, *args)
+
+    def warning(self, category, message, *args):
+        self.log(WARNING, category, message, *args)
+
+    def error(self, category, message, *args):
+        self.log(ERROR, category, message, *args)
+
+    def write(self, text):
+        # Output formatted elsewhere (a direction process, the metrics
+        # reporter), written as is with the next drain. Not level filtered or
+        # rate limited, but dropped like any record when the buffer is full.
+        self._append((time.time(), None, None, text, ()))
+
+    def flush(self):
+        # Writes out everything buffered so far on the calling thread
+        self._drain()
+
+    def _append(self, record):
+        records = self.records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append(record)
+        if self.thread is None:
+            self._start()
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def _start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def format(self, record):
+        timestamp, level, category, message, args = record
+        if level is None:
+            return message
+        if args:
+            message = message % args
+        if not self.structured:
+            return message
+        import json
+        return json.dumps({'type': 'log', 'time': timestamp, 'level': LEVEL_NAMES.get(level, level),
+                           'category': category, 'message': message})
+
+    def _drain(self):
+        with self.drain_lock:
+            lines = []
+            records = self.records
+            while records:
+                try:
+                    record = records.popleft()
+                except IndexError:
+                    break
+                try:
+                    lines.append(self.format(record))
+                except Exception as e:
+                    lines.append(f"Unable to format log record {record[3]!r}: {e}")
+            dropped = self.dropped
+            if dropped != self.reported_drops:
+                lines.append(self.format((time.time(), WARNING, 'log', "%d log records dropped, the log buffer was full",
+                                          (dropped - self.reported_drops,))))
+                self.reported_drops = dropped
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            # Let a burst collect so it goes out in one write
+            time.sleep(self.linger)
+            self.wakeup.clear()
+            try:
+                self._drain()
+            except (OSError, ValueError):
+                # stdout went away (host closed the pipe), nothing left to write to
+                return
+
+
+log = Logger()
+atexit.register(log.flush)
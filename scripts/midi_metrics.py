@@ -0,0 +1,221 @@
+import itertools
+import json
+import math
+import threading
+import time
+from array import array
+
+from midi_log import log
+
+# Hot path instrumentation for mirror_midi. Everything here is optional: the
+# pipeline only touches it behind an "if metrics is not None" check, so a
+# disabled run pays nothing. Counters are exact; stage durations are taken for
+# one message in sample_every and recorded in nanoseconds into power-of-two
+# buckets, which keeps the average cost per message to a counter increment
+# plus a fraction of the clock reads.
+
+BUCKETS = 64
+
+STAGES = ('input', 'nrpn', 'convert', 'button', 'queue', 'send')
+COUNTERS = ('messages_in', 'messages_out', 'throttled', 'echoes', 'redundant', 'superseded', 'unknown')
+
+
+class Histogram:
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+
+    def record(self, duration_ns):
+        self.counts[duration_ns.bit_length()] += 1
+
+    def take(self):
+        # Swap in a fresh bucket list; a sample racing the swap is lost, which
+        # is fine for a periodic report
+        counts, self.counts = self.counts, [0] * BUCKETS
+        return counts
+
+
+def summarize(counts):
+    # Percentiles are reported as the upper bound of their bucket
+    total = sum(counts)
+    if not total:
+        return {'count': 0}
+    summary = {'count': total}
+    seen = 0
+    buckets = iter(enumerate(counts))
+    for name, fraction in (('p50_us', 0.5), ('p95_us', 0.95), ('p99_us', 0.99)):
+        while seen < fraction * total:
+            bucket, count = next(buckets)
+            seen += count
+        summary[name] = (1 << bucket) / 1000
+    top = max(bucket for bucket, count in enumerate(counts) if count)
+    summary['max_us'] = (1 << top) / 1000
+    return summary
+
+
+class DirectionMetrics:
+    def __init__(self, name, sample_every=16):
+        self.name = name
+        # Power of two so sampling is a single mask test
+        self.sample_mask = (1 << max(0, int(sample_every) - 1).bit_length()) - 1
+        self.ticks = itertools.count(1)
+        self.messages_in = 0
+        self.messages_out = 0
+        self.throttled = 0
+        self.echoes = 0
+        self.redundant = 0
+        self.superseded = 0
+        self.unknown = 0
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.input = self.stages['input']
+        self.nrpn = self.stages['nrpn']
+        self.convert = self.stages['convert']
+        self.button = self.stages['button']
+        self.queue = self.stages['queue']
+        self.send = self.stages['send']
+        self.gauges = {}
+
+    def sample(self):
+        # Returns a start timestamp for the messages that get timed, else 0.
+        # Called from the backend callback and the writer thread, next() on
+        # a count is atomic so both can share it.
+        if next(self.ticks) & self.sample_mask:
+            return 0
+        return time.perf_counter_ns()
+
+    def snapshot(self):
+        snapshot = {counter: getattr(self, counter) for counter in COUNTERS}
+        for gauge, read in self.gauges.items():
+            snapshot[gauge] = read()
+        snapshot['stages'] = {stage: summarize(histogram.take()) for stage, histogram in self.stages.items()}
+        return snapshot
+
+
+NAN = float('nan')
+
+# Gauges a direction in another process publishes next to its counters
+SHARED_GAUGES = ('queue_depth', 'pending_faders', 'recover_ms')
+
+SHARED_LAYOUT = (('counters', 'q', len(COUNTERS)), ('stages', 'q', len(STAGES) * BUCKETS),
+                 ('gauges', 'd', len(SHARED_GAUGES)))
+
+
+class SharedHistogram(Histogram):
+    # Histogram over a slice of shared memory, filled by the process running
+    # the direction and taken by the one reporting it
+    __slots__ = ()
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def take(self):
+        counts = self.counts.tolist()
+        self.counts[:] = array('q', [0]) * BUCKETS
+        return counts
+
+
+class SharedDirectionMetrics(DirectionMetrics):
+    # DirectionMetrics for --engine processes. Counters and stage histograms
+    # live in a midi_shared.SharedArrays block of SHARED_LAYOUT, so the
+    # direction's process updates them in place and the main process
+    # reports them. Gauges are callables in the direction's process only;
+    # publish() copies their values over for the report.
+    def __init__(self, name, arrays, sample_every=16):
+        self.arrays = arrays
+        super().__init__(name, sample_every)
+        self.stages = {stage: SharedHistogram(arrays.slice('stages', index * BUCKETS, (index + 1) * BUCKETS))
+                       for index, stage in enumerate(STAGES)}
+        self.input = self.stages['input']
+        self.nrpn = self.stages['nrpn']
+        self.convert = self.stages['convert']
+        self.button = self.stages['button']
+        self.queue = self.stages['queue']
+        self.send = self.stages['send']
+
+    def publish(self):
+        gauges = self.arrays.gauges
+        for index, gauge in enumerate(SHARED_GAUGES):
+            read = self.gauges.get(gauge)
+            value = read() if read is not None else None
+            gauges[index] = NAN if value is None else value
+
+    def snapshot(self):
+        snapshot = {counter: getattr(self, counter) for counter in COUNTERS}
+        for index, gauge in enumerate(SHARED_GAUGES):
+            value = self.arrays.gauges[index]
+            if not math.isnan(value):
+                snapshot[gauge] = int(value) if value.is_integer() else value
+        snapshot['stages'] = {stage: summarize(histogram.take()) for stage, histogram in self.stages.items()}
+        return snapshot
+
+
+def make_shared_counter(index):
+    def get(self):
+        return self.arrays.counters[index]
+    def set(self, value):
+        self.arrays.counters[index] = value
+    return property(get, set)
+
+for index, counter in enumerate(COUNTERS):
+    setattr(SharedDirectionMetrics, counter, make_shared_counter(index))
+
+
+class MetricsPublisher:
+    # Runs in the process of a direction and keeps the shared gauges of its
+    # metrics current for the reporter in the main process
+    def __init__(self, directions, interval=5.0):
+        self.directions = directions
+        self.interval = interval
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            for direction in self.directions:
+                direction.publish()
+            time.sleep(min(self.interval, 1.0))
+
+
+class MetricsReporter:
+    # Writes one JSON line per interval, {"type": "metrics", ...}, which the
+    # C# host receives along with the rest of stdout. Without a stream the
+    # line goes through the log, whose drain thread does the writing.
+    def __init__(self, directions, interval=5.0, stream=None):
+        self.directions = directions
+        self.interval = interval
+        self.stream = stream
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        # No report after this, for metrics in shared memory that is going away
+        with self.lock:
+            self.closed = True
+
+    def report(self):
+        record = {
+            'type': 'metrics',
+            'time': time.time(),
+            'interval': self.interval,
+            'directions': {direction.name: direction.snapshot() for direction in self.directions},
+        }
+        if self.stream is None:
+            log.write(json.dumps(record))
+            return
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.closed:
+                    return
+                self.report()
@@ -0,0 +1,57 @@
+import mido
+
+# Raw byte access to the MIDI ports for the --raw fast path. Fader moves are
+# read as the status and data bytes the backend received and written as
+# prebuilt byte groups, so no mido.Message is built, validated or encoded on
+# the way. A raw group is a bytes or bytearray of complete three byte channel
+# messages; anything else keeps going through mido messages.
+#
+# python-rtmidi is used directly under mido's rtmidi backend (the port's
+# MidiIn/MidiOut), midi_sim has raw hooks of its own and any other backend
+# falls back to converting at the port.
+
+RAW_GROUP = (bytes, bytearray)
+
+CONTROL_CHANGE = 0xB0
+PITCHWHEEL = 0xE0
+
+
+def open_raw_input(name, callback):
+    # callback(data) gets each message as a sequence of ints, a list from rtmidi
+    port = mido.open_input(name)
+    rt = getattr(port, '_rt', None)
+    if rt is not None:
+        # python-rtmidi passes ([status, data...], delta time) and a user argument
+        rt.set_callback(lambda event, data: callback(event[0]))
+    elif hasattr(port, 'raw_callback'):
+        port.raw_callback = callback
+    else:
+        port.callback = lambda message: callback(message.bytes())
+    return port
+
+
+def get_raw_send(port):
+    # Returns send(data) writing one message given as bytes to an open output
+    rt = getattr(port, '_rt', None)
+    if rt is not None:
+        return rt.send_message
+    send_bytes = getattr(port, 'send_bytes', None)
+    if send_bytes is not None:
+        return send_bytes
+    return lambda data: port.send(mido.Message.from_bytes(data))
+
+
+def control_change(channel, control, value):
+    return bytes((CONTROL_CHANGE | channel, control, value))
+
+
+def nrpn_template(channel, number):
+    # CC 99/98 select and CC 6/38 data entry, the two data bytes (index 8
+    # and 11) are patched in with the value
+    status = CONTROL_CHANGE | channel
+    return bytes((status, 99, (number >> 7) & 0x7F, status, 98, number & 0x7F, status, 6, 0, status, 38, 0))
+
+
+def pitchwheel(channel, value):
+    # value is the unsigned 14-bit pitch, 0 to 16383
+    return bytes((PITCHWHEEL | channel, value & 0x7F, value >> 7))
@@ -0,0 +1,122 @@
+import struct
+import threading
+import time
+from array import array
+from multiprocessing import shared_memory
+
+# Shared memory for --engine processes, where each direction runs in a
+# process of its own. SharedArrays holds the typed arrays the processes
+# share (device state, echo values, metric counters) in one block; the
+# processes attach to it by name when it is unpickled, so it can be passed
+# to multiprocessing.Process as is. RingQueue moves commands and log output
+# between two processes without a lock on the data path.
+
+
+class SharedArrays:
+    # layout is a list of (field, typecode, length); every field is an
+    # attribute holding a memoryview of that type, used like an array.
+    def __init__(self, layout, fill=0, name=None):
+        self.layout = tuple(layout)
+        offsets = []
+        size = 0
+        for field, typecode, length in self.layout:
+            # Fields start on an 8 byte boundary so the views can be cast
+            size = (size + 7) & ~7
+            offsets.append(size)
+            size += struct.calcsize(typecode) * length
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=max(size, 1))
+        self.name = self.memory.name
+        self.views = []
+        for (field, typecode, length), offset in zip(self.layout, offsets):
+            view = self.memory.buf[offset:offset + struct.calcsize(typecode) * length].cast(typecode)
+            if self.owner:
+                view[:] = array(typecode, [fill]) * length
+            self.views.append(view)
+            setattr(self, field, view)
+
+    def __reduce__(self):
+        return (SharedArrays, (self.layout, 0, self.name))
+
+    def slice(self, field, start, stop):
+        # A view of part of a field; the block can only be closed once all
+        # views are released, so they are taken through here
+        view = getattr(self, field)[start:stop]
+        self.views.append(view)
+        return view
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class RingQueue:
+    # Single producer, single consumer queue of byte records in shared
+    # memory. The producer only ever writes the tail and the consumer the
+    # head, each after its slot is complete, so neither side takes a lock.
+    # put() rings doorbell, a multiprocessing.Semaphore the consumer waits on
+    # instead of polling; several rings may share one doorbell.
+    HEADER = struct.Struct('<QQ')
+    LENGTH = struct.Struct('<H')
+
+    def __init__(self, doorbell, capacity=256, slot_size=512, name=None):
+        self.doorbell = doorbell
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.payload_size = slot_size - self.LENGTH.size
+        self.owner = name is None
+        size = self.HEADER.size + capacity * slot_size
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.name = self.memory.name
+        self.buffer = self.memory.buf
+        if self.owner:
+            self.HEADER.pack_into(self.buffer, 0, 0, 0)
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        return (RingQueue, (self.doorbell, self.capacity, self.slot_size, self.name))
+
+    def put(self, data):
+        # Returns False when the ring is full. Records longer than a slot
+        # must be split by the caller (see payload_size). The lock only
+        # keeps threads of the producing process apart.
+        with self.lock:
+            head, tail = self.HEADER.unpack_from(self.buffer, 0)
+            if tail - head >= self.capacity:
+                return False
+            offset = self.HEADER.size + (tail % self.capacity) * self.slot_size
+            self.LENGTH.pack_into(self.buffer, offset, len(data))
+            self.buffer[offset + self.LENGTH.size:offset + self.LENGTH.size + len(data)] = data
+            struct.pack_into('<Q', self.buffer, 8, tail + 1)
+        self.doorbell.release()
+        return True
+
+    def get(self):
+        # Returns the oldest record, or None when the ring is empty
+        head, tail = self.HEADER.unpack_from(self.buffer, 0)
+        if head == tail:
+            return None
+        offset = self.HEADER.size + (head % self.capacity) * self.slot_size
+        length, = self.LENGTH.unpack_from(self.buffer, offset)
+        data = bytes(self.buffer[offset + self.LENGTH.size:offset + self.LENGTH.size + length])
+        struct.pack_into('<Q', self.buffer, 0, head + 1)
+        return data
+
+    def put_wait(self, data, timeout=1.0):
+        # put() for callers that can afford to wait for the consumer
+        deadline = time.monotonic() + timeout
+        while not self.put(data):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def close(self):
+        self.buffer.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
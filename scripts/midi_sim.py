@@ -0,0 +1,156 @@
+import threading
+import time
+from mido import Message
+from mido.ports import BaseInput, BaseOutput
+
+# Simulated mido backend used by the benchmarks. Select it with
+# mido.set_backend('midi_sim') with this directory on sys.path, register the
+# port names with add_device() and drive the inputs with inject(), or with
+# inject_group() for messages a device sends back to back (an NRPN sequence).
+# disconnect() unplugs a port like a USB glitch would: it leaves the port
+# list, open inputs stop delivering and open outputs raise on send, even after
+# connect() brings the device back, so the port has to be reopened.
+#
+# Raw ports (midi_raw) get the bytes of each message: set raw_callback on an
+# input, call send_bytes() on an output; output listeners added with raw=True
+# are called with bytes for either kind of send.
+
+_lock = threading.Lock()
+_devices = {}
+_inputs = {}
+_output_listeners = {}
+_echoes = {}
+_unplugged = {}
+_generations = {}
+# Input name -> lock that keeps groups sent to it from interleaving, the way
+# a device's single MIDI out does
+_senders = {}
+
+def add_device(name, is_input=True, is_output=True):
+    with _lock:
+        _devices[name] = {'name': name, 'is_input': is_input, 'is_output': is_output}
+
+def disconnect(name):
+    with _lock:
+        device = _devices.pop(name, None)
+        if device is not None:
+            _unplugged[name] = device
+        _inputs.pop(name, None)
+        _generations[name] = _generations.get(name, 0) + 1
+
+def connect(name):
+    with _lock:
+        device = _unplugged.pop(name, None)
+        if device is not None:
+            _devices[name] = device
+
+def reset():
+    with _lock:
+        _devices.clear()
+        _inputs.clear()
+        _output_listeners.clear()
+        _echoes.clear()
+        _unplugged.clear()
+        _generations.clear()
+        _senders.clear()
+
+def add_output_listener(name, listener, raw=False):
+    # listener(message, timestamp) is called on the sending thread, with the
+    # message as bytes for a raw listener
+    with _lock:
+        _output_listeners.setdefault(name, []).append((listener, raw))
+
+def add_echo(output_name, input_name, types=('control_change',)):
+    # Messages of the given types sent to output_name come straight back on
+    # input_name, the way a motorized fader reports the position it was moved
+    # to. An NRPN sequence comes back once its CC 38 arrived, as one group.
+    with _lock:
+        _echoes.setdefault(output_name, []).append((input_name, types, []))
+
+def inject(name, message):
+    return inject_group(name, (message,))
+
+def inject_group(name, messages):
+    with _lock:
+        ports = list(_inputs.get(name, ()))
+        sender = _senders.setdefault(name, threading.Lock())
+    timestamp = time.perf_counter()
+    with sender:
+        for message in messages:
+            for port in ports:
+                port._deliver(message)
+    return timestamp
+
+def _echo(output_name, message):
+    for input_name, types, pending in _echoes.get(output_name, ()):
+        if message.type not in types:
+            continue
+        if message.type == 'control_change' and message.control in (99, 98, 6):
+            pending.append(message)
+            continue
+        group = pending + [message]
+        pending.clear()
+        inject_group(input_name, group)
+
+def get_devices(**kwargs):
+    with _lock:
+        return [dict(device) for device in _devices.values()]
+
+
+class Input(BaseInput):
+    def _open(self, callback=None, **kwargs):
+        device = _devices.get(self.name)
+        if device is None or not device['is_input']:
+            raise OSError(f'unknown input port {self.name!r}')
+        self.callback = callback
+        self.raw_callback = None
+        with _lock:
+            _inputs.setdefault(self.name, []).append(self)
+
+    def _close(self):
+        with _lock:
+            ports = _inputs.get(self.name, [])
+            if self in ports:
+                ports.remove(self)
+
+    def _deliver(self, message):
+        if self.raw_callback is not None:
+            self.raw_callback(message.bytes())
+            return
+        callback = self.callback
+        if callback is not None:
+            callback(message)
+        else:
+            with self._lock:
+                self._messages.append(message)
+
+
+class Output(BaseOutput):
+    def _open(self, **kwargs):
+        device = _devices.get(self.name)
+        if device is None or not device['is_output']:
+            raise OSError(f'unknown output port {self.name!r}')
+        self._generation = _generations.get(self.name, 0)
+
+    def _send(self, message):
+        if _generations.get(self.name, 0) != self._generation:
+            raise OSError(f'output port {self.name!r} was disconnected')
+        timestamp = time.perf_counter()
+        for listener, raw in _output_listeners.get(self.name, ()):
+            listener(message.bytes() if raw else message, timestamp)
+        _echo(self.name, message)
+
+    def send_bytes(self, data):
+        if self.closed or _generations.get(self.name, 0) != self._generation:
+            raise OSError(f'output port {self.name!r} was disconnected')
+        timestamp = time.perf_counter()
+        message = None
+        for listener, raw in _output_listeners.get(self.name, ()):
+            if raw:
+                listener(data, timestamp)
+            else:
+                if message is None:
+                    message = Message.from_bytes(data)
+                listener(message, timestamp)
+        if _echoes.get(self.name):
+            _echo(self.name, message if message is not None else Message.from_bytes(data))
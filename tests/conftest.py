@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts are run from their own directory, not installed as a package
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')))
@@ -0,0 +1,82 @@
+import threading
+import xml.etree.ElementTree as ET
+
+import mido
+
+from MIDI_MIrror import ActionExecutor, PRIORITY_BUTTON, parse_actions, parse_keys
+
+ACTIONS = """
+<config>
+    <actions>
+        <action trigger="note_on channel=0 note=40 velocity=127" dhd="true">
+            <keys>ctrl+alt+f12</keys>
+            <wait>0.01</wait>
+            <gpio>2A01, 2a02</gpio>
+        </action>
+        <action trigger="control_change channel=1 control=20 value=127" mirror="true">
+            <midi>note_on channel=0 note=1 velocity=127 AND note_off channel=0 note=1</midi>
+        </action>
+        <action>
+            <keys>ctrl+a</keys>
+        </action>
+        <action trigger="note_of channel=0 note=41">
+            <keys>ctrl+b</keys>
+        </action>
+        <action trigger="note_on channel=0 note=42 velocity=127">
+            <wait>soon</wait>
+        </action>
+    </actions>
+</config>
+"""
+
+
+def test_parse_actions_skips_bad_entries():
+    actions = parse_actions(ET.fromstring(ACTIONS))
+    # No trigger, an unknown message type and a bad step are left out
+    assert len(actions) == 2
+    keys = actions[tuple(mido.Message('note_on', note=40, velocity=127).bytes())]
+    assert keys['dhd'] and not keys['mirror']
+    assert keys['steps'] == (('keys', parse_keys('ctrl+alt+f12')), ('wait', 0.01), ('gpio', ('2A01', '2A02')))
+    macro = actions[tuple(mido.Message('control_change', channel=1, control=20, value=127).bytes())]
+    assert macro['mirror'] and not macro['dhd']
+    assert macro['steps'] == (('midi', (mido.Message('note_on', note=1, velocity=127), mido.Message('note_off', note=1))),)
+
+
+def test_parse_actions_without_actions():
+    assert parse_actions(ET.fromstring('<config/>')) == {}
+
+
+class RecordingGpio:
+    def __init__(self):
+        self.codes = []
+
+    def dispatch(self, codes):
+        self.codes.append(codes)
+
+
+def test_executor_runs_the_steps_in_order():
+    actions = parse_actions(ET.fromstring(ACTIONS))
+    done = threading.Event()
+    steps = []
+    gpio = RecordingGpio()
+    def press(keys):
+        steps.append(('keys', keys))
+    def emit(messages, priority):
+        steps.append(('midi', messages, priority))
+        done.set()
+    executor = ActionExecutor(press=press, gpio=gpio).start()
+    for action in actions.values():
+        assert executor.submit(action, emit)
+    assert done.wait(2)
+    assert steps == [('keys', parse_keys('ctrl+alt+f12')),
+                     ('midi', (mido.Message('note_on', note=1, velocity=127), mido.Message('note_off', note=1)), PRIORITY_BUTTON)]
+    assert gpio.codes == [['2A01', '2A02']]
+
+
+def test_executor_drops_actions_when_the_queue_is_full():
+    action = {'trigger': 'note_on channel=0 note=40 velocity=127', 'steps': ()}
+    # Not started, so nothing is taken off the queue
+    executor = ActionExecutor(capacity=2)
+    assert executor.submit(action, None)
+    assert executor.submit(action, None)
+    assert not executor.submit(action, None)
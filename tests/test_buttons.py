@@ -0,0 +1,115 @@
+import math
+import random
+
+import pytest
+
+from MIDI_MIrror import TimerWheel, ButtonPairer
+
+ON = ('note_on', 0, 32, 127)
+OFF = ('note_off', 0, 32, 0)
+OTHER = ('note_on', 0, 33, 127)
+
+
+@pytest.fixture
+def pairer():
+    dispatch = {
+        (ON, OFF): ('pair', 'toggle_on', 'device1', ()),
+        ON: ('single', 'toggle_on', 'device1', ()),
+        OTHER: ('other', 'toggle_off', 'device1', ()),
+    }
+    return ButtonPairer({32: 1, 33: 2}, dispatch, pair_window=0.1, debounce=0.01)
+
+
+def names(entries):
+    return [entry[0] for entry in entries]
+
+
+def test_wheel_returns_due_timers_in_deadline_order():
+    wheel = TimerWheel(tick=0.01, slots=8)
+    wheel.schedule('b', 0.05, 'b')
+    wheel.schedule('a', 0.03, 'a')
+    wheel.schedule('c', 0.5, 'c')
+    assert len(wheel) == 3
+    assert wheel.next_deadline() == pytest.approx(0.03, abs=0.01)
+    assert wheel.advance(0.02) == []
+    assert wheel.advance(0.06) == ['a', 'b']
+    assert wheel.next_deadline() == pytest.approx(0.5, abs=0.01)
+    # More than one turn of the wheel out
+    assert wheel.advance(0.3) == []
+    assert wheel.advance(0.5) == ['c']
+    assert wheel.next_deadline() is None
+
+
+def test_wheel_schedule_replaces_and_cancel_returns_value():
+    wheel = TimerWheel(tick=0.01, slots=8)
+    wheel.schedule('a', 0.03, 1)
+    wheel.schedule('a', 0.07, 2)
+    assert len(wheel) == 1
+    assert wheel.next_deadline() == pytest.approx(0.07, abs=0.01)
+    assert wheel.cancel('a') == 2
+    assert wheel.cancel('a') is None
+    assert wheel.advance(1.0) == []
+
+
+def test_wheel_matches_sorted_deadlines():
+    rng = random.Random(7)
+    tick = 0.002
+    wheel = TimerWheel(tick=tick, slots=16)
+    pending = {}
+    now = 0.0
+    for _ in range(5000):
+        key = rng.randrange(20)
+        action = rng.random()
+        if action < 0.5:
+            # Deadlines a little in the past fire on the next advance
+            deadline = now + rng.random() * 0.2 - 0.01
+            wheel.schedule(key, deadline, key)
+            pending[key] = math.ceil(deadline / tick)
+        elif action < 0.7:
+            assert (wheel.cancel(key) is None) == (key not in pending)
+            pending.pop(key, None)
+        else:
+            now += rng.random() * 0.05
+            current = math.floor(now / tick)
+            due = sorted((index, key) for key, index in pending.items() if index <= current)
+            fired = wheel.advance(now)
+            assert sorted(fired) == sorted(key for _, key in due)
+            assert [pending[key] for key in fired] == [index for index, _ in due]
+            for key in fired:
+                del pending[key]
+        assert len(wheel) == len(pending)
+        if pending:
+            assert wheel.next_deadline() == pytest.approx(min(pending.values()) * tick)
+        else:
+            assert wheel.next_deadline() is None
+
+
+def test_pairer_joins_note_on_with_note_off(pairer):
+    assert pairer.feed(ON, 0.0) == []
+    assert pairer.next_deadline() == pytest.approx(0.1, abs=0.002)
+    assert names(pairer.feed(OFF, 0.05)) == ['pair']
+    assert pairer.next_deadline() is None
+
+
+def test_pairer_sends_single_entry_when_window_runs_out(pairer):
+    pairer.feed(ON, 0.0)
+    assert pairer.expire(0.05) == []
+    assert names(pairer.expire(0.11)) == ['single']
+    assert pairer.expire(0.2) == []
+
+
+def test_pairer_dispatches_unpaired_messages_right_away(pairer):
+    assert names(pairer.feed(OTHER, 0.0)) == ['other']
+    assert pairer.is_button(33)
+    assert not pairer.is_button(40)
+
+
+def test_pairer_drops_bounce_and_releases_held(pairer):
+    pairer.feed(ON, 0.0)
+    # Bounce of the same message does not restart the window
+    assert pairer.feed(ON, 0.005) == []
+    assert names(pairer.release()) == ['single']
+    assert pairer.release() == []
+    # Another press of the held button counts on its own
+    pairer.feed(ON, 0.5)
+    assert names(pairer.feed(ON, 0.55)) == ['single']
@@ -0,0 +1,36 @@
+from MIDI_MIrror import FaderCoalescer
+
+
+def test_first_value_goes_straight_through():
+    coalescer = FaderCoalescer(0.02)
+    assert coalescer.submit('fader', 'a', 1.0) == 'a'
+    assert coalescer.next_deadline() is None
+
+
+def test_last_value_in_the_window_wins():
+    coalescer = FaderCoalescer(0.02)
+    coalescer.submit('fader', 'a', 1.0)
+    assert coalescer.submit('fader', 'b', 1.005) is None
+    assert coalescer.submit('fader', 'c', 1.01) is None
+    assert coalescer.next_deadline() == 1.02
+    assert coalescer.flush_due(1.015) == []
+    assert coalescer.flush_due(1.02) == ['c']
+    assert coalescer.next_deadline() is None
+
+
+def test_window_starts_again_after_a_flush():
+    coalescer = FaderCoalescer(0.02)
+    coalescer.submit('fader', 'a', 1.0)
+    coalescer.submit('fader', 'b', 1.01)
+    assert coalescer.flush_due(1.03) == ['b']
+    assert coalescer.submit('fader', 'c', 1.04) is None
+    assert coalescer.flush_due(1.05) == ['c']
+    assert coalescer.submit('fader', 'd', 1.08) == 'd'
+
+
+def test_parameters_are_coalesced_apart():
+    coalescer = FaderCoalescer(0.02)
+    assert coalescer.submit(1, 'a', 1.0) == 'a'
+    assert coalescer.submit(2, 'b', 1.005) == 'b'
+    assert coalescer.submit(1, 'c', 1.01) is None
+    assert coalescer.flush_due(1.02) == ['c']
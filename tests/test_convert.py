@@ -0,0 +1,83 @@
+import mido
+import pytest
+
+from midi_convert import (build_value_table, build_conversions, check_fader_range, get_source_key, get_taper,
+                          ControlChangeConversion, NrpnConversion, PitchbendConversion)
+
+CC = {'type': 'control_change', 'value': 7}
+NRPN = {'type': 'NRPN', 'value': 0x1017}
+PITCHBEND = {'type': 'pitchbend', 'value': 3}
+
+
+def test_identity_and_resolution_tables():
+    assert list(build_value_table(CC, CC)) == list(range(128))
+    table = build_value_table(CC, NRPN)
+    assert len(table) == 128
+    assert (table[0], table[127]) == (0, 16383)
+    table = build_value_table(NRPN, CC)
+    assert len(table) == 16384
+    assert (table[0], table[8192], table[16383]) == (0, 64, 127)
+    assert list(table) == sorted(table)
+
+
+def test_range_and_inversion():
+    ranged = dict(CC, min_value=10, max_value=100)
+    table = build_value_table(ranged, CC)
+    # Values outside the range hold the end points
+    assert (table[0], table[10], table[55], table[100], table[127]) == (0, 0, 64, 127, 127)
+    assert list(build_value_table(dict(CC, invert=True), CC)) == list(range(127, -1, -1))
+    assert list(build_value_table(dict(CC, min_value=127, max_value=0), CC)) == list(range(127, -1, -1))
+    # Inverted on both sides cancels out
+    assert list(build_value_table(dict(CC, invert=True), dict(CC, invert=True))) == list(range(128))
+
+
+def test_taper_folds_into_table():
+    table = build_value_table(CC, dict(CC, taper=get_taper('log')))
+    assert (table[0], table[127]) == (0, 127)
+    assert table[64] == round((64 / 127) ** 2 * 127)
+    # The same taper on both sides cancels out
+    assert list(build_value_table(dict(CC, taper=2.0), dict(CC, taper=2.0))) == list(range(128))
+
+
+def test_get_taper():
+    assert get_taper('linear') == 1.0
+    assert get_taper('1.5') == 1.5
+    with pytest.raises(ValueError):
+        get_taper(0)
+
+
+def test_conversions_put_the_same_value_on_the_wire():
+    conversion = ControlChangeConversion(CC, dict(CC, value=9), 2)
+    assert conversion.convert(100) == (mido.Message('control_change', channel=2, control=9, value=100),)
+    assert conversion.convert_raw(100) == bytes(conversion.convert(100)[0].bytes())
+
+    conversion = NrpnConversion(CC, NRPN, 1)
+    messages = conversion.convert(127)
+    assert [(message.control, message.value) for message in messages] == [(99, 0x20), (98, 0x17), (6, 127), (38, 127)]
+    assert bytes(conversion.convert_raw(127)) == b''.join(bytes(message.bytes()) for message in messages)
+    # Every raw group is a copy of its own
+    assert conversion.convert_raw(0) is not conversion.convert_raw(0)
+
+    conversion = PitchbendConversion(CC, PITCHBEND, 0)
+    assert conversion.convert(0) == (mido.Message('pitchwheel', channel=3, pitch=-8192),)
+    assert conversion.convert_raw(127) == bytes(conversion.convert(127)[0].bytes())
+
+
+def test_build_conversions_matches_faders_by_id():
+    source = {'channel': 0, 'faders': {1: CC, 2: NRPN, 3: dict(CC, value=8)}}
+    target = {'channel': 4, 'faders': {1: NRPN, 2: PITCHBEND, 4: CC}}
+    conversions = build_conversions(source, target)
+    assert conversions == {('control_change', 7): NrpnConversion(CC, NRPN, 4),
+                           ('nrpn', 0x1017): PitchbendConversion(NRPN, PITCHBEND, 4)}
+    assert get_source_key(PITCHBEND) == ('pitchwheel', 3)
+
+
+def test_range_outside_the_resolution_is_rejected():
+    check_fader_range(dict(CC, min_value=0, max_value=127))
+    check_fader_range(dict(NRPN, max_value=16383))
+    with pytest.raises(ValueError, match='max_value 128 is outside 0-127'):
+        check_fader_range(dict(CC, max_value=128))
+    with pytest.raises(ValueError, match='min_value -1'):
+        check_fader_range(dict(NRPN, min_value=-1))
+    with pytest.raises(ValueError, match='max_value 16384'):
+        check_fader_range(dict(PITCHBEND, max_value=16384))
@@ -0,0 +1,43 @@
+import mido
+
+from MIDI_MIrror import EchoSuppressor
+
+
+def control_changes(*controls, channel=0):
+    return [mido.Message('control_change', channel=channel, control=control, value=value) for control, value in controls]
+
+
+def test_echo_inside_the_window_is_suppressed():
+    echoes = EchoSuppressor(0.1)
+    echoes.record(control_changes((7, 64)), 1.0)
+    assert echoes.is_echo(('control_change', 0, 7), 64, 1.05)
+    assert echoes.is_echo(('control_change', 0, 7), 64, 1.09)
+
+
+def test_move_after_the_window_passes():
+    echoes = EchoSuppressor(0.1)
+    echoes.record(control_changes((7, 64)), 1.0)
+    assert not echoes.is_echo(('control_change', 0, 7), 64, 1.2)
+
+
+def test_other_value_or_parameter_passes():
+    echoes = EchoSuppressor(0.1)
+    echoes.record(control_changes((7, 64)), 1.0)
+    assert not echoes.is_echo(('control_change', 0, 7), 65, 1.01)
+    assert not echoes.is_echo(('control_change', 0, 8), 64, 1.01)
+    assert not echoes.is_echo(('control_change', 1, 7), 64, 1.01)
+
+
+def test_nrpn_is_compared_at_seven_bits():
+    echoes = EchoSuppressor(0.1)
+    echoes.record(control_changes((99, 0x20), (98, 0x17), (6, 0x40), (38, 0x05)), 1.0)
+    assert echoes.is_echo(('nrpn', 0, (0x20 << 7) | 0x17), 0x40, 1.05)
+    assert not echoes.is_echo(('nrpn', 0, (0x20 << 7) | 0x17), 0x41, 1.05)
+
+
+def test_raw_bytes_record_the_same_keys():
+    echoes = EchoSuppressor(0.1)
+    echoes.record_raw(bytes((0xB0, 99, 0x20, 0xB0, 98, 0x17, 0xB0, 6, 0x40, 0xB0, 38, 0x05)), 1.0)
+    echoes.record_raw(bytes((0xE1, 0x00, 0x50)), 1.0)
+    assert echoes.is_echo(('nrpn', 0, (0x20 << 7) | 0x17), 0x40, 1.05)
+    assert echoes.is_echo(('pitchwheel', 1), 0x50, 1.05)
@@ -0,0 +1,17 @@
+from MIDI_MIrror import decode_gpio_frames
+
+
+def test_decodes_complete_frames():
+    assert decode_gpio_frames(bytes((1, 0x2A, 0x01, 2, 0x01, 0x00, 0x02, 0xFF))) == (['2A01', '0100', '02FF'], b'')
+
+
+def test_keeps_partial_frame():
+    codes, rest = decode_gpio_frames(bytes((1, 0x2A, 0x01, 2, 0x01, 0x00, 0x02)))
+    assert codes == ['2A01']
+    assert rest == bytes((2, 0x01, 0x00, 0x02))
+    assert decode_gpio_frames(rest + bytes((0x03,))) == (['0100', '0203'], b'')
+
+
+def test_empty_frames_and_buffer():
+    assert decode_gpio_frames(b'') == ([], b'')
+    assert decode_gpio_frames(bytes((0, 0, 1, 0x10))) == ([], bytes((1, 0x10)))
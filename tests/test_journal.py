@@ -0,0 +1,41 @@
+import mido
+
+from midi_journal import Journal, read_journal, JOURNAL_IN, JOURNAL_OUT
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'port.journal')
+    journal = Journal(path, 'In', 'Out', records=8)
+    journal.record(JOURNAL_IN, mido.Message('control_change', channel=1, control=7, value=100))
+    journal.record_bytes(JOURNAL_OUT, b'\xc0\x05')
+    journal.record_bytes(JOURNAL_OUT, b'\xf0\x01\x02\x03\xf7')
+    journal.close()
+
+    info, entries = read_journal(path)
+    assert (info['input'], info['output']) == ('In', 'Out')
+    assert [(tag, data) for _, tag, data in entries] == [
+        (JOURNAL_IN, b'\xb1\x07\x64'), (JOURNAL_OUT, b'\xc0\x05'), (JOURNAL_OUT, b'\xf0\x01\x02')]
+    timestamps = [timestamp for timestamp, _, _ in entries]
+    assert timestamps == sorted(timestamps)
+
+
+def test_ring_keeps_the_newest_records(tmp_path):
+    path = str(tmp_path / 'port.journal')
+    journal = Journal(path, 'In', 'Out', records=4)
+    for value in range(10):
+        journal.record_bytes(JOURNAL_IN, bytes((0xB0, 7, value)))
+    journal.close()
+    _, entries = read_journal(path)
+    assert [data[2] for _, _, data in entries] == [6, 7, 8, 9]
+
+
+def test_previous_journal_is_kept(tmp_path):
+    path = str(tmp_path / 'port.journal')
+    journal = Journal(path, 'In', 'Out', records=4)
+    journal.record_bytes(JOURNAL_IN, b'\x90\x20\x7f')
+    journal.close()
+    Journal(path, 'In', 'Out', records=4).close()
+
+    _, entries = read_journal(path + '.1')
+    assert [data for _, _, data in entries] == [b'\x90\x20\x7f']
+    assert read_journal(path)[1] == []
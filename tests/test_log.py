@@ -0,0 +1,58 @@
+import io
+
+import midi_log
+from midi_log import Logger, WARNING
+
+
+def make_logger(**options):
+    # A long linger keeps the writer thread asleep, records stay in the ring until flush
+    return Logger(stream=io.StringIO(), linger=60, **options)
+
+
+def test_category_is_limited_per_second(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(midi_log.time, 'time', lambda: now[0])
+    logger = make_logger()
+    for number in range(60):
+        logger.info('gpio', 'code %d', number)
+    logger.info('mirror', 'other category')
+    assert logger.rate_limited == 10
+    assert len(logger.records) == 51
+    now[0] += 1.0
+    logger.info('gpio', 'next second')
+    logger.flush()
+    lines = logger.stream.getvalue().splitlines()
+    assert lines[:2] == ['code 0', 'code 1']
+    assert "10 more 'gpio' messages were rate limited" in lines
+    assert lines[-1] == 'next second'
+
+
+def test_rate_limits_override_one_category(monkeypatch):
+    monkeypatch.setattr(midi_log.time, 'time', lambda: 100.0)
+    logger = make_logger(rate_limits={'buttons': 2})
+    for _ in range(5):
+        logger.info('buttons', 'press')
+        logger.info('gpio', 'code')
+    assert logger.rate_limited == 3
+    assert len(logger.records) == 7
+
+
+def test_full_ring_drops_the_oldest_and_counts():
+    logger = Logger(stream=io.StringIO(), linger=60, rate_limit=0)
+    for number in range(4096 + 5):
+        logger.info('mirror', 'record %d', number)
+    assert logger.dropped == 5
+    assert logger.records[0][4] == (5,)
+    logger.flush()
+    lines = logger.stream.getvalue().splitlines()
+    assert lines[0] == 'record 5'
+    assert lines[-1] == '5 log records dropped, the log buffer was full'
+    assert len(lines) == 4096 + 1
+
+
+def test_level_filters_before_the_ring():
+    logger = Logger(stream=io.StringIO(), linger=60, level=WARNING)
+    logger.info('mirror', 'hidden')
+    logger.warning('mirror', 'shown')
+    logger.flush()
+    assert logger.stream.getvalue() == 'shown\n'
@@ -0,0 +1,82 @@
+import mido
+
+from MIDI_MIrror import NrpnParser, NrpnEncoder
+
+
+def feed(parser, *controls, channel=0):
+    return [parser.feed(channel, control, value) for control, value in controls]
+
+
+def control_changes(*controls, channel=0):
+    return [mido.Message('control_change', channel=channel, control=control, value=value) for control, value in controls]
+
+
+def test_parser_reports_msb_then_lsb():
+    parser = NrpnParser()
+    results = feed(parser, (99, 0x20), (98, 0x17), (6, 0x40), (38, 0x01))
+    assert results == [None, None, ('nrpn', (0x20 << 7) | 0x17, 0x40 << 7), ('nrpn', (0x20 << 7) | 0x17, (0x40 << 7) | 0x01)]
+    # Once CC 38 has been seen the MSB alone waits for its LSB
+    assert feed(parser, (6, 0x10), (38, 0x02)) == [None, ('nrpn', (0x20 << 7) | 0x17, (0x10 << 7) | 0x02)]
+
+
+def test_parser_keeps_selection_for_data_entry_only():
+    parser = NrpnParser()
+    assert feed(parser, (99, 1), (98, 2), (6, 5)) == [None, None, ('nrpn', 130, 5 << 7)]
+    assert feed(parser, (6, 7)) == [('nrpn', 130, 7 << 7)]
+
+
+def test_parser_channels_are_independent():
+    parser = NrpnParser()
+    feed(parser, (99, 1), (98, 2), channel=0)
+    assert feed(parser, (6, 5), channel=1) == [None]
+    assert feed(parser, (6, 5), channel=0) == [('nrpn', 130, 5 << 7)]
+
+
+def test_parser_increment_and_decrement():
+    parser = NrpnParser()
+    feed(parser, (99, 0), (98, 1), (6, 10))
+    assert feed(parser, (96, 0)) == [('nrpn', 1, 11 << 7)]
+    assert feed(parser, (97, 0), (97, 0)) == [('nrpn', 1, 10 << 7), ('nrpn', 1, 9 << 7)]
+
+
+def test_parser_ignores_null_parameter_and_rpn_kind():
+    parser = NrpnParser()
+    assert feed(parser, (99, 127), (98, 127), (6, 1)) == [None, None, None]
+    assert feed(parser, (101, 0), (100, 0), (6, 2)) == [None, None, ('rpn', 0, 2 << 7)]
+
+
+def test_encoder_drops_repeated_select():
+    encoder = NrpnEncoder()
+    sequence = control_changes((99, 1), (98, 2), (6, 3), (38, 4))
+    assert encoder.encode(sequence) == sequence
+    assert [message.control for message in encoder.encode(sequence)] == [6, 38]
+    # A new LSB only sends CC 98
+    other = control_changes((99, 1), (98, 5), (6, 3), (38, 4))
+    assert [message.control for message in encoder.encode(other)] == [98, 6, 38]
+
+
+def test_encoder_reset_sends_select_again():
+    encoder = NrpnEncoder()
+    sequence = control_changes((99, 1), (98, 2), (6, 3), (38, 4))
+    encoder.encode(sequence)
+    encoder.reset()
+    assert encoder.encode(sequence) == sequence
+
+
+def test_encoder_rpn_select_clears_nrpn_selection():
+    encoder = NrpnEncoder()
+    sequence = control_changes((99, 1), (98, 2), (6, 3))
+    encoder.encode(sequence)
+    encoder.encode(control_changes((101, 0), (100, 0)))
+    assert encoder.encode(sequence) == sequence
+
+
+def test_encoder_raw_matches_message_encoding():
+    encoder = NrpnEncoder()
+    data = bytes((0xB0, 99, 1, 0xB0, 98, 2, 0xB0, 6, 3, 0xB0, 38, 4))
+    assert encoder.encode_raw(data) == data
+    assert encoder.encode_raw(data) == data[6:]
+    assert encoder.encode_raw(bytes((0xB0, 99, 1, 0xB0, 98, 9)) + data[6:]) == bytes((0xB0, 98, 9)) + data[6:]
+    # Other channels and other messages pass unchanged
+    assert encoder.encode_raw(bytes((0xB1,)) + data[1:]) == bytes((0xB1,)) + data[1:]
+    assert encoder.encode_raw(bytes((0xB0, 7, 100))) == bytes((0xB0, 7, 100))
@@ -0,0 +1,54 @@
+import shutil
+
+import pytest
+
+import MIDI_MIrror
+from MIDI_MIrror import LiveTables, load_device_pair, reload_device_pair
+
+
+@pytest.fixture
+def configs(tmp_path, monkeypatch):
+    # Copies of the shipped configs, compiled and cached in tmp_path
+    for device in ('Q16', 'Xtouch-One'):
+        shutil.copy(MIDI_MIrror.get_config_path(f'{device}.xml'), tmp_path)
+    monkeypatch.setattr(MIDI_MIrror, 'get_config_path', lambda file_name: str(tmp_path / file_name))
+    monkeypatch.setattr(MIDI_MIrror, 'CONFIG_CACHE_DIR', str(tmp_path / '.cache'))
+    live_tables = LiveTables(load_device_pair('Q16', 'Xtouch-One'))
+    return tmp_path, live_tables
+
+
+def edit(path, old, new):
+    text = path.read_text(encoding='utf-8-sig')
+    assert old in text
+    path.write_text(text.replace(old, new, 1), encoding='utf-8')
+
+
+def test_good_config_swaps_the_tables(configs):
+    tmp_path, live_tables = configs
+    old = live_tables.current
+    edit(tmp_path / 'Xtouch-One.xml', '</channel>', '</channel>\n\t\t<fader_interval>0.05</fader_interval>')
+    assert reload_device_pair('Q16', 'Xtouch-One', live_tables)
+    assert live_tables.current is not old
+    assert live_tables.current['device2']['fader_interval'] == 0.05
+    assert old['device2']['fader_interval'] == 0.02
+
+
+def test_unchanged_config_is_not_swapped(configs):
+    _, live_tables = configs
+    old = live_tables.current
+    assert not reload_device_pair('Q16', 'Xtouch-One', live_tables)
+    assert live_tables.current is old
+
+
+@pytest.mark.parametrize('old, new', [
+    ('</faders>', '</fader>'),                                    # not well-formed
+    ('type="NRPN" value="4119"', 'type="NRPN" value="4119" max_value="20000"'),   # outside the 14-bit range
+    ('<channel>1</channel>', '<channel>2</channel>'),             # needs a restart
+    ('QU-16 MIDI Out 1', 'QU-16 MIDI Out 2'),
+])
+def test_bad_config_keeps_the_old_tables(configs, old, new):
+    tmp_path, live_tables = configs
+    tables = live_tables.current
+    edit(tmp_path / 'Q16.xml', old, new)
+    assert not reload_device_pair('Q16', 'Xtouch-One', live_tables)
+    assert live_tables.current is tables
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import mido
+import pytest
+
+import midi_sim
+import MIDI_MIrror
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def star():
+    # The Q16 as console with two copies of the Xtouch-One on their own ports
+    console = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config('Q16.xml'))
+    surfaces = []
+    for number in (1, 2):
+        config = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config('Xtouch-One.xml'))
+        config['midi_in_name'] = f"{config['midi_in_name']} #{number}"
+        config['midi_out_name'] = f"{config['midi_out_name']} #{number}"
+        surfaces.append(config)
+    mido.set_backend('midi_sim')
+    outputs = {}
+    for config in [console] + surfaces:
+        midi_sim.add_device(config['midi_in_name'], is_input=True, is_output=False)
+        midi_sim.add_device(config['midi_out_name'], is_input=False, is_output=True)
+        received = outputs[config['midi_out_name']] = []
+        midi_sim.add_output_listener(config['midi_out_name'], lambda message, timestamp, received=received: received.append(message))
+    devices = ['Q16', 'Surface A', 'Surface B']
+    pairs = {('Q16', device): MIDI_MIrror.compile_device_pair(console, config) for device, config in zip(devices[1:], surfaces)}
+    router = MIDI_MIrror.MidiRouter(devices, pairs, False)
+    threading.Thread(target=router.run, daemon=True).start()
+    assert router.ready.wait(5)
+    # The router runs until the test process exits, like it does in the script
+    yield console, surfaces, outputs
+    midi_sim.reset()
+
+
+def test_star_relays_surface_faders_to_sibling_surfaces(star):
+    console, (surface_a, surface_b), outputs = star
+    fader = surface_a['faders'][1]
+    midi_sim.inject(surface_a['midi_in_name'], mido.Message('control_change', channel=surface_a['channel'], control=fader['value'], value=100))
+
+    expected = mido.Message('control_change', channel=surface_b['channel'], control=surface_b['faders'][1]['value'], value=100)
+    assert wait_for(lambda: expected in outputs[surface_b['midi_out_name']])
+    assert any(message.type == 'control_change' and message.control == 6 for message in outputs[console['midi_out_name']])
+    # The surface the value came from does not get it back
+    assert not outputs[surface_a['midi_out_name']]
@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from midi_shared import RingQueue
+
+
+@pytest.fixture
+def ring():
+    ring = RingQueue(threading.Semaphore(0), capacity=4, slot_size=16)
+    yield ring
+    ring.close()
+
+
+def test_put_and_get_in_order(ring):
+    assert ring.get() is None
+    assert ring.put(b'one')
+    assert ring.put(b'')
+    assert ring.put(bytes(range(ring.payload_size)))
+    assert ring.doorbell.acquire(blocking=False)
+    assert ring.get() == b'one'
+    assert ring.get() == b''
+    assert ring.get() == bytes(range(ring.payload_size))
+    assert ring.get() is None
+
+
+def test_full_ring_refuses_and_wraps(ring):
+    for value in range(4):
+        assert ring.put(bytes((value,)))
+    assert not ring.put(b'x')
+    assert not ring.put_wait(b'x', timeout=0.01)
+    assert [ring.get() for _ in range(4)] == [bytes((value,)) for value in range(4)]
+    # Interleaved put/get over several turns of the ring
+    for value in range(4, 20):
+        assert ring.put(bytes((value,)))
+        assert ring.get() == bytes((value,))
+    assert ring.get() is None
+
+
+def test_second_handle_reads_the_same_memory(ring):
+    # What a spawned process gets when the ring is pickled
+    other = RingQueue(ring.doorbell, ring.capacity, ring.slot_size, name=ring.name)
+    try:
+        ring.put(b'shared')
+        assert other.get() == b'shared'
+        assert ring.get() is None
+    finally:
+        other.close()
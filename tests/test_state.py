@@ -0,0 +1,88 @@
+import time
+
+import mido
+
+import MIDI_MIrror
+from MIDI_MIrror import DeviceState, MirrorDirection, PortWriter, PRIORITY_BULK, PRIORITY_FADER, send_resync
+
+
+class RecordingPort:
+    name = 'Recording'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def wait_for_sent(port, count, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while len(port.sent) < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return len(port.sent) >= count
+
+
+def fader(control, value):
+    return (mido.Message('control_change', control=control, value=value),)
+
+
+def test_update_reports_redundant_fader_values():
+    state = DeviceState(0)
+    assert state.update(fader(7, 64))
+    assert not state.update(fader(7, 64))
+    assert state.update(fader(7, 65))
+    nrpn = tuple(mido.Message('control_change', control=control, value=value) for control, value in ((99, 32), (98, 23), (6, 64), (38, 1)))
+    assert state.update(nrpn)
+    assert not state.update(nrpn)
+    assert state.get_fader(('nrpn', (32 << 7) | 23)) == (64 << 7) | 1
+
+
+def test_writer_skips_a_value_the_device_holds():
+    port = RecordingPort()
+    writer = PortWriter(port, state=DeviceState(0))
+    # One at a time, a queued fader group would be replaced by the next
+    for value in (64, 64, 65):
+        writer.send(fader(7, value), PRIORITY_FADER)
+        time.sleep(0.02)
+    writer.close()
+    assert [message.value for message in port.sent] == [64, 65]
+
+
+def test_live_value_replaces_a_queued_resync_value():
+    port = RecordingPort()
+    writer = PortWriter(port, bytes_per_second=100, state=DeviceState(0))
+    writer.send(fader(1, 1), PRIORITY_FADER)
+    assert wait_for_sent(port, 1)
+    writer.send(fader(7, 10), PRIORITY_BULK)
+    writer.send(fader(7, 20), PRIORITY_FADER)
+    writer.send(fader(7, 30), PRIORITY_FADER)
+    assert wait_for_sent(port, 2)
+    writer.close()
+    # The resync value would otherwise be written after the newer ones
+    assert [(message.control, message.value) for message in port.sent] == [(1, 1), (7, 30)]
+
+
+def test_resync_sends_every_known_value_again():
+    q16 = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config('Q16.xml'))
+    xtouch = MIDI_MIrror.parse_config(MIDI_MIrror.read_xml_config('Xtouch-One.xml'))
+    tables = MIDI_MIrror.compile_device_pair(q16, xtouch)
+    # The Xtouch-One direction towards the Q16 learns what the Xtouch-One holds
+    emitted = []
+    mirror = MirrorDirection(lambda messages, priority: emitted.append(messages), tables['conversions']['device2'],
+                             tables['button_notes'], tables['button_dispatch'], False,
+                             state=DeviceState(xtouch['channel']))
+    for control, value in ((1, 100), (7, 20)):
+        mirror.handle(mido.Message('control_change', channel=xtouch['channel'], control=control, value=value))
+    port = RecordingPort()
+    writer = PortWriter(port, state=DeviceState(q16['channel']))
+    for messages in emitted:
+        writer.send(messages, PRIORITY_FADER)
+    assert wait_for_sent(port, 7)
+    before = len(port.sent)
+    # Both values again with the NRPN selected from scratch, although the Q16 holds them
+    assert send_resync(writer, [mirror], 'Q16') == 2
+    assert wait_for_sent(port, before * 2)
+    writer.close()
+    assert port.sent[before:] == port.sent[:before]
+    assert port.sent[0].control == 99 and port.sent[4].control == 99
@@ -0,0 +1,82 @@
+import time
+
+import mido
+import pytest
+
+import midi_sim
+from MIDI_MIrror import PortSupervisor, PortWriter, PRIORITY_BULK, PRIORITY_FADER
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def fader(value):
+    return (mido.Message('control_change', control=7, value=value),)
+
+
+@pytest.fixture
+def device():
+    # One surface with an input and an output port, both supervised
+    mido.set_backend('midi_sim')
+    midi_sim.add_device('Surface In', is_input=True, is_output=False)
+    midi_sim.add_device('Surface Out', is_input=False, is_output=True)
+    sent = []
+    midi_sim.add_output_listener('Surface Out', lambda message, timestamp: sent.append(message))
+    received = []
+    writer = PortWriter(None)
+    held = {}
+    def restore():
+        for messages in held.values():
+            writer.send(messages, PRIORITY_BULK)
+    supervisor = PortSupervisor(interval=0.02, min_backoff=0.01, max_backoff=0.05)
+    supervisor.add_input('Surface In', callback=received.append)
+    supervisor.add_output('Surface Out', writer, restore=restore)
+    supervisor.start()
+    yield supervisor, writer, held, sent, received
+    supervisor.close()
+    writer.close()
+    midi_sim.reset()
+
+
+def test_reconnect_replays_the_state(device):
+    supervisor, writer, held, sent, received = device
+    held['fader'] = fader(64)
+    writer.send(fader(64), PRIORITY_FADER)
+    midi_sim.inject('Surface In', fader(10)[0])
+    assert wait_for(lambda: len(sent) == 1 and len(received) == 1)
+    midi_sim.disconnect('Surface In')
+    midi_sim.disconnect('Surface Out')
+    assert wait_for(lambda: all(port.port is None for port in supervisor.ports))
+    # Gone while unplugged, nothing arrives and nothing is written
+    midi_sim.inject('Surface In', fader(11)[0])
+    writer.send(fader(70), PRIORITY_FADER)
+    time.sleep(0.05)
+    assert len(sent) == 1 and len(received) == 1
+    midi_sim.connect('Surface In')
+    midi_sim.connect('Surface Out')
+    assert wait_for(lambda: len(sent) == 2)
+    assert sent[1] == fader(64)[0]
+    midi_sim.inject('Surface In', fader(12)[0])
+    assert wait_for(lambda: len(received) == 2)
+    assert received[1].value == 12
+
+
+def test_port_missing_at_startup_is_opened_once_there():
+    mido.set_backend('midi_sim')
+    supervisor = PortSupervisor(interval=0.02, min_backoff=0.01, max_backoff=0.05)
+    received = []
+    supervised = supervisor.add_input('Late In', callback=received.append)
+    supervisor.start()
+    try:
+        assert supervised.port is None
+        midi_sim.add_device('Late In', is_input=True, is_output=False)
+        assert wait_for(lambda: supervised.port is not None)
+        midi_sim.inject('Late In', fader(5)[0])
+        assert wait_for(lambda: len(received) == 1)
+    finally:
+        supervisor.close()
+        midi_sim.reset()
@@ -0,0 +1,86 @@
+import time
+
+import mido
+
+from MIDI_MIrror import PortWriter, PRIORITY_BUTTON, PRIORITY_FADER, PRIORITY_BULK, DIN_MIDI_BYTES_PER_SECOND
+
+
+class RecordingPort:
+    name = 'Recording'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append((message, time.monotonic()))
+
+
+def fader(control, value):
+    return (mido.Message('control_change', control=control, value=value),)
+
+
+def button(note):
+    return (mido.Message('note_on', note=note, velocity=127),)
+
+
+def sent_messages(port):
+    return [message for message, _ in port.sent]
+
+
+def wait_for_sent(port, count, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while len(port.sent) < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return len(port.sent) >= count
+
+
+def test_lanes_are_served_by_priority():
+    port = RecordingPort()
+    # Slow enough that everything after the first group queues up behind it
+    writer = PortWriter(port, bytes_per_second=100)
+    writer.send(fader(1, 1), PRIORITY_FADER)
+    assert wait_for_sent(port, 1)
+    writer.send(fader(2, 2), PRIORITY_BULK)
+    writer.send(fader(3, 3), PRIORITY_FADER)
+    writer.send(button(60), PRIORITY_BUTTON)
+    assert wait_for_sent(port, 4)
+    writer.close()
+    assert sent_messages(port) == [fader(1, 1)[0], button(60)[0], fader(3, 3)[0], fader(2, 2)[0]]
+
+
+def test_output_is_paced_to_the_din_rate():
+    port = RecordingPort()
+    writer = PortWriter(port, DIN_MIDI_BYTES_PER_SECOND)
+    for control in range(20):
+        writer.send(fader(control, 64), PRIORITY_FADER)
+    assert wait_for_sent(port, 20)
+    writer.close()
+    elapsed = port.sent[-1][1] - port.sent[0][1]
+    # Three bytes per message, the first one goes out at once
+    assert elapsed >= 19 * 3 / DIN_MIDI_BYTES_PER_SECOND * 0.95
+
+
+def test_newer_fader_value_replaces_the_queued_one():
+    port = RecordingPort()
+    writer = PortWriter(port, bytes_per_second=100)
+    writer.send(fader(1, 1), PRIORITY_FADER)
+    assert wait_for_sent(port, 1)
+    writer.send(fader(2, 10), PRIORITY_FADER)
+    writer.send(fader(3, 30), PRIORITY_FADER)
+    writer.send(fader(2, 20), PRIORITY_FADER)
+    assert wait_for_sent(port, 3)
+    writer.close()
+    # The newer value keeps the place of the one it replaced
+    assert sent_messages(port) == [fader(1, 1)[0], fader(2, 20)[0], fader(3, 30)[0]]
+
+
+def test_bulk_groups_are_not_replaced():
+    port = RecordingPort()
+    writer = PortWriter(port, bytes_per_second=100)
+    writer.send(fader(1, 1), PRIORITY_FADER)
+    assert wait_for_sent(port, 1)
+    writer.send(fader(2, 10), PRIORITY_BULK)
+    writer.send(fader(2, 20), PRIORITY_BULK)
+    assert wait_for_sent(port, 3)
+    writer.close()
+    assert sent_messages(port) == [fader(1, 1)[0], fader(2, 10)[0], fader(2, 20)[0]]